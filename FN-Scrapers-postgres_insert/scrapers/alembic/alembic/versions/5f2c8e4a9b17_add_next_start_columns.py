@@ -0,0 +1,31 @@
+"""Add next_can_start_at and next_should_start_at columns
+
+Revision ID: 5f2c8e4a9b17
+Revises: d14d027ecc5f
+Create Date: 2026-10-17 10:12:41.530214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2c8e4a9b17'
+down_revision = 'd14d027ecc5f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The columns start out NULL - schedulers compute them as they acquire work.
+    op.add_column('schedules', sa.Column('next_can_start_at', sa.DateTime(timezone=True), nullable=True), schema='fnscrapers')
+    op.add_column('schedules', sa.Column('next_should_start_at', sa.DateTime(timezone=True), nullable=True), schema='fnscrapers')
+    op.create_index(
+        'schedules_next_start_idx', 'schedules', ['next_should_start_at', 'next_can_start_at', 'scraper_name'],
+        schema='fnscrapers', postgresql_where=sa.text('owner_tag IS NULL'))
+
+
+def downgrade():
+    op.drop_index('schedules_next_start_idx', table_name='schedules', schema='fnscrapers')
+    op.drop_column('schedules', 'next_should_start_at', schema='fnscrapers')
+    op.drop_column('schedules', 'next_can_start_at', schema='fnscrapers')
@@ -0,0 +1,42 @@
+"""Create scraper_runs table
+
+Revision ID: a3d7e1c94f20
+Revises: 5f2c8e4a9b17
+Create Date: 2026-10-17 14:03:27.118452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d7e1c94f20'
+down_revision = '5f2c8e4a9b17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('scraper_runs',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('scraper_name', sa.String(), nullable=False),
+    sa.Column('owner_node', sa.String(), nullable=False),
+    sa.Column('owner_name', sa.String(), nullable=False),
+    sa.Column('owner_tag', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('start_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('end_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('returncode', sa.BigInteger(), nullable=True),
+    sa.Column('maxrss', sa.BigInteger(), nullable=True),
+    sa.Column('utime', sa.Float(), nullable=True),
+    sa.Column('stime', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    schema='fnscrapers',
+    )
+    op.create_index(
+        'scraper_runs_scraper_name_end_at_idx', 'scraper_runs', ['scraper_name', 'end_at'], schema='fnscrapers')
+
+
+def downgrade():
+    op.drop_index('scraper_runs_scraper_name_end_at_idx', table_name='scraper_runs', schema='fnscrapers')
+    op.drop_table('scraper_runs', schema='fnscrapers')
@@ -0,0 +1,31 @@
+"""Create schedule_heartbeats table
+
+Revision ID: c81f5b2e6d09
+Revises: a3d7e1c94f20
+Create Date: 2026-10-17 16:41:09.582731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f5b2e6d09'
+down_revision = 'a3d7e1c94f20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('schedule_heartbeats',
+    sa.Column('owner_tag', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('scraper_name', sa.String(), nullable=False),
+    sa.Column('last_ping_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('owner_tag'),
+    schema='fnscrapers',
+    )
+
+
+def downgrade():
+    op.drop_table('schedule_heartbeats', schema='fnscrapers')
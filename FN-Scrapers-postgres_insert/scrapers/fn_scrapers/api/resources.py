@@ -35,7 +35,13 @@ from fn_dataaccess_client.blocking.locality_metadata import LocalityMetadataData
 
 from fn_scrapers.common import files, http
 from fn_scrapers.common.files import Session as FilesSession
+from fn_scrapers.common.files import ConnectionPool as FilesConnectionPool
+from fn_scrapers.common.files import DownloadIndex as FilesDownloadIndex
+from fn_scrapers.common.files import ExtractionCache as FilesExtractionCache
 from fn_scrapers.common.http import Session as HttpSession
+from fn_scrapers.common.http import ConnectionPool as HttpConnectionPool
+from fn_scrapers.common.http import ResponseCache as HttpResponseCache
+from fn_scrapers.common.http import RetryEngine as HttpRetryEngine
 
 BlockingRetryingPublisherManager = injector.Key("BlockingRetryingPublisherManager")
 
@@ -123,19 +129,98 @@ class AppModule(injector.Module):
                 "README.md for more information.")
         return config.app["scrapers"].get(scraper_name, {})
 
-    @injector.provides(HttpSession)
-    @per_request
-    @injector.inject(rate_limiter_client=BlockingRateLimiterClient)
-    def _provide_http_session(self, rate_limiter_client):
-        return http.Session(rl_config=rate_limiter_client)
+    # HttpConnectionPool is thread-safe and holds the keep-alive sockets that
+    # we want every request (and every worker thread) to reuse. So, we make it
+    # @per_app scoped.
+    @injector.provides(HttpConnectionPool)
+    @per_app
+    @injector.inject(config=Config)
+    def _provide_http_connection_pool(self, config):
+        return http.ConnectionPool(**config.app["global"].get("http_pool", {}))
 
-    @injector.provides(FilesSession)
+    # The response cache is opt-in: it is None unless app.global.http_cache
+    # is configured.
+    @injector.provides(HttpResponseCache)
+    @per_app
+    @injector.inject(config=Config)
+    def _provide_http_response_cache(self, config):
+        cache_config = config.app["global"].get("http_cache")
+        if not cache_config:
+            return None
+        return http.ResponseCache(**cache_config)
+
+    # The retry engine is opt-in: it is None (requests use their retry
+    # policy) unless app.global.http_retry is configured. It tracks the
+    # health of every host the app talks to, so it must be shared by all
+    # requests (and threads): @per_app scoped.
+    @injector.provides(HttpRetryEngine)
+    @per_app
+    @injector.inject(config=Config)
+    def _provide_http_retry_engine(self, config):
+        retry_config = config.app["global"].get("http_retry")
+        if not retry_config:
+            return None
+        return http.RetryEngine(**retry_config)
+
+    @injector.provides(HttpSession)
     @per_request
+    @injector.inject(rate_limiter_client=BlockingRateLimiterClient,
+                     connection_pool=HttpConnectionPool,
+                     response_cache=HttpResponseCache,
+                     retry_engine=HttpRetryEngine)
+    def _provide_http_session(self, rate_limiter_client, connection_pool,
+                              response_cache, retry_engine):
+        return http.Session(rl_config=rate_limiter_client,
+                            connection_pool=connection_pool,
+                            response_cache=response_cache,
+                            retry_engine=retry_engine)
+
+    # The extraction cache is opt-in: it is None unless
+    # app.global.extraction_cache is configured.
+    @injector.provides(FilesExtractionCache)
+    @per_app
+    @injector.inject(config=Config)
+    def _provide_files_extraction_cache(self, config):
+        cache_config = config.app["global"].get("extraction_cache")
+        if not cache_config:
+            return None
+        return files.ExtractionCache(**cache_config)
+
+    # The download index is shared by all requests of the app; it is kept in
+    # memory (for the run) unless app.global.download_index.path is set.
+    @injector.provides(FilesDownloadIndex)
+    @per_app
     @injector.inject(config=Config)
-    def _provide_files_session(self, config):
+    def _provide_files_download_index(self, config):
+        return files.DownloadIndex(
+            **config.app["global"].get("download_index", {}))
+
+    # FilesConnectionPool is thread-safe and connects lazily, and we don't want
+    # every request to set up S3 and document service connections again. So,
+    # we make it @per_app scoped. Document service calls share the http
+    # connection pool's keep-alive sockets.
+    @injector.provides(FilesConnectionPool)
+    @per_app
+    @injector.inject(config=Config, http_pool=HttpConnectionPool,
+                     retry_engine=HttpRetryEngine)
+    def _provide_files_connection_pool(self, config, http_pool, retry_engine):
         aws_config = config.app['scraperutils']['aws'].copy()
         aws_config.update(config.app['scraperutils']['file_upload_bucket'])
-        return files.Session(aws_config, config.app["global"]["doc_service_url"])
+        return files.ConnectionPool(
+            aws_config, config.app["global"]["doc_service_url"],
+            doc_session=http_pool.create_requests_session(),
+            retry_engine=retry_engine)
+
+    @injector.provides(FilesSession)
+    @per_request
+    @injector.inject(connection_pool=FilesConnectionPool,
+                     extraction_cache=FilesExtractionCache,
+                     download_index=FilesDownloadIndex)
+    def _provide_files_session(self, connection_pool, extraction_cache,
+                               download_index):
+        return files.Session(connection_pool=connection_pool,
+                             extraction_cache=extraction_cache,
+                             download_index=download_index)
 
     @injector.provides(LocalityMetadataDataAccess.Client)
     @per_request
@@ -0,0 +1,185 @@
+'''
+common.cpu
+
+Process pool for CPU-heavy parsing. Threads of a --concurrency scraper share
+one GIL, so lxml/html5lib parsing, large entity list flattening and regex
+heavy parsing done on scraper threads barely use more than one core. The
+CpuExecutor runs such work in worker processes instead:
+
+    links = cpu.run(cpu.xpath_task, content, {'links': '//a/@href'},
+                    base_url=url)['links']
+    votes = cpu.run(cpu.findall_task, self.sheet_vote_pattern.pattern, text)
+
+Tasks and their arguments and results are pickled, so tasks must be module
+level functions, and should return compact plain data (strings, lists,
+dictionaries) - lxml trees cannot be sent between processes. With
+max_workers=0 tasks run inline in the calling thread.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import multiprocessing
+import re
+import threading
+from urlparse import urljoin
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from lxml import html
+from lxml.html import html5parser
+
+logger = logging.getLogger(__name__)
+
+
+class CpuExecutor(object):
+    '''
+    Lazily started process pool shared by all threads of a scraper.
+    '''
+    instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_workers=None):
+        '''
+        Constructor.
+
+        Args:
+            max_workers: Optional number of worker processes. Defaults to the
+                number of CPUs; 0 runs tasks inline.
+        '''
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        self.max_workers = max_workers
+        self.is_closed = False
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        '''
+        Returns the shared executor instance, creating it if needed.
+        '''
+        with cls._instance_lock:
+            if cls.instance is None or cls.instance.is_closed:
+                cls.instance = cls()
+            return cls.instance
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Schedule func(*args, **kwargs) in a worker process.
+
+        Returns:
+            concurrent.futures.Future
+        '''
+        if self.is_closed:
+            raise RuntimeError("CpuExecutor is closed.")
+        if not self.max_workers:
+            future = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as exc: # pylint: disable=broad-except
+                future.set_exception(exc)
+            return future
+        with self._lock:
+            if self._executor is None:
+                logger.debug("Starting %s cpu worker processes", self.max_workers)
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            executor = self._executor
+        return executor.submit(func, *args, **kwargs)
+
+    def map(self, func, *iterables):
+        '''
+        Returns:
+            list of func results for each item of iterables, in order.
+        '''
+        futures = [self.submit(func, *args) for args in zip(*iterables)]
+        return [future.result() for future in futures]
+
+    def close(self, wait=True):
+        '''
+        Shut down the worker processes.
+
+        Args:
+            wait: Optional, wait for running tasks. Default True.
+        '''
+        self.is_closed = True
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+
+
+def submit(func, *args, **kwargs):
+    '''
+    Schedule func(*args, **kwargs) on the shared CpuExecutor.
+
+    Returns:
+        concurrent.futures.Future
+    '''
+    return CpuExecutor.get().submit(func, *args, **kwargs)
+
+
+def run(func, *args, **kwargs):
+    '''
+    Run func(*args, **kwargs) on the shared CpuExecutor and wait for the
+    result. The calling thread releases the GIL while waiting.
+    '''
+    return submit(func, *args, **kwargs).result()
+
+
+def xpath_task(content, xpaths, base_url=None, html5=False, rep_nbsp=False):
+    '''
+    Parse html and evaluate xpaths - for use with run/submit.
+
+    Args:
+        content: html string.
+        xpaths: dictionary of name to xpath expression. Expressions should
+            select strings (text(), @attributes, string(...)) - elements are
+            converted to their text content.
+        base_url: Optional, makes links absolute against base_url (only
+            a/@href with html5).
+        html5: Optional, use the html5lib parser instead of lxml's.
+        rep_nbsp: Optional, replaces nbsp entities with spaces if True.
+    Returns:
+        dictionary of name to list of strings (or a single value for
+        expressions returning a number, string or boolean).
+    '''
+    if rep_nbsp:
+        content = content.replace("&nbsp;", " ")
+    if html5:
+        parser = html5parser.HTMLParser(namespaceHTMLElements=False)
+        doc = html5parser.document_fromstring(content, parser=parser)
+        if base_url:
+            for link in doc.xpath('//a[@href]'):
+                link.set('href', urljoin(base_url, link.get('href')))
+    else:
+        doc = html.fromstring(content, base_url=base_url)
+        if base_url:
+            doc.make_links_absolute(base_url)
+    results = {}
+    for name, xpath in xpaths.items():
+        value = doc.xpath(xpath)
+        if isinstance(value, list):
+            # plain unicode - lxml's "smart" strings reference the tree
+            value = [unicode(item) if isinstance(item, basestring) else
+                     u''.join(item.itertext()) for item in value]
+        results[name] = value
+    return results
+
+
+def findall_task(pattern, text, flags=0):
+    '''
+    re.findall in a worker process - for use with run/submit.
+
+    Args:
+        pattern: regular expression string.
+        text: string to search.
+        flags: Optional re flags.
+    Returns:
+        list of matches, see re.findall.
+    '''
+    return re.compile(pattern, flags).findall(text)
@@ -21,8 +21,11 @@ from fn_ratelimiter_client.blocking_util import (
 from fn_scrapers.common import http
 
 from .exceptions import FilesException, RemoteExtractionException, S3Exception
-from .file import File
-from .session import Session
+from .download_index import DownloadIndex
+from .extraction_cache import ExtractionCache
+from .file import File, StreamDigest
+from .pipeline import Pipeline, PipelineException
+from .session import ConnectionPool, Session
 from .extraction import Extractors as extractors
 
 
@@ -35,7 +38,8 @@ _S3_URL_PATTERN = re.compile(
 )
 
 def request_file_with_cache(url, request_args=None, skip_checks=None,
-                            file_obj=None, session=None, headers_decoding=None):
+                            file_obj=None, session=None, headers_decoding=None,
+                            ldi=None):
     '''
     Returns a files.File object, either downloaded from the internet or
     retrieved from S3. Implements automatic HTTP cacheing.
@@ -47,6 +51,9 @@ def request_file_with_cache(url, request_args=None, skip_checks=None,
         file_obj: Optional file object, temporary file created if none given.
         session: Optional HttpSession instance
         headers_decoding: The encoding used for decoding the response headers
+        ldi: Optional last-download info for url, e.g. from
+            session.docserv_client.last_download_info_many. Requested from
+            document service if not provided.
     Returns:
         files.File object.
     Raises:
@@ -60,7 +67,13 @@ def request_file_with_cache(url, request_args=None, skip_checks=None,
     request_args = request_args or {}
     file_obj = file_obj or _get_temp_file()
 
-    ldi = session.docserv_client.last_download_info(url)
+    index = session.download_index
+    if ldi is None and index is not None:
+        ldi = index.get(url)
+    if ldi is None:
+        ldi = session.docserv_client.last_download_info(url)
+        if index is not None:
+            index.record_ldi(url, ldi)
 
     request_args['headers'] = request_args.get('headers', {})
     headers = request_args['headers']
@@ -82,6 +95,8 @@ def request_file_with_cache(url, request_args=None, skip_checks=None,
         fil.ldi = ldi
         if fil.source.status_code != 304:
             return fil
+        if index is not None:
+            index.touch(url)
 
     if not ldi.s3Url:
         ValueError('Did not receive last-download-info: ' + url)
@@ -108,12 +123,18 @@ def request_file(url, file_obj=None, session=None, headers_decoding=None, **kwar
     '''
     session = session or Session.get()
     file_obj = file_obj or _get_temp_file()
+    digest = StreamDigest()
     file_obj, res = http.request_file(
-        url, file_obj=file_obj, http_session=session.http_session, **kwargs)
+        url, file_obj=file_obj, http_session=session.http_session,
+        hasher=digest, **kwargs)
 
     logger.debug("Received HTTP %s Response", res.status_code)
     res.raise_for_status()
-    return File(url, file_obj, source=res, headers_decoding=headers_decoding)
+    if res.status_code == 304:
+        # nothing was downloaded, the cached copy is used instead
+        return File(url, file_obj, source=res, headers_decoding=headers_decoding)
+    return File(url, file_obj, source=res, headers_decoding=headers_decoding,
+                hashvalue=digest.hexdigest(), head=digest.head)
 
 
 def download_from_s3(endpoint, file_obj=None, session=None):
@@ -169,7 +190,8 @@ def _get_temp_file(*args, **kwargs):
 
 def download_and_register(url, request_args=None, s3_args=None, skip_checks=None,
                           mimetype=None, encoding=None, filename=None, name=None,
-                          serve_from_s3=None, session=None, headers_decoding=None):
+                          serve_from_s3=None, session=None, headers_decoding=None,
+                          ldi=None):
     '''
     Download a file, upload it to s3, and register it with document service.
 
@@ -188,12 +210,13 @@ def download_and_register(url, request_args=None, s3_args=None, skip_checks=None
             for everything else.
         session: Optional HttpSession instance.
         headers_decoding: The encoding used for decoding the response headers
+        ldi: Optional prefetched last-download info for url.
     Returns:
         files.File object
     '''
     fil = request_file_with_cache(
             url, request_args, skip_checks=skip_checks, session=session,
-            headers_decoding=headers_decoding)
+            headers_decoding=headers_decoding, ldi=ldi)
     if mimetype:
         fil.mimetype = mimetype
     if encoding:
@@ -210,7 +233,8 @@ def download_and_register(url, request_args=None, s3_args=None, skip_checks=None
 def register_download_and_documents(
         url, extractor, serve_from_s3=None, skip_checks=False, mimetype=None,
         encoding=None, filename=None, name=None, parser=None, request_args=None,
-        s3_args=None, extract_args=None, session=None, headers_decoding=None):
+        s3_args=None, extract_args=None, session=None, headers_decoding=None,
+        ldi=None):
     '''
     The ultimate shortcut function: download a file, upload it to s3, register
     it with document service, extract content, and register documents.
@@ -233,6 +257,7 @@ def register_download_and_documents(
         extract_args: Specific optional arguments for the extractor.
         session: Optional files.Session instance.
         headers_decoding: The encoding used for decoding the response headers
+        ldi: Optional prefetched last-download info for url.
     Returns:
         Three-tuple: (files.File object, list of ScraperDocument objects,
             list of document ids) where a document id can be an integer or None.
@@ -241,12 +266,34 @@ def register_download_and_documents(
     fil = download_and_register(
         url, request_args=request_args, s3_args=s3_args, skip_checks=skip_checks,
         mimetype=mimetype, encoding=encoding, filename=filename, name=name,
-        serve_from_s3=serve_from_s3, session=session, headers_decoding=headers_decoding)
+        serve_from_s3=serve_from_s3, session=session, headers_decoding=headers_decoding,
+        ldi=ldi)
     fil.extract_and_register_documents(
         extractor, extract_args=extract_args, parser=parser, session=session)
     return fil
 
 
+def register_downloads_and_documents(requests, extractor=None, session=None,
+                                     **kwargs):
+    '''
+    Pipelined register_download_and_documents for many urls: downloads,
+    uploads, registrations and extractions of different files run
+    concurrently.
+
+    Args:
+        requests: Iterable of urls or dictionaries of
+            register_download_and_documents arguments.
+        extractor: Optional extractor for requests that do not specify one.
+        session: Optional files.Session instance.
+        kwargs: Optional files.Pipeline arguments.
+    Yields:
+        files.File objects in completion order.
+    '''
+    with Pipeline(extractor=extractor, session=session, **kwargs) as pipeline:
+        for fil in pipeline.run(requests):
+            yield fil
+
+
 def close():
     '''
     Closes the current session.
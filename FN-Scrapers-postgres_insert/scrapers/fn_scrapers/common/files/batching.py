@@ -0,0 +1,141 @@
+'''
+common.files.batching
+
+Client side request batching. A BatchQueue collects items submitted from any
+thread and hands them to a handler function in batches, flushing once
+max_size items are pending or the oldest item has waited max_wait seconds.
+Each submit() returns a concurrent.futures.Future resolved with that item's
+result:
+
+    queue = BatchQueue(client.register_documents_many, max_size=50)
+    future = queue.submit((download_id, documents))
+    ...
+    queue.close() # flushes and waits
+'''
+
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class BatchQueue(object):
+    '''
+    Size/time bounded batching queue.
+    '''
+    def __init__(self, handler, max_size=50, max_wait=1.0, executor=None):
+        '''
+        Constructor.
+
+        Args:
+            handler: Function taking a list of items and returning a list of
+                results in the same order.
+            max_size: Optional number of items that triggers a flush.
+            max_wait: Optional maximum seconds an item waits before a flush.
+            executor: Optional concurrent.futures executor to run batches on.
+                Batches run on the flushing thread if not provided.
+        '''
+        self.handler = handler
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.executor = executor
+        self.is_closed = False
+        self.batches = 0
+        self._pending = []
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._timer = threading.Thread(target=self._run_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, item):
+        '''
+        Queue an item.
+
+        Returns:
+            concurrent.futures.Future resolved with the item's result.
+        '''
+        future = Future()
+        with self._cond:
+            if self.is_closed:
+                raise RuntimeError("BatchQueue is closed.")
+            if not self._pending:
+                self._oldest = time.time()
+                self._cond.notify()
+            self._pending.append((item, future))
+            batch = self._take() if len(self._pending) >= self.max_size else None
+        if batch:
+            self._dispatch(batch)
+        return future
+
+    def flush(self):
+        '''Hand all pending items to the handler.'''
+        with self._cond:
+            batch = self._take()
+        if batch:
+            self._dispatch(batch)
+
+    def _take(self):
+        batch, self._pending, self._oldest = self._pending, [], None
+        return batch
+
+    def _dispatch(self, batch):
+        self.batches += 1
+        if self.executor is None:
+            self._run_batch(batch)
+        else:
+            self.executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        batch = [(item, future) for item, future in batch
+                 if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        items = [item for item, _ in batch]
+        futures = [future for _, future in batch]
+        try:
+            results = self.handler(items)
+        except Exception as exc: # pylint: disable=broad-except
+            logger.warning("Batch of %s items failed: %s", len(items), exc)
+            for future in futures:
+                future.set_exception(exc)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def _run_timer(self):
+        while True:
+            with self._cond:
+                while not self.is_closed and not self._pending:
+                    self._cond.wait()
+                if self.is_closed:
+                    return
+                remaining = self._oldest + self.max_wait - time.time()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                batch = self._take()
+            self._dispatch(batch)
+
+    def close(self):
+        '''Flush pending items and stop the timer thread.'''
+        with self._cond:
+            # no submit can get in between: later ones raise
+            self.is_closed = True
+            batch = self._take()
+            self._cond.notify()
+        if batch:
+            self._dispatch(batch)
+        self._timer.join()
@@ -0,0 +1,80 @@
+'''
+common.files.dedup
+
+Content-addressed upload deduplication. S3 keys of the form
+"file-by-sha384/<hash>" always hold the same bytes, so once a key is known to
+exist it never needs to be uploaded again. KnownKeys remembers the most
+recently seen keys so repeated uploads of the same content (the same PDF
+linked from several bills, re-downloads after a cache miss) are skipped
+without a request; unknown keys are checked with a single HEAD request:
+
+    if not session.known_keys.exists(session.aws.bucket, endpoint):
+        ... upload ...
+        session.known_keys.add(endpoint)
+
+Only positive results are remembered - a false "exists" would lose a file,
+which is why an exact LRU is used rather than a probabilistic filter.
+'''
+
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class KnownKeys(object):
+    '''
+    Thread-safe LRU set of S3 keys known to exist.
+    '''
+    def __init__(self, max_size=100000):
+        '''
+        Constructor.
+
+        Args:
+            max_size: Optional number of keys to remember.
+        '''
+        self.max_size = max_size
+        self.hits = 0
+        self.lookups = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._keys:
+                return False
+            # move to the most recently used end
+            self._keys[key] = self._keys.pop(key)
+            return True
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        '''Remember that key exists.'''
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = True
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def exists(self, bucket, key):
+        '''
+        Check whether key exists in bucket, issuing a HEAD request only if the
+        key is not already known.
+
+        Args:
+            bucket: boto Bucket object.
+            key: S3 key name.
+        Returns:
+            True if the key exists.
+        '''
+        if key in self:
+            self.hits += 1
+            return True
+        self.lookups += 1
+        if bucket.get_key(key) is None:
+            return False
+        self.add(key)
+        return True
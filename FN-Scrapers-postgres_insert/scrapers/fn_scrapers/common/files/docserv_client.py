@@ -1,5 +1,8 @@
 '''Document Service Client object. '''
 
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from thrift.protocol import TBinaryProtocol
 
@@ -8,33 +11,116 @@ from fn_ratelimiter_client.blocking_util import Retry500RequestsRetryPolicy
 from fn_ratelimiter_client.blocking_util import standard_retry
 from fn_service.util.blocking_client import RequestsHttpTransport
 
+from fn_scrapers.common.http import get_host
+
+from .batching import BatchQueue
+
 class DocServiceClient(object):
-    '''Document service client - shamelessly copied from scraperutils'''
-    def __init__(self, host, timeout, doc_session=None):
+    '''Document service client - shamelessly copied from scraperutils
+
+    The document service has no batch RPCs, so the bulk methods
+    (last_download_info_many, register_downloads, register_documents_many)
+    pipeline single calls over max_workers connections, each thread using its
+    own thrift client. register_documents_async queues registrations and
+    sends them in batches.
+
+    thrift clients are not thread-safe, so every thread calling the client
+    gets its own, sharing doc_session's connection pool.
+
+    Calls are retried with retry_policy, or through retry_engine (an
+    http.RetryEngine) if given, which fails fast while document service is
+    down.
+    '''
+    def __init__(self, host, timeout, doc_session=None, max_workers=8,
+                 batch_size=50, batch_wait=1.0, retry_engine=None):
         # Set up thrift clients
         self.host = host
+        self.timeout = timeout
         if doc_session is None:
             doc_session = requests.Session()
         self.session = doc_session
-        doc_transport = RequestsHttpTransport(doc_session, host, timeout=timeout)
-        doc_protocol = TBinaryProtocol.TBinaryProtocol(doc_transport)
-        self.doc_service_client = DocumentService.Client(doc_protocol)
+        self._local = threading.local()
+        self.doc_service_client = self._local.client = \
+            self._create_thrift_client()
         self.retry_policy = Retry500RequestsRetryPolicy(max_retry_time=1800)
+        self.retry_engine = retry_engine
+
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._executor = None
+        self._document_queue = None
+        self._lock = threading.Lock()
+
+    def _create_thrift_client(self):
+        doc_transport = RequestsHttpTransport(
+            self.session, self.host, timeout=self.timeout)
+        doc_protocol = TBinaryProtocol.TBinaryProtocol(doc_transport)
+        return DocumentService.Client(doc_protocol)
+
+    def _thread_client(self):
+        '''Returns the calling thread's thrift client.'''
+        if not hasattr(self._local, 'client'):
+            self._local.client = self._create_thrift_client()
+        return self._local.client
+
+    def _retry(self, func):
+        if self.retry_engine is not None:
+            return self.retry_engine.call(get_host(self.host), func)
+        return standard_retry(func, self.retry_policy)
+
+    @property
+    def executor(self):
+        '''Worker pool for the bulk methods, created on first use.'''
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _map(self, func, items):
+        '''Run func(thrift_client, item) for each item on the worker pool.'''
+        def _call(item):
+            client = self._thread_client()
+            return self._retry(lambda: func(client, item))
+        return list(self.executor.map(_call, items))
 
     def last_download_info(self, url):
         '''Retrieve last-download info. '''
         def _try_last_download():
-            return self.doc_service_client.getLastDownload(url)
-        return standard_retry(_try_last_download, self.retry_policy)
+            return self._thread_client().getLastDownload(url)
+        return self._retry(_try_last_download)
+
+    def last_download_info_many(self, urls):
+        '''
+        Retrieve last-download info for many urls.
+
+        Returns:
+            Dictionary of url to last-download info.
+        '''
+        urls = list(urls)
+        return dict(zip(urls, self._map(
+            lambda client, url: client.getLastDownload(url), urls)))
 
     def register_download(self, file_hash, s3_url, serve_from_s3, original_url,
                           external_filename, mime_type, encoding, return_headers):
         '''Register a file download. '''
         def _try_register_download():
-            return self.doc_service_client.registerDownload(
+            return self._thread_client().registerDownload(
                 file_hash, s3_url, serve_from_s3, original_url,
                 external_filename, mime_type, encoding, return_headers)
-        return standard_retry(_try_register_download, self.retry_policy)
+        return self._retry(_try_register_download)
+
+    def register_downloads(self, downloads):
+        '''
+        Register many file downloads.
+
+        Args:
+            downloads: Iterable of register_download argument tuples.
+        Returns:
+            List of download ids, in the same order as downloads.
+        '''
+        return self._map(
+            lambda client, args: client.registerDownload(*args), downloads)
 
     def extract_content(self, download_id, extraction_type, **kwargs):
         '''Request a document extraction from the doc service. 
@@ -60,18 +146,55 @@ class DocServiceClient(object):
 
         def _try_extract_content():
             extraction_params = ttypes.ExtractionParams(**extract_params)
-            extracted_content = self.doc_service_client.extractContent(
+            extracted_content = self._thread_client().extractContent(
                 download_id, extraction_type, extraction_params)
             return extracted_content.entities
-        return standard_retry(_try_extract_content, self.retry_policy)
+        return self._retry(_try_extract_content)
 
     def register_documents(self, download_id, doc_service_documents):
         '''Register a document. '''
         def _try_register_documents():
-            return self.doc_service_client.registerDocuments(
+            return self._thread_client().registerDocuments(
                 download_id, doc_service_documents)
-        return standard_retry(_try_register_documents, self.retry_policy)
+        return self._retry(_try_register_documents)
+
+    def register_documents_many(self, registrations):
+        '''
+        Register documents for many downloads.
+
+        Args:
+            registrations: Iterable of (download_id, documents) tuples.
+        Returns:
+            List of document id lists, in the same order as registrations.
+        '''
+        return self._map(
+            lambda client, args: client.registerDocuments(*args), registrations)
+
+    def register_documents_async(self, download_id, doc_service_documents):
+        '''
+        Queue a document registration. Queued registrations are sent once
+        batch_size are pending or the oldest has waited batch_wait seconds.
+
+        Returns:
+            concurrent.futures.Future resolved with the document ids.
+        '''
+        with self._lock:
+            if self._document_queue is None:
+                self._document_queue = BatchQueue(
+                    self.register_documents_many, max_size=self.batch_size,
+                    max_wait=self.batch_wait)
+            queue = self._document_queue
+        return queue.submit((download_id, doc_service_documents))
+
+    def flush(self):
+        '''Send all queued document registrations.'''
+        if self._document_queue is not None:
+            self._document_queue.flush()
 
     def close(self):
         '''Close the current connection.'''
+        if self._document_queue is not None:
+            self._document_queue.close()
+        if self._executor is not None:
+            self._executor.shutdown()
         self.session.close()
@@ -0,0 +1,143 @@
+'''
+common.files.download_index
+
+Local, TTL-bounded index of url to last download information (headers
+including ETag/Last-Modified, file hash, download id, s3 url).
+request_file_with_cache answers last-download lookups for recently verified
+urls from the index instead of calling document service:
+
+    session = files.Session(aws, host, download_index=files.DownloadIndex(
+        '/tmp/fnscrapers-download-index.db', ttl=6*3600))
+
+Entries are written when document service returns last download info, when a
+download is registered, and refreshed when the source answers a conditional
+request with 304. Entries older than ttl are ignored (and purged), so stale
+urls fall back to document service. Without a path the index is kept in
+memory and only lasts for the run.
+'''
+
+from datetime import datetime
+import json
+import sqlite3
+import threading
+import time
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS downloads (
+    url TEXT PRIMARY KEY,
+    download_id INTEGER NOT NULL,
+    s3_url TEXT NOT NULL,
+    file_hash TEXT,
+    headers TEXT NOT NULL,
+    downloaded_at TEXT,
+    verified_at REAL NOT NULL
+)
+'''
+
+
+class IndexedDownload(object):
+    '''
+    Last download information from the index. Has the same attributes as the
+    document service last-download info used by request_file_with_cache.
+    '''
+    # pylint: disable=invalid-name
+    def __init__(self, id, s3Url, headers, datetime=None, hash=None):
+        self.id = id
+        self.s3Url = s3Url
+        self.headers = headers
+        self.datetime = datetime
+        self.hash = hash
+        self.from_index = True
+
+
+class DownloadIndex(object):
+    '''
+    sqlite backed url index, safe to share between threads.
+    '''
+    def __init__(self, path=None, ttl=6*3600):
+        '''
+        Constructor.
+
+        Args:
+            path: Optional sqlite database file (created if missing). In
+                memory if not provided.
+            ttl: Optional number of seconds an entry is trusted after it was
+                last verified.
+        '''
+        self.path = path or ':memory:'
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(_SCHEMA)
+        self.purge()
+
+    def get(self, url):
+        '''
+        Returns:
+            IndexedDownload if url was verified within ttl, otherwise None.
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT download_id, s3_url, headers, downloaded_at, file_hash '
+                'FROM downloads WHERE url = ? AND verified_at >= ?',
+                (url, time.time() - self.ttl)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        download_id, s3_url, headers, downloaded_at, file_hash = row
+        return IndexedDownload(download_id, s3_url, json.loads(headers),
+                               downloaded_at, file_hash)
+
+    def record(self, url, download_id, s3_url, headers=None, file_hash=None,
+               downloaded_at=None):
+        '''
+        Add or replace the entry for url, marking it verified now.
+
+        Args:
+            url: Source url.
+            download_id: Document service download id.
+            s3_url: S3 url of the content.
+            headers: Optional source response headers.
+            file_hash: Optional sha384 of the content.
+            downloaded_at: Optional ISO formatted download time, now (UTC) if
+                not provided.
+        '''
+        if not download_id or not s3_url:
+            return
+        downloaded_at = downloaded_at or datetime.utcnow().isoformat()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, download_id, s3_url, file_hash,
+                 json.dumps(dict(headers or {})), downloaded_at, time.time()))
+            self._conn.commit()
+
+    def record_ldi(self, url, ldi):
+        '''Add or replace the entry for url from last-download info.'''
+        self.record(url, ldi.id, ldi.s3Url, ldi.headers,
+                    file_hash=getattr(ldi, 'hash', None),
+                    downloaded_at=ldi.datetime)
+
+    def touch(self, url):
+        '''Mark the entry for url as verified now.'''
+        with self._lock:
+            self._conn.execute(
+                'UPDATE downloads SET verified_at = ? WHERE url = ?',
+                (time.time(), url))
+            self._conn.commit()
+
+    def purge(self):
+        '''Remove expired entries.'''
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM downloads WHERE verified_at < ?',
+                (time.time() - self.ttl,))
+            self._conn.commit()
+
+    def close(self):
+        '''Close the database.'''
+        with self._lock:
+            self._conn.close()
@@ -2,7 +2,16 @@
 Extraction specific interfaces - not intended for scraper use directly.
 '''
 
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+from tempfile import NamedTemporaryFile
+import threading
+
 from lxml import etree, html
+import subprocess32 as subprocess
 from thrift.Thrift import TApplicationException
 
 from fn_document_service.blocking import ttypes
@@ -10,15 +19,34 @@ from fn_document_service.blocking import ttypes
 from .session import Session
 from .exceptions import ExtractionException, RemoteExtractionException
 
+logger = logging.getLogger(__name__)
+
+# Limits the number of local pdftotext processes running at once.
+LOCAL_PDF_PROCESSES = threading.BoundedSemaphore(multiprocessing.cpu_count())
+
 class Extractor(object):
     '''
     Describes an extractor.
     '''
-    def __init__(self, name, is_remote=True, extract=None, parse=None):
+    def __init__(self, name, is_remote=True, extract=None, parse=None,
+                 local=None, cacheable=None):
+        '''
+        Args:
+            name: Extraction type name.
+            is_remote: Whether the extraction is done by document service.
+            extract: Optional extract function, remote_extract by default.
+            parse: Optional parse function, remote_parse by default.
+            local: Optional name of an equivalent local extractor, used
+                instead when the session sets prefer_local_extraction.
+            cacheable: Optional, whether results may be stored in the
+                session's extraction cache. Defaults to is_remote.
+        '''
         self.name = name
         self.is_remote = is_remote
         self.extract = extract if extract else remote_extract
         self.parse = parse if parse else remote_parse
+        self.local = local
+        self.cacheable = bool(is_remote) if cacheable is None else cacheable
 
 def remote_extract(name, fil, **kwargs):
     """
@@ -35,43 +63,156 @@ def remote_extract(name, fil, **kwargs):
     except (TApplicationException, ttypes.BadFile) as exc:
         raise RemoteExtractionException(str(exc), exception=exc)
 
-def remote_parse(entities):
+def iter_entity_lines(entities):
     '''
-    Remote extraction entities list to ScraperDocument list.
+    Lazily walks a remote extraction entities list.
+
+    Yields:
+        (page number, list of text fragments) tuples, one per text or header
+        entity and one per table row. The fragments of a line are meant to be
+        concatenated. Page number is None if the entity has none.
     '''
-    content = []
     for entity in entities:
         if entity.textEntity:
-            entity_content = []
-            for text_container in entity.textEntity.textContainers:
-                entity_content.append(text_container.text)
-            content.append(u''.join(entity_content))
+            yield (getattr(entity.textEntity, 'pageNum', None),
+                   [container.text for container in entity.textEntity.textContainers])
         elif entity.headerEntity:
-            content.append(entity.headerEntity.text)
+            yield (getattr(entity.headerEntity, 'pageNum', None),
+                   [entity.headerEntity.text])
         elif entity.tableEntity:
+            page_num = getattr(entity.tableEntity, 'pageNum', None)
             for row in entity.tableEntity.rows:
-                entity_content = []
-                for cell in row.cells:
-                    for text_container in cell.textContainers:
-                        entity_content.append(text_container.text)
-                content.append(u''.join(entity_content))
-    content.append(u'') # previous version had a trailing newline
-    return [ScraperDocument(u'\n'.join(content))]
-
-def html_extract(name, fil, replace_nbsp=True, encoding='utf-8', **kwargs):
-    """
-    files.File object to lxml html object.
-    """
+                yield page_num, [container.text for cell in row.cells
+                                 for container in cell.textContainers]
+
+def _write_line(buf, fragments):
+    for fragment in fragments:
+        if isinstance(fragment, bytes):
+            fragment = fragment.decode('utf-8')
+        buf.write(fragment)
+    buf.write(u'\n')
+
+def remote_parse(entities):
+    '''
+    Remote extraction entities list to ScraperDocument list.
+    '''
+    # written straight into one buffer rather than joining per-entity lists
+    buf = io.StringIO()
+    for _, fragments in iter_entity_lines(entities):
+        _write_line(buf, fragments)
+    # previous version had a trailing newline - kept by _write_line
+    return [ScraperDocument(buf.getvalue())]
+
+def remote_parse_pages(entities):
+    '''
+    Remote extraction entities list to one ScraperDocument per page, yielded
+    lazily so only one page of text is held at a time. Use as the parser for
+    very large files:
+
+        fil.extract_and_register_documents(
+            files.extractors.text_pdf, parser=remote_parse_pages)
+
+    Yields:
+        ScraperDocument objects with page_num set.
+    '''
+    buf, page = None, None
+    for page_num, fragments in iter_entity_lines(entities):
+        if buf is not None and page_num != page:
+            yield ScraperDocument(buf.getvalue(), page_num=page)
+            buf = None
+        if buf is None:
+            buf, page = io.StringIO(), page_num
+        _write_line(buf, fragments)
+    if buf is not None:
+        yield ScraperDocument(buf.getvalue(), page_num=page)
+
+def _local_path(fil):
+    '''
+    Returns a (path, temporary file) tuple for a File's content on disk. The
+    temporary file is None if file_obj already is a named file.
+    '''
+    name = getattr(fil.file_obj, 'name', None)
+    if isinstance(name, basestring) and os.path.isfile(name):
+        fil.file_obj.flush()
+        return name, None
+    tmp = NamedTemporaryFile(suffix='.pdf')
     fil.file_obj.seek(0)
-    content = fil.file_obj.read().decode(encoding)
-    if replace_nbsp:
-        content = content.replace("&nbsp;", " ")
+    shutil.copyfileobj(fil.file_obj, tmp, 64*1024)
+    tmp.flush()
+    return tmp.name, tmp
+
+def _text_entity(page_num, text):
+    return ttypes.Entity(textEntity=ttypes.TextEntity(
+        pageNum=page_num, textContainers=[ttypes.TextContainer(text=text)]))
+
+def pdftotext_extract(name, fil, layout=True, **kwargs):
+    '''
+    Local text PDF extraction with poppler's pdftotext. Output is streamed
+    from the process and returned as the entity structure of a remote
+    extraction (one text entity per non-empty line, with page numbers), so
+    remote_parse and entity based scraper code work unchanged.
+
+    Raises:
+        ExtractionException: If pdftotext is missing or fails.
+    '''
+    path, tmp = _local_path(fil)
+    commandline = ['pdftotext', '-enc', 'UTF-8']
+    if layout:
+        commandline.append('-layout')
+    commandline.extend([path, '-'])
+    entities = []
+    page_num = 1
+    devnull = open(os.devnull, 'w')
     try:
-        html_content = html.fromstring(content)
-    except etree.XMLSyntaxError as exc:
-        raise ExtractionException(str(exc), fil=fil)
-    html_content.make_links_absolute(fil.url)
-    return html_content
+        with LOCAL_PDF_PROCESSES:
+            try:
+                proc = subprocess.Popen(
+                    commandline, stdout=subprocess.PIPE, stderr=devnull,
+                    close_fds=True)
+            except OSError as exc:
+                raise ExtractionException(
+                    "error running pdftotext, missing executable? [{}]".format(
+                        exc), exception=exc, fil=fil)
+            for line in iter(proc.stdout.readline, b''):
+                pages = line.decode('utf-8', 'replace').split(u'\f')
+                for i, text in enumerate(pages):
+                    if i:
+                        page_num += 1
+                    text = text.rstrip(u'\r\n').replace(u'\xad', u'-')
+                    if text.strip():
+                        entities.append(_text_entity(page_num, text))
+            proc.stdout.close()
+            if proc.wait():
+                raise ExtractionException(
+                    "pdftotext exited with status {}".format(proc.returncode),
+                    fil=fil)
+    finally:
+        devnull.close()
+        if tmp:
+            tmp.close()
+    logger.debug("pdftotext: %s entities from %s pages", len(entities), page_num)
+    return entities
+
+def html_extract(name, fil, replace_nbsp=True, encoding='utf-8', cache=False,
+                 **kwargs):
+    """
+    files.File object to lxml html object. With cache=True (extract_args)
+    the tree is parsed once per File and shared with other cache=True
+    extractions - parsers must not modify it in place.
+    """
+    def _parse():
+        content = fil.content.decode(encoding)
+        if replace_nbsp:
+            content = content.replace("&nbsp;", " ")
+        try:
+            html_content = html.fromstring(content)
+        except etree.XMLSyntaxError as exc:
+            raise ExtractionException(str(exc), fil=fil)
+        html_content.make_links_absolute(fil.url)
+        return html_content
+    if not cache:
+        return _parse()
+    return fil.memoize_parse((name, replace_nbsp, encoding), _parse)
 
 def html_parse(lxml_page):
     '''
@@ -81,10 +222,10 @@ def html_parse(lxml_page):
 
 def text_extract(name, fil, encoding='utf-8', **kwargs):
     """
-    files.File object to plain-text content.
+    files.File object to plain-text content (decoded once per File).
     """
-    fil.file_obj.seek(0)
-    return fil.file_obj.read().decode(encoding)
+    return fil.memoize_parse(
+        (name, encoding), lambda: fil.content.decode(encoding))
 
 def text_parse(content):
     '''
@@ -92,17 +233,21 @@ def text_parse(content):
     '''
     return [ScraperDocument(content)]
 
-def xml_extract(name, fil, encoding='utf-8', **kwargs):
+def xml_extract(name, fil, encoding='utf-8', cache=False, **kwargs):
     """
-    files.File object to lxml Element.
+    files.File object to lxml Element. With cache=True (extract_args) the
+    tree is parsed once per File and shared with other cache=True
+    extractions - parsers must not modify it in place.
     """
-    fil.file_obj.seek(0)
-    content = fil.file_obj.read().decode(encoding)
-    try:
-        element = etree.fromstring(content, base_url=fil.url)
-    except etree.XMLSyntaxError as exc:
-        raise ExtractionException(str(exc), fil=fil)
-    return element
+    def _parse():
+        content = fil.content.decode(encoding)
+        try:
+            return etree.fromstring(content, base_url=fil.url)
+        except etree.XMLSyntaxError as exc:
+            raise ExtractionException(str(exc), fil=fil)
+    if not cache:
+        return _parse()
+    return fil.memoize_parse((name, encoding), _parse)
 
 def xml_parse(element):
     '''
@@ -117,9 +262,11 @@ class Extractors(object):
     html = Extractor("html", 0, html_extract, html_parse)
     xml = Extractor("xml", 0, xml_extract, xml_parse)
     text = Extractor("text", 0, text_extract, text_parse)
+    local_text_pdf = Extractor("local_text_pdf", 0, pdftotext_extract,
+                               cacheable=True)
     image_pdf = Extractor("image_pdf")
-    text_pdf = Extractor("text_pdf")
-    extractor_pdftotext = Extractor("extractor_pdftotext")
+    text_pdf = Extractor("text_pdf", local="local_text_pdf")
+    extractor_pdftotext = Extractor("extractor_pdftotext", local="local_text_pdf")
     extractor_pdftoxml = Extractor("extractor_pdftoxml")
     tesseract = Extractor("extractor_tesseract")
     msword_doc = Extractor("msword_doc")
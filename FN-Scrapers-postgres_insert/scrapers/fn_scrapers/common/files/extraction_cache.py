@@ -0,0 +1,112 @@
+'''
+common.files.extraction_cache
+
+Opt-in, size-bounded on-disk cache of extraction results. Extraction output
+only depends on the file content, the extractor and its parameters, so
+results are keyed by (sha384, extractor name, extraction parameters) and the
+same PDF is not sent to document service again on the next scheduled run or
+for the next bill linking it:
+
+    files.Session.get().extraction_cache = files.ExtractionCache(
+        '/var/cache/fnscrapers/extraction-cache.db', max_size=1024*1024*1024)
+
+File.extract consults the cache for cacheable extractors (remote extractors
+and local_text_pdf) - results of the html/xml/text extractors are lxml
+objects or strings that are cheap to recreate. Entries are evicted least
+recently used first once the stored results exceed max_size.
+
+Results are pickled, so loading them can run arbitrary code: the database
+file must be owned by and only writable by the user running the scrapers
+(keep it out of shared directories like /tmp).
+'''
+
+import cPickle as pickle
+import hashlib
+import json
+import logging
+import sqlite3
+import zlib
+
+from fn_scrapers.common.sqlite_cache import CacheStats, LRUStore
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = (
+    ('extractor', 'TEXT NOT NULL'),
+    ('result', 'BLOB NOT NULL'),
+)
+
+
+class ExtractionCache(object):
+    '''
+    sqlite backed LRU extraction result cache, safe to share between threads.
+    '''
+    def __init__(self, path, max_size=512*1024*1024):
+        '''
+        Constructor.
+
+        Args:
+            path: sqlite database file (created if missing), owned by and
+                only writable by the current user.
+            max_size: Optional maximum total size of stored (compressed)
+                results in bytes.
+        Raises:
+            ValueError: If somebody else could write to path.
+        '''
+        self.path = path
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self._store = LRUStore(path, 'extractions', _COLUMNS, max_size,
+                               stats=self.stats, private=True)
+
+    @staticmethod
+    def key(file_hash, extractor_name, params=None):
+        '''
+        Returns:
+            cache key for an extraction.
+        '''
+        hasher = hashlib.sha1()
+        for part in (file_hash, extractor_name,
+                     json.dumps(params or {}, sort_keys=True, default=str)):
+            hasher.update(part.encode('utf-8') if isinstance(part, unicode) else part)
+            hasher.update('\0')
+        return hasher.hexdigest()
+
+    def get(self, key):
+        '''
+        Returns:
+            Two-tuple (found, result).
+        '''
+        row = self._store.get(key, ('result',))
+        if row is None:
+            self.stats.increment('misses')
+            return False, None
+        self.stats.increment('hits')
+        self.stats.increment('bytes_saved', len(row[0]))
+        return True, pickle.loads(zlib.decompress(bytes(row[0])))
+
+    def store(self, key, extractor_name, result):
+        '''
+        Store an extraction result.
+
+        Returns:
+            True if the result was stored.
+        '''
+        try:
+            blob = zlib.compress(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError) as exc:
+            logger.debug("Extraction result not cacheable: %s", exc)
+            return False
+        if len(blob) > self.max_size:
+            return False
+        self._store.put(key, (extractor_name, sqlite3.Binary(blob)), len(blob))
+        self.stats.increment('stores')
+        return True
+
+    def clear(self):
+        '''Remove all entries.'''
+        self._store.clear()
+
+    def close(self):
+        '''Close the database.'''
+        self._store.close()
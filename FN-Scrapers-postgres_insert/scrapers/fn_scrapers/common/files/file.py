@@ -6,14 +6,20 @@ document lifecycle.
 '''
 
 import cgi
+from cStringIO import StringIO
 import hashlib
 import logging
 import mimetypes
+import mmap
 import os
 import re
+import threading
+import time
 from urlparse import urlparse
 
 import boto
+from boto.s3.multipart import MultiPartUpload
+from concurrent.futures import Future, ThreadPoolExecutor
 from rfc6266 import build_header as rfc6266_header
 from requests.structures import CaseInsensitiveDict
 import six
@@ -27,11 +33,11 @@ except ImportError:
 
 
 from fn_document_service.blocking import ttypes
-from fn_scrapers.common import http
+from fn_scrapers.common import cpu, http
 
 from .session import Session
 from .extraction import Extractors as extractors, ScraperDocument
-from .exceptions import RemoteExtractionException
+from .exceptions import ExtractionException, RemoteExtractionException
 
 logger = logging.getLogger(__name__)
 
@@ -45,10 +51,60 @@ MIMETYPE_TO_EXT = [
     (re.compile(r'^.*/json$'), '.json'),
 ]
 
+# Number of leading bytes handed to libmagic for mimetype sniffing.
+SNIFF_SIZE = 1024
+
+# Smallest part size S3 accepts for all but the last part of a multipart upload.
+MIN_PART_SIZE = 5*1024*1024
+
+S3_ACL = 'public-read'
+
+# Documents per document service call when registering documents from a
+# generator (e.g. extraction.remote_parse_pages).
+REGISTER_BATCH_SIZE = 50
+
+
+def _completed_future(func, *args, **kwargs):
+    '''
+    Run func now and return a completed Future holding its result or
+    exception.
+    '''
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as exc: # pylint: disable=broad-except
+        future.set_exception(exc)
+    return future
+
+
+class StreamDigest(object):
+    '''
+    Hashes a file and keeps its leading bytes for mimetype sniffing while it
+    is being written, so a freshly downloaded File does not need to be
+    re-read. Pass as the hasher argument of http.request_file.
+    '''
+    def __init__(self):
+        self.hasher = hashlib.sha384()
+        self.head = b''
+
+    def update(self, chunk):
+        '''Add the next chunk of the file.'''
+        self.hasher.update(chunk)
+        if len(self.head) < SNIFF_SIZE:
+            self.head += chunk[:SNIFF_SIZE - len(self.head)]
+
+    def hexdigest(self):
+        '''SHA384 hexdigest of the data seen so far.'''
+        return self.hasher.hexdigest()
+
+
 class File(object):
     '''
     Tracks the state of the doc service request through the pipeline.
     '''
+    # Default for the use_mmap constructor argument.
+    use_mmap = False
+
     def __init__(self, url, file_obj, **kwargs):
         '''
         Constructor.
@@ -67,6 +123,11 @@ class File(object):
             mimetype: Optional, Mimetype to use in S3 headers.
             encoding: Optional, Encoding to use in S3 headers.
             name: Optional, Used to determine filename along with the mimetype.
+            head: Optional, leading bytes of the file, used for mimetype
+                sniffing instead of reading file_obj.
+            use_mmap: Optional, if True the file is memory mapped: buffer,
+                hashing and sniffing read the mapping and content is not
+                kept in memory. Defaults to File.use_mmap.
         '''
         self.url = url
         self.file_obj = file_obj
@@ -77,6 +138,10 @@ class File(object):
         self.source = kwargs.pop('source', None)
 
         self._bytes = None
+        self._head = kwargs.pop('head', None)
+        self._parsed = {}
+        self._mmap = None
+        self.use_mmap = kwargs.pop('use_mmap', self.__class__.use_mmap)
 
         self.hashvalue = kwargs.pop('hashvalue', None)
         self.filename = kwargs.pop('filename', None)
@@ -140,9 +205,53 @@ class File(object):
         '''
         Closes the file object.
         '''
+        self._close_mmap()
         self.file_obj.close()
 
-    def hash(self, chunk_size=1024):
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _get_mmap(self):
+        '''
+        Returns an mmap of file_obj, or None if it cannot be mapped (in
+        memory files, empty files).
+        '''
+        if self._mmap is not None:
+            return self._mmap
+        try:
+            fileno = self.file_obj.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+        self.file_obj.flush()
+        if not os.fstat(fileno).st_size:
+            return None
+        self._mmap = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    @property
+    def buffer(self):
+        '''
+        Read-only view of the file supporting len(), slicing and find(). With
+        use_mmap this is an mmap over file_obj, so no copy of the file is
+        made; otherwise (or if file_obj cannot be mapped) it is content.
+        '''
+        if self.use_mmap:
+            mapped = self._get_mmap()
+            if mapped is not None:
+                return mapped
+        return self.content
+
+    def find(self, sub, start=0, end=None):
+        '''
+        Returns the lowest index of sub in the file, or -1 if not found.
+        '''
+        if end is None:
+            return self.buffer.find(sub, start)
+        return self.buffer.find(sub, start, end)
+
+    def hash(self, chunk_size=64*1024):
         '''
         Perform a SHA384 hash against the file.
 
@@ -155,13 +264,17 @@ class File(object):
             return self.hashvalue
         if not self.file_obj:
             raise ValueError("No file available for hashing.")
-        self.file_obj.seek(0)
         hasher = hashlib.sha384()
-        while True:
-            data = self.file_obj.read(chunk_size)
-            if not data:
-                break
-            hasher.update(data)
+        mapped = self._get_mmap() if self.use_mmap else None
+        if mapped is not None:
+            hasher.update(mapped)
+        else:
+            self.file_obj.seek(0)
+            while True:
+                data = self.file_obj.read(chunk_size)
+                if not data:
+                    break
+                hasher.update(data)
         self.hashvalue = hasher.hexdigest()
         logger.info("File hashed: %s", self.hashvalue)
         return self.hashvalue
@@ -213,8 +326,12 @@ class File(object):
             logger.debug('Determined mimetype from filename: %s', self.mimetype)
         if not self.mimetype and magic:
             # TODO: determine libmagic failure modes (indeterminate files, etc)
-            self.file_obj.seek(0)
-            self.mimetype = magic.from_buffer(self.file_obj.read(1024), mime=True)
+            if self._head is None and self.use_mmap:
+                self._head = self.buffer[:SNIFF_SIZE]
+            elif self._head is None:
+                self.file_obj.seek(0)
+                self._head = self.file_obj.read(SNIFF_SIZE)
+            self.mimetype = magic.from_buffer(self._head, mime=True)
             logger.debug('Determined mimetype from magic: %s', self.mimetype)
         if not self.filename and self.mimetype and self.name:
             # TODO: double check zip false-positives (may be docx/xslx/pptx?)
@@ -277,12 +394,14 @@ class File(object):
         if self.is_cached:
             logger.debug("Response is cached, skipping upload")
             return self.ldi.id
-        self.upload_to_s3(headers=s3_args, session=session)
+        self.upload_to_s3(headers=s3_args, session=session,
+                          skip_existing=session.dedup_uploads)
         return self.create_download(serve_from_s3=serve_from_s3, session=session)
 
 
     def upload_to_s3(self, endpoint=None, headers=None, filename=None,
-                    name=None, mimetype=None, session=None):
+                    name=None, mimetype=None, session=None, multipart=None,
+                    skip_existing=False):
         '''
         Upload a file-like object to s3.
 
@@ -294,12 +413,19 @@ class File(object):
             mimetype: Optional mimetype of source. If used, tries to determine
                 mime-type of file by filename. Not used if 'Content-Disposiiton'
                 header is set or filename is both set and successfully used.
+            multipart: Optional, True/False to force/disable a parallel
+                multipart upload. By default files of at least
+                session.multipart_threshold bytes use multipart.
+            skip_existing: Optional, if True and the default content-addressed
+                endpoint is used, the upload is skipped when the key already
+                exists. The existing object keeps its original headers.
         Returns:
             S3 URL
         '''
         content_type_hdr = 'Content-Type'
         content_dis_hdr = 'Content-Disposition'
         session = session or Session.get()
+        content_addressed = not endpoint
         if not endpoint:
             # TODO: Move "file-by-sha384/" to HttpSession
             endpoint = self.get_s3_endpoint()
@@ -329,15 +455,35 @@ class File(object):
         if content_type_hdr not in headers and mimetype:
             headers[content_type_hdr] = mimetype
         s3_url = self.get_s3_url(session, endpoint)
+        if skip_existing and content_addressed and \
+                session.known_keys.exists(session.aws.bucket, endpoint):
+            logger.info("Content already in s3, skipping upload: %s", s3_url)
+            self.s3_url = s3_url
+            if not self.filename:
+                self.filename = filename
+            return s3_url
         logger.info("Uploading file to s3 \"%s\" (%s) %s", filename, mimetype, s3_url)
         logger.debug("Headers: %s", headers)
 
-        key = boto.s3.key.Key(session.aws.bucket, endpoint)
-        self.file_obj.seek(0)
-        key.set_contents_from_file(self.file_obj, headers=headers)
-        key.set_acl('public-read')
-        key.generate_url(expires_in=0, query_auth=False)
-        logger.debug("Upload complete.")
+        self.file_obj.seek(0, os.SEEK_END)
+        size = self.file_obj.tell()
+        if multipart is None:
+            multipart = size >= session.multipart_threshold
+        start = time.time()
+        if multipart:
+            self._upload_multipart(endpoint, headers, size, session)
+        else:
+            key = boto.s3.key.Key(session.aws.bucket, endpoint)
+            self.file_obj.seek(0)
+            # the canned ACL is sent with the upload - no separate set_acl call
+            key.set_contents_from_file(
+                self.file_obj, headers=headers, policy=S3_ACL)
+        elapsed = max(time.time() - start, 0.001)
+        logger.info("Upload complete: %s bytes in %.2fs (%.2f MB/s)%s",
+                    size, elapsed, size / elapsed / (1024*1024),
+                    " multipart" if multipart else "")
+        if content_addressed:
+            session.known_keys.add(endpoint)
 
         self.s3_url = s3_url
         if not self.filename:
@@ -345,6 +491,49 @@ class File(object):
         return s3_url
 
 
+    def _upload_multipart(self, endpoint, headers, size, session):
+        '''
+        Upload file_obj as a multipart upload, sending parts in parallel.
+        Each worker thread uses its own S3 connection, closed once the upload
+        is done; parts are read from file_obj under a lock.
+        '''
+        part_size = max(session.multipart_part_size, MIN_PART_SIZE)
+        part_count = max((size + part_size - 1) // part_size, 1)
+        bucket = session.aws.bucket
+        upload = bucket.initiate_multipart_upload(
+            endpoint, headers=headers, policy=S3_ACL)
+        read_lock = threading.Lock()
+        local = threading.local()
+        connections = []
+
+        def _upload_part(part_num):
+            with read_lock:
+                self.file_obj.seek((part_num - 1) * part_size)
+                data = self.file_obj.read(part_size)
+            if not hasattr(local, 'upload'):
+                conn = session.aws.create_connection()
+                with read_lock:
+                    connections.append(conn)
+                local.upload = MultiPartUpload(
+                    conn.get_bucket(bucket.name, validate=False))
+                local.upload.key_name = upload.key_name
+                local.upload.id = upload.id
+            local.upload.upload_part_from_file(
+                StringIO(data), part_num, size=len(data))
+
+        logger.debug("Uploading %s parts of %s bytes", part_count, part_size)
+        try:
+            workers = min(session.multipart_workers, part_count)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(_upload_part, range(1, part_count + 1)))
+            upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
+        finally:
+            for conn in connections:
+                conn.close()
+
     def create_download(self, serve_from_s3=None, session=None):
         '''
         A shortcut method to register a download efficiently.
@@ -377,10 +566,14 @@ class File(object):
         )
         self.download_id = download_id
         logger.info("Registered at doc service. Download ID: %s", download_id)
+        if session.download_index is not None:
+            session.download_index.record(
+                self.url, download_id, self.s3_url, self.headers,
+                file_hash=self.hash())
         return download_id
 
     def extract_and_register_documents(self, extractor, extract_args=None,
-                                       parser=None, session=None):
+                                       parser=None, session=None, wait=True):
         '''
         Runs an extractor, parses the output, and returns a list of ScraperDocument
         objects.
@@ -390,17 +583,25 @@ class File(object):
             extract_args: Specific optional arguments for the extractor.
             parser: (Deprecated, Optional) A callback for a custom parser.
             session: Optional HttpSession instance.
+            wait: Optional. If False, returns a concurrent.futures.Future of
+                the result instead, running remote extractions on the
+                session's extraction pool (see Session.submit_extraction).
         Returns:
             Two-tuple: (list of ScraperDocument objects, list of document ids) where
-                a document id can be an integer or None.
+                a document id can be an integer or None. The list of documents
+                is None for streaming parsers (see register_documents).
         '''
+        if not wait:
+            return self._submit_extraction(
+                self.extract_and_register_documents, extractor,
+                extract_args=extract_args, parser=parser, session=session)
         documents = self.extract_and_parse(
             extractor, extract_args=extract_args, parser=parser,
             session=session)
         return self.register_documents(documents, session=session)
 
     def extract_and_parse(self, extractor, parser=None,
-                          extract_args=None, session=None):
+                          extract_args=None, session=None, offload_parse=False):
         '''
         Runs an extractor, parses the output, and returns a list of ScraperDocument
         objects.
@@ -410,27 +611,66 @@ class File(object):
             parser: (Deprecated, Optional) A callback for a custom parser.
             extract_args: Specific optional arguments for the extractor.
             session: Optional files.Session instance.
+            offload_parse: Optional, parse in a common.cpu worker process.
+                Only for remote extractors (entity lists), and parser must be
+                a module level function.
         Returns:
-            List of ScraperDocument objects
+            List of ScraperDocument objects, or the iterable returned by a
+            streaming parser such as extraction.remote_parse_pages. Only
+            lists are kept as the documents property, so streamed documents
+            are not held in memory.
         '''
         extractor = extractors.get(extractor)
         parser = parser or extractor.parse
         extracted_content = self.extract(
             extractor, extract_args=extract_args, session=session)
-        self.documents = parser(extracted_content)
-        return self.documents
+        if offload_parse and extractor.is_remote:
+            documents = cpu.run(parser, extracted_content)
+        else:
+            documents = parser(extracted_content)
+        self.documents = documents if isinstance(documents, list) else None
+        return documents
 
-    def extract(self, extractor, extract_args=None, session=None):
+    def _submit_extraction(self, method, extractor, session=None, **kwargs):
+        '''
+        Returns a Future of method(extractor, session=session, **kwargs),
+        submitted to the session's extraction pool for remote extractors and
+        run immediately for local ones.
+        '''
+        session = session or Session.get()
+        extractor = extractors.get(extractor)
+        if extractor.is_remote and not session.dev_mode:
+            return session.submit_extraction(
+                method, extractor, session=session, **kwargs)
+        return _completed_future(method, extractor, session=session, **kwargs)
+
+    def extract(self, extractor, extract_args=None, session=None, wait=True):
         '''
         Runs an extractor and returns the raw content (entities list, etree, etc)
 
+        Remote extractions (OCR in particular) can take minutes. With
+        wait=False a scraper can submit many of them and collect the results
+        later:
+
+            futures = [fil.extract(files.extractors.tesseract, wait=False)
+                       for fil in fils]
+            ...
+            entities = [future.result() for future in futures]
+
         Args:
             extractor: Extractor object (see files.extractors)
             extract_args: Specific optional arguments for the extractor.
             session: Optional HttpSession instance.
+            wait: Optional. If False, returns a concurrent.futures.Future of
+                the result instead, running remote extractions on the
+                session's extraction pool (see Session.submit_extraction).
         Returns:
             Extractor specific, list of entities for remote extractors.
         '''
+        if not wait:
+            return self._submit_extraction(
+                self.extract, extractor, extract_args=extract_args,
+                session=session)
         session = session or Session.get()
         extractor = extractors.get(extractor)
 
@@ -438,35 +678,87 @@ class File(object):
         if self.encoding and 'encoding' not in extract_args:
             extract_args['encoding'] = self.encoding
 
+        if extractor.local and session.prefer_local_extraction:
+            # cheap text PDFs are extracted locally; fall back to document
+            # service if that fails or finds no text (e.g. scanned PDFs)
+            local = extractors.get(extractor.local)
+            try:
+                entities = self._extract_cached(local, extract_args, session)
+            except ExtractionException as exc:
+                logger.warning("Local extraction failed, using %s: %s",
+                               extractor.name, exc)
+            else:
+                if entities:
+                    return entities
+                logger.info("No text extracted locally, using %s", extractor.name)
+
         if extractor.is_remote and session.dev_mode:
             logger.warning(" %s DEV MODE %s ", *([' == '*10]*2))
             return [ttypes.HeaderEntity(text=(
                 u"Scraper was run in development mode, and so we skipped "
                 u"remote extraction."))]
 
-        return extractor.extract(extractor.name, self, **extract_args)
+        return self._extract_cached(extractor, extract_args, session)
+
+    def _extract_cached(self, extractor, extract_args, session):
+        '''
+        Runs an extractor, consulting the session's extraction cache (if any)
+        for cacheable extractors.
+        '''
+        cache = session.extraction_cache
+        if not cache or not extractor.cacheable:
+            return extractor.extract(extractor.name, self, **extract_args)
+        key = cache.key(self.hash(), extractor.name, extract_args)
+        found, result = cache.get(key)
+        if found:
+            logger.debug("Extraction cache hit: %s %s", extractor.name, self.url)
+            return result
+        result = extractor.extract(extractor.name, self, **extract_args)
+        cache.store(key, extractor.name, result)
+        return result
 
     def register_documents(self, scraper_docs, session=None):
         '''
-        Runs an extractor, parses the output, and returns a list of ScraperDocument
-        objects.
+        Registers scraper documents with document service.
 
         Args:
-            scraper_docs: List of scraper documents or strings.
+            scraper_docs: List (or iterable) of scraper documents or strings.
+                Iterables other than lists, such as generator parsers like
+                extraction.remote_parse_pages, are registered in batches of
+                REGISTER_BATCH_SIZE while they are consumed, and are not kept.
             session: Optional HttpSession instance.
         Returns:
             Two-tuple: (list of ScraperDocument objects, list of document ids) where
-                a document id can be an integer or None.
+                a document id can be an integer or None. The list of documents
+                is None if scraper_docs is not a list.
         '''
         session = session or Session.get()
+        assert self.download_id
+        if isinstance(scraper_docs, list):
+            for i, doc in enumerate(scraper_docs):
+                if isinstance(doc, six.string_types):
+                    scraper_docs[i] = ScraperDocument(doc)
+            doc_ids = self._register_batch(scraper_docs, session)
+        else:
+            doc_ids = []
+            batch = []
+            for doc in scraper_docs:
+                if isinstance(doc, six.string_types):
+                    doc = ScraperDocument(doc)
+                batch.append(doc)
+                if len(batch) >= REGISTER_BATCH_SIZE:
+                    doc_ids.extend(self._register_batch(batch, session))
+                    batch = []
+            doc_ids.extend(self._register_batch(batch, session))
+            scraper_docs = None
+        self.document_ids = doc_ids
+        return scraper_docs, doc_ids
+
+    def _register_batch(self, scraper_docs, session):
         docserv_docs = []
         skipped = []
         doc_ids = []
-        assert self.download_id
         for i, doc in enumerate(scraper_docs):
-            if isinstance(doc, six.string_types):
-                doc = ScraperDocument(doc)
-                scraper_docs[i] = doc
             if not doc.text:
                 skipped.append(i)
                 continue
@@ -487,8 +779,7 @@ class File(object):
         # list.
         for i in skipped:
             doc_ids.insert(i, None)
-        self.document_ids = doc_ids
-        return scraper_docs, doc_ids
+        return doc_ids
 
     @property
     def content(self):
@@ -497,34 +788,75 @@ class File(object):
         '''
         if self._bytes is not None:
             return self._bytes
+        mapped = self._get_mmap() if self.use_mmap else None
+        if mapped is not None:
+            # not retained: the mapping is the long lived copy
+            return mapped[:]
         self.file_obj.seek(0)
         self._bytes = self.file_obj.read()
         self.file_obj.seek(0)
         return self._bytes
 
-    def get_xml(self):
+    def memoize_parse(self, key, parse):
+        '''
+        Return parse(), calling it only once per key until invalidate() is
+        called. Parsed trees are shared between callers, so only memoize
+        trees that callers don't modify in place.
+
+        Args:
+            key: Hashable key describing the parser and its options.
+            parse: Function without arguments returning the parsed content.
+        '''
+        if key not in self._parsed:
+            self._parsed[key] = parse()
+        return self._parsed[key]
+
+    def invalidate(self):
+        '''
+        Drop cached content and parsed documents, e.g. after file_obj has
+        been rewritten.
+        '''
+        self._close_mmap()
+        self._bytes = None
+        self._head = None
+        self._parsed = {}
+
+    def _parse_cached(self, func, cache, **kwargs):
+        if not cache:
+            return func(url=self.url, content=self.content, **kwargs)
+        return self.memoize_parse(
+            (func.__name__, tuple(sorted(kwargs.items()))),
+            lambda: func(url=self.url, content=self.content, **kwargs))
+
+    def get_xml(self, cache=False):
         '''
         Parse the file as an lxml xml object (shortcut to html.request_xml).
+        With cache=True the result is cached on the File and shared with
+        other cache=True callers - don't modify it in place.
 
         NOTE: This method is only considered partially complete in that it may
         introduce encoding issues.
         '''
-        return http.request_xml(url=self.url, content=self.content)
+        return self._parse_cached(http.request_xml, cache)
 
-    def get_lxml_html(self, **kwargs):
+    def get_lxml_html(self, cache=False, **kwargs):
         '''
         Parse the file as an lxml html object (shortcut to html.request_lxml_html).
+        With cache=True the result is cached per set of options and shared
+        with other cache=True callers - don't modify it in place.
 
         NOTE: This method is only considered partially complete in that it may
         introduce encoding issues.
         '''
-        return http.request_lxml_html(url=self.url, content=self.content, **kwargs)
+        return self._parse_cached(http.request_lxml_html, cache, **kwargs)
 
-    def get_html5(self, **kwargs):
+    def get_html5(self, cache=False, **kwargs):
         '''
         Parse the file as an html5 object (shortcut to html.request_html5).
+        With cache=True the result is cached per set of options and shared
+        with other cache=True callers - don't modify it in place.
 
         NOTE: This method is only considered partially complete in that it may
         introduce encoding issues.
         '''
-        return http.request_html5(url=self.url, content=self.content, **kwargs)
+        return self._parse_cached(http.request_html5, cache, **kwargs)
@@ -0,0 +1,250 @@
+'''
+common.files.pipeline
+
+Pipelined version of files.register_download_and_documents. Each request goes
+through three stages - download, upload (S3 upload and download
+registration), and extract (extraction and document registration) - and
+each stage runs on its own bounded thread pool, so the network, S3 and
+extraction latency of different files overlap:
+
+    with files.Pipeline(extractor=files.extractors.pdf) as pipeline:
+        for fil in pipeline.run(urls):
+            logger.info("%s: %s", fil.url, fil.document_ids)
+
+Requests are either urls or dictionaries of register_download_and_documents
+arguments (including 'url'). Completed File objects are yielded in completion
+order. A stage only accepts a limited number of queued files, so a slow stage
+blocks the stages before it rather than buffering an unbounded number of
+temporary files.
+'''
+
+import logging
+import Queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+import six
+
+from fn_scrapers.common import http
+from .exceptions import FilesException
+from .session import Session
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+EXTRACT = 'extract'
+STAGES = (DOWNLOAD, UPLOAD, EXTRACT)
+
+DEFAULT_WORKERS = {DOWNLOAD: 8, UPLOAD: 4, EXTRACT: 4}
+
+# request keys handled by each stage
+_DOWNLOAD_ARGS = ('request_args', 'skip_checks', 'headers_decoding', 'ldi')
+_FILE_OVERRIDES = ('mimetype', 'encoding', 'filename', 'name')
+_ALL_ARGS = frozenset(
+    ('url', 'extractor', 'extract_args', 'parser', 's3_args', 'serve_from_s3')
+    + _DOWNLOAD_ARGS + _FILE_OVERRIDES)
+
+
+class PipelineException(FilesException):
+    '''A request failed in one of the pipeline stages.'''
+    def __init__(self, message, stage, exception=None, url=None, fil=None):
+        super(PipelineException, self).__init__(
+            message, exception=exception, url=url, fil=fil)
+        self.stage = stage
+
+
+class _Item(object):
+    '''A request travelling through the pipeline.'''
+    def __init__(self, request, defaults):
+        if isinstance(request, six.string_types):
+            request = {'url': request}
+        self.args = dict(defaults, **request)
+        unknown = set(self.args) - _ALL_ARGS
+        if unknown:
+            raise ValueError('Unrecognized args: ' + ', '.join(unknown))
+        self.url = self.args['url']
+        self.file = None
+        self.error = None
+
+
+class Pipeline(object):
+    '''
+    Staged, bounded executor for download/upload/register/extract requests.
+    '''
+    def __init__(self, extractor=None, workers=None, queue_size=2,
+                 max_pending=64, return_exceptions=False, session=None,
+                 **kwargs):
+        '''
+        Constructor.
+
+        Args:
+            extractor: Optional default extractor for requests that do not
+                specify one. Files without an extractor are not extracted.
+            workers: Optional dictionary of stage name to thread count,
+                overriding DEFAULT_WORKERS.
+            queue_size: Optional number of files (per worker) a stage queues
+                before blocking the previous stage.
+            max_pending: Optional maximum number of requests in the pipeline.
+            return_exceptions: Optional, if True failed requests yield a
+                PipelineException instead of raising it.
+            session: Optional files.Session instance.
+            kwargs: Optional default register_download_and_documents
+                arguments for every request.
+        '''
+        self.extractor = extractor
+        self.max_pending = max_pending
+        self.return_exceptions = return_exceptions
+        self.session = session or Session.get()
+        self.defaults = kwargs
+        self.is_closed = False
+        self._local = threading.local()
+        self._worker_sessions = []
+        self._worker_lock = threading.Lock()
+
+        workers = dict(DEFAULT_WORKERS, **(workers or {}))
+        self.executors = {}
+        self.slots = {}
+        for stage in STAGES:
+            self.executors[stage] = ThreadPoolExecutor(max_workers=workers[stage])
+            self.slots[stage] = threading.Semaphore(workers[stage] * queue_size)
+        self.stage_funcs = {
+            DOWNLOAD: self._download,
+            UPLOAD: self._upload,
+            EXTRACT: self._extract,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def run(self, requests):
+        '''
+        Run requests through the pipeline.
+
+        Args:
+            requests: Iterable of urls or register_download_and_documents
+                argument dictionaries.
+        Yields:
+            files.File objects (or PipelineException objects if
+            return_exceptions is set) as they complete.
+        Raises:
+            PipelineException: If a request fails and return_exceptions is
+                not set.
+        '''
+        if self.is_closed:
+            raise RuntimeError("Pipeline is closed.")
+        done = Queue.Queue()
+        requests = iter(requests)
+        pending = 0
+        exhausted = False
+        while True:
+            while not exhausted and pending < self.max_pending:
+                try:
+                    request = next(requests)
+                except StopIteration:
+                    exhausted = True
+                    break
+                item = _Item(request, self.defaults)
+                pending += 1
+                self._submit(DOWNLOAD, item, done)
+            if not pending:
+                return
+            item = done.get()
+            pending -= 1
+            if item.error is None:
+                yield item.file
+            elif self.return_exceptions:
+                yield item.error
+            else:
+                raise item.error
+
+    def _submit(self, stage, item, done):
+        # blocks the calling (previous stage) thread while the stage is full
+        self.slots[stage].acquire()
+        self.executors[stage].submit(self._run_stage, stage, item, done)
+
+    def _run_stage(self, stage, item, done):
+        try:
+            self.stage_funcs[stage](item)
+        except Exception as exc: # pylint: disable=broad-except
+            logger.warning("Pipeline %s failed for %s: %s", stage, item.url, exc)
+            item.error = PipelineException(
+                str(exc), stage, exception=exc, url=item.url, fil=item.file)
+            if item.file is not None:
+                # the temporary file is not used by later stages
+                item.file.close()
+        finally:
+            self.slots[stage].release()
+
+        next_stage = None
+        if item.error is None and stage != STAGES[-1]:
+            next_stage = STAGES[STAGES.index(stage) + 1]
+        if next_stage == EXTRACT and not self._get_extractor(item):
+            next_stage = None
+        if next_stage:
+            self._submit(next_stage, item, done)
+        else:
+            done.put(item)
+
+    def _worker_session(self):
+        '''
+        files.Session copy of the calling stage worker thread, with its own
+        http.Session copy (and requests.Session), so workers do not share
+        connection state. Closed with the pipeline.
+        '''
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            http_session = self.session.http_session or http.Session.get()
+            http_session = http_session.copy(
+                req_session=http_session.create_requests_session())
+            session = self.session.copy(http_session=http_session)
+            self._local.session = session
+            with self._worker_lock:
+                self._worker_sessions.append(session)
+        return session
+
+    def _get_extractor(self, item):
+        return item.args.get('extractor', self.extractor)
+
+    def _download(self, item):
+        from . import request_file_with_cache
+        kwargs = {key: item.args[key] for key in _DOWNLOAD_ARGS
+                  if key in item.args}
+        item.file = request_file_with_cache(
+            item.url, session=self._worker_session(), **kwargs)
+        for key in _FILE_OVERRIDES:
+            if item.args.get(key):
+                setattr(item.file, key, item.args[key])
+
+    def _upload(self, item):
+        item.file.upload_and_register(
+            s3_args=item.args.get('s3_args'),
+            serve_from_s3=item.args.get('serve_from_s3'),
+            session=self._worker_session())
+
+    def _extract(self, item):
+        item.file.extract_and_register_documents(
+            self._get_extractor(item), extract_args=item.args.get('extract_args'),
+            parser=item.args.get('parser'), session=self._worker_session())
+
+    def close(self, wait=True):
+        '''
+        Shut down the stage thread pools and close the worker sessions.
+
+        Args:
+            wait: Optional, wait for in flight requests. Default True. Worker
+                sessions are only closed once their threads are done.
+        '''
+        self.is_closed = True
+        for stage in STAGES:
+            self.executors[stage].shutdown(wait=wait)
+        if not wait:
+            return
+        with self._worker_lock:
+            sessions, self._worker_sessions = self._worker_sessions, []
+        for session in sessions:
+            session.http_session.close()
+            session.close()
@@ -29,16 +29,23 @@ import json
 import threading
 
 from boto.s3.connection import S3Connection
-import requests
+from concurrent.futures import ThreadPoolExecutor
 
 import fn_ratelimiter_common.config as ratelimiter_config
 from fn_ratelimiter_client.blocking_client import BlockingRateLimiterClientFactory
 from fn_ratelimiter_client.blocking_util import STANDARD_REQUESTS_RETRY_POLICY
 
+from fn_scrapers.common.http.session import SessionStats
+
+from .dedup import KnownKeys
 from .docserv_client import DocServiceClient
 
 class SessionAWS(object):
-    '''Storage object for AWS settings. '''
+    '''
+    Storage object for AWS settings. Connections are established on first use,
+    one per thread (boto connections should not be shared between threads),
+    so a single SessionAWS can be shared by every thread of a scraper.
+    '''
     def __init__(self, access_key, secret_access_key=None, region=None,
                  base64_secret_access_key=None, bucket=None, **kwargs):
         self.access_key = access_key
@@ -46,13 +53,11 @@ class SessionAWS(object):
             secret_access_key = b64decode(base64_secret_access_key)
         self.secret_access_key = secret_access_key
 
-        # TODO: Review initialization. Just-In-Time Connect?
-        self.conn = S3Connection(self.access_key, self.secret_access_key)
-
         self.region = region
-        self.bucket = None
-        self.buckets = {}
-
+        self.bucket_name = None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
 
         if not bucket and kwargs.get('s3_bucket'):
             bucket = kwargs.pop('s3_bucket')
@@ -67,31 +72,78 @@ class SessionAWS(object):
         if kwargs:
             raise ValueError('Unrecognized args: ' + ', '.join(kwargs.keys()))
 
+    @property
+    def conn(self):
+        '''
+        The calling thread's S3Connection, created on first use.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.create_connection()
+            self._local.buckets = {}
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @property
+    def buckets(self):
+        '''
+        Dictionary of bucket name to the calling thread's bucket object.
+        '''
+        self.conn # pylint: disable=pointless-statement
+        return self._local.buckets
+
+    @property
+    def bucket(self):
+        '''
+        The current bucket object, or None if no bucket is set.
+        '''
+        if not self.bucket_name:
+            return None
+        return self.get_bucket(self.bucket_name)
+
     def connect(self, disconnect=True):
         '''
-        Establishes an S3 Connection object.
+        Replaces the calling thread's S3 Connection object. The new connection
+        is established on first use.
 
         Args:
             disconnect: If False, prevents disconnecting the current connection.
                 Used when forking.
         '''
-        if disconnect and self.conn:
-            self.conn.close()
-        self.conn = S3Connection(self.access_key, self.secret_access_key)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            with self._lock:
+                self._connections.remove(conn)
+            if disconnect:
+                conn.close()
+        self._local.conn = None
+
+    def create_connection(self):
+        '''
+        Returns a new S3Connection object. boto connections should not be
+        shared between threads, so worker threads use their own.
+        '''
+        return S3Connection(self.access_key, self.secret_access_key)
 
     def close(self):
         '''
-        Closes the connection to AWS.
+        Closes the connections to AWS.
         '''
-        self.conn.close()
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
 
     def get_bucket(self, bucket):
         '''
-        Returns the bucket object.
+        Returns the bucket object. The bucket is not validated (no request is
+        made), errors surface on the first operation using it.
         '''
-        if bucket not in self.buckets:
-            self.buckets[bucket] = self.conn.get_bucket(bucket)
-        return self.buckets[bucket]
+        buckets = self.buckets
+        if bucket not in buckets:
+            buckets[bucket] = self.conn.get_bucket(bucket, validate=False)
+        return buckets[bucket]
 
     def set_bucket(self, bucket):
         '''
@@ -100,28 +152,74 @@ class SessionAWS(object):
         Args:
             bucket: string name of bucket.
         '''
-        self.bucket = self.get_bucket(bucket)
+        self.bucket_name = bucket
 
     def generate_s3_url(self, key_name, bucket=None):
         '''
         Return a valid s3 url given a key_name of style 'file-by-sha384/...'
         '''
-        if bucket:
-            bucket = self.get_bucket(bucket).name
-        else:
-            bucket = self.bucket.name
         return self.s3_url_format.format(
-            bucket=bucket or self.bucket.name, key=key_name)
+            bucket=bucket or self.bucket_name, key=key_name)
+
+
+class ConnectionPool(object):
+    '''
+    S3 and document service connections shared by files.Session objects.
+    Creating a files.Session on top of an existing pool makes no connections,
+    so a pool is intended to be shared by every request and thread of a
+    scraper:
+
+        pool = files.ConnectionPool(aws, docservice_host)
+        session = files.Session(connection_pool=pool)
+    '''
+    def __init__(self, aws, docservice_host, docservice_timeout=1800,
+                 doc_session=None, known_keys_size=100000, retry_engine=None):
+        '''
+        Constructor.
+
+        Args:
+            aws: AWS specific settings dictionary, see files.Session.
+            docservice_host: host to connect to for document service.
+            docservice_timeout: Optional document service timeout in seconds.
+            doc_session: Optional requests.Session for document service
+                calls, e.g. from http.ConnectionPool.create_requests_session.
+            known_keys_size: Optional - number of existing S3 keys remembered
+                for dedup_uploads. Defaults to 100000.
+            retry_engine: Optional http.RetryEngine for document service
+                calls.
+        '''
+        self.is_closed = False
+        self.aws = SessionAWS(**aws)
+        self.docserv_client = DocServiceClient(
+            docservice_host, docservice_timeout, doc_session=doc_session,
+            retry_engine=retry_engine)
+        self.known_keys = KnownKeys(known_keys_size)
+
+    def close(self):
+        '''
+        Closes the connections.
+        '''
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.aws.close()
+        self.docserv_client.close()
 
 
 class Session(object):
     '''
     Collection object of HTTP settings and handlers, including rate limiter
     objects, thrift settings, requests sessions, etc.
+
+    Session.get() follows the same per-thread rules as http.Session.get(),
+    including the per_thread class setting (on by default).
     '''
     instance = None
     thread_local = threading.local()
-    def __init__(self, aws, docservice_host, **kwargs):
+    per_thread = True
+    stats = SessionStats()
+    _owner = None
+    def __init__(self, aws=None, docservice_host=None, **kwargs):
         '''
         Constructor.
 
@@ -131,24 +229,67 @@ class Session(object):
                         access_key str, secret_access_key str, s3_endpoint str,
                         bucket str, base64_secret_access_key str (optional)
                     }
-            docservice_host: host to connect to for document service.
+                Not used with connection_pool.
+            docservice_host: host to connect to for document service. Not
+                used with connection_pool.
+            connection_pool: Optional files.ConnectionPool shared with other
+                sessions. A pool owned by the session is created from aws and
+                docservice_host if not provided.
             s3_bucket: Bucket to upload/download from.
             dev_mode: Optional - do not extract content.
             start_time: Optional - start time of scraper.
             serve_from_s3: Optional - whether to use the s3 url or the external
                 url. Defaults to None (auto: False if text/html, True otherwise).
             skip_checks: Optional - set to true to ignore cache.
+            multipart_threshold: Optional - size in bytes from which uploads
+                to S3 use parallel multipart uploads. Defaults to 64MB.
+            multipart_part_size: Optional - multipart part size in bytes
+                (minimum 5MB). Defaults to 16MB.
+            multipart_workers: Optional - threads per multipart upload.
+                Defaults to 4.
+            dedup_uploads: Optional - skip uploading content that already
+                exists in S3. Defaults to True.
+            known_keys_size: Optional - number of existing S3 keys remembered
+                for dedup_uploads. Defaults to 100000. Not used with
+                connection_pool.
+            max_extractions: Optional - number of asynchronous remote
+                extractions in flight. Defaults to 8.
+            prefer_local_extraction: Optional - extract text PDFs locally
+                with pdftotext instead of document service where possible.
+                Defaults to False.
+            extraction_cache: Optional - files.ExtractionCache for results
+                of cacheable extractors. Defaults to None (no cache).
+            download_index: Optional - files.DownloadIndex answering last
+                download lookups for recently verified urls. Defaults to None
+                (always ask document service).
         '''
         self.is_closed = False
-
-        s3_bucket = kwargs.pop('s3_bucket', None)
-        if s3_bucket:
-            aws['bucket'] = s3_bucket
-        aws['s3_url_format'] = kwargs.pop('s3_url_format', None)
+        self._parent = None
+
+        self.connection_pool = kwargs.pop('connection_pool', None)
+        self._owns_pool = self.connection_pool is None
+        pool_args = {key: kwargs.pop(key) for key in
+                     ('s3_bucket', 's3_url_format', 'known_keys_size')
+                     if key in kwargs}
+        if self._owns_pool:
+            if aws is None or docservice_host is None:
+                raise ValueError(
+                    'aws and docservice_host are required without a '
+                    'connection_pool.')
+            if pool_args.get('s3_bucket'):
+                aws['bucket'] = pool_args['s3_bucket']
+            aws['s3_url_format'] = pool_args.get('s3_url_format')
+            self.connection_pool = ConnectionPool(
+                aws, docservice_host,
+                known_keys_size=pool_args.get('known_keys_size', 100000))
+        elif pool_args:
+            raise ValueError('Set by the connection_pool: ' +
+                             ', '.join(pool_args.keys()))
 
         self.http_session = None
-        self.aws = SessionAWS(**aws)
-        self.docserv_client = DocServiceClient(docservice_host, 1800)
+        self.aws = self.connection_pool.aws
+        self.docserv_client = self.connection_pool.docserv_client
+        self.known_keys = self.connection_pool.known_keys
 
         # TODO: Data-access service initialization
 
@@ -158,6 +299,19 @@ class Session(object):
         self.serve_from_s3 = kwargs.pop('serve_from_s3', None)
         self.start_time = kwargs.pop('start_time', None)
         self.skip_checks = kwargs.pop('skip_checks', False)
+        self.multipart_threshold = kwargs.pop(
+            'multipart_threshold', 64*1024*1024)
+        self.multipart_part_size = kwargs.pop(
+            'multipart_part_size', 16*1024*1024)
+        self.multipart_workers = kwargs.pop('multipart_workers', 4)
+        self.dedup_uploads = kwargs.pop('dedup_uploads', True)
+        self.max_extractions = kwargs.pop('max_extractions', 8)
+        self.prefer_local_extraction = kwargs.pop(
+            'prefer_local_extraction', False)
+        self.extraction_cache = kwargs.pop('extraction_cache', None)
+        self.download_index = kwargs.pop('download_index', None)
+        self._extraction_executor = None
+        self._extraction_lock = threading.Lock()
         if kwargs:
             raise ValueError('Unrecognized args: ' + ', '.join(kwargs.keys()))
 
@@ -168,9 +322,30 @@ class Session(object):
         if self.is_closed:
             return
         self.is_closed = True
+        if self._parent is not None:
+            # copies share the extraction pool and connections
+            return
 
-        self.aws.close()
-        self.docserv_client.close()
+        if self._extraction_executor:
+            self._extraction_executor.shutdown()
+        if self._owns_pool:
+            self.connection_pool.close()
+
+    def submit_extraction(self, func, *args, **kwargs):
+        '''
+        Run func(*args, **kwargs) on the remote extraction thread pool, which
+        keeps at most max_extractions extractions in flight. Further
+        submissions wait in the pool's queue.
+
+        Returns:
+            concurrent.futures.Future
+        '''
+        with self._extraction_lock:
+            if self._extraction_executor is None:
+                self._extraction_executor = ThreadPoolExecutor(
+                    max_workers=self.max_extractions)
+            executor = self._extraction_executor
+        return executor.submit(func, *args, **kwargs)
 
     @classmethod
     def new(cls, *args, **kwargs):
@@ -194,41 +369,63 @@ class Session(object):
         Returns:
             files.Session object, or None if create=False and none exist.
         '''
-        if 'files_session' in cls.thread_local.__dict__:
-            if not cls.thread_local.files_session.is_closed:
-                return cls.thread_local.files_session
-        if cls.instance and not cls.instance.is_closed:
-            return cls.instance
+        session = getattr(cls.thread_local, 'files_session', None)
+        if session is not None and not session.is_closed and \
+                (session._parent is None or not session._parent.is_closed):
+            cls.stats.increment('local')
+            return session
+        instance = cls.instance
+        if instance and not instance.is_closed:
+            if threading.current_thread().ident == cls._owner:
+                return instance
+            if cls.per_thread:
+                return instance.create_local()
+            cls.stats.increment('shared')
+            return instance
         if not create:
             return None
         session = cls.load()
-        cls.instance = session
+        session.set_as_instance()
         return session
 
     def set_as_instance(self):
         '''
-        Sets the current object as the global instance.
+        Sets the current object as the global instance, owned by the calling
+        thread.
         '''
         self.__class__.instance = self
+        self.__class__._owner = threading.current_thread().ident
 
     def copy(self, **kwargs):
         '''
         Shallow copies the current config object. Any arguments passed via
-        kwargs will be set to the new object.
+        kwargs will be set to the new object. The copy shares the connection
+        pool and extraction thread pool, which are closed by the original
+        only.
+
+        Returns:
+            files.Session object.
         '''
         new_instance = copy(self)
+        new_instance._parent = self
         for key in kwargs:
             setattr(new_instance, key, kwargs[key])
+        return new_instance
 
     def create_local(self, **kwargs):
         '''
-        Create a thread-local instance of the current session, decoupling the
-        requests.session property.
+        Create a thread-local instance of the current session. S3 and
+        document service connections are already per thread (see
+        ConnectionPool), so the copy only decouples the settings. The copy
+        becomes the calling thread's Session.get() result.
+
+        Returns:
+            files.Session object.
         '''
-        if 'session' not in kwargs:
-            # TODO: new session, or copy?
-            kwargs['session'] = requests.Session()
-        self.thread_local.files_session = self.copy(**kwargs)
+        session = self.copy(**kwargs)
+        self.thread_local.files_session = session
+        self.stats.increment('copies')
+        return session
 
     @classmethod
     def load(cls, su_config=None):
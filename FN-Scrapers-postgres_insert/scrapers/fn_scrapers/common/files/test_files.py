@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
-from fn_scrapers.common.files.file import File
+from fn_scrapers.common.files.file import File, StreamDigest, SNIFF_SIZE
 from cStringIO import StringIO
+from tempfile import TemporaryFile
 
 def test_rfc6266():
     from rfc6266 import build_header
@@ -19,6 +20,14 @@ def test_content():
     fil = File('http://foo.com', StringIO('This is a test'))
     assert fil.content == 'This is a test'
 
+def test_stream_digest():
+    data = 'x' * (SNIFF_SIZE + 10)
+    digest = StreamDigest()
+    for i in range(0, len(data), 100):
+        digest.update(data[i:i + 100])
+    assert digest.head == data[:SNIFF_SIZE]
+    assert digest.hexdigest() == File('http://foo.com', StringIO(data)).hash()
+
 def test_get_xml():
     fil = File('http://foo.com', StringIO('<foo><bar>baz</bar></foo>'))
     xml = fil.get_xml()
@@ -44,3 +53,434 @@ def test_get_html5():
     import lxml
     print lxml.etree.tostring(xml)
     assert xml.xpath('//p/text()') == ['foo', 'bar']
+
+def test_parse_cache():
+    fil = File('http://foo.com', StringIO('<html><body><p>foo</p></body></html>'))
+    first = fil.get_lxml_html(cache=True)
+    assert fil.get_lxml_html(cache=True) is first
+    assert fil.get_lxml_html(cache=True, abs_links=True) is not first
+    assert fil.get_lxml_html() is not first
+    fil.invalidate()
+    assert fil.get_lxml_html(cache=True) is not first
+
+def test_extract_cache():
+    import mock
+    from fn_scrapers.common.files.extraction import Extractors
+    session = mock.Mock(dev_mode=False, prefer_local_extraction=False,
+                        extraction_cache=None)
+    fil = File('http://foo.com', StringIO('<html><body><p>foo</p></body></html>'))
+    first = fil.extract(Extractors.html, session=session)
+    # a parser modifying the tree doesn't change later extractions
+    first.xpath('//p')[0].drop_tree()
+    docs = fil.extract_and_parse(Extractors.html, session=session)
+    assert docs[0].text == 'foo'
+    cached = fil.extract(Extractors.html, extract_args={'cache': True},
+                         session=session)
+    assert cached is not first
+    assert fil.extract(Extractors.html, extract_args={'cache': True},
+                       session=session) is cached
+
+def test_mmap_buffer():
+    file_obj = TemporaryFile()
+    file_obj.write('<html><body><p>foo</p></body></html>')
+    fil = File('http://foo.com/foo.html', file_obj, use_mmap=True)
+    assert fil.find('<p>') == 12
+    assert fil.buffer[12:15] == '<p>'
+    assert fil.content == '<html><body><p>foo</p></body></html>'
+    assert fil.hash() == File(
+        'http://foo.com', StringIO(fil.content)).hash()
+    fil.close()
+
+    # in memory files fall back to content
+    fil = File('http://foo.com', StringIO('foo'), use_mmap=True)
+    assert fil.buffer == 'foo'
+
+def test_upload_multipart():
+    import mock
+    from fn_scrapers.common.files.file import MIN_PART_SIZE
+
+    parts = {}
+    class FakeMultiPartUpload(object):
+        def __init__(self, bucket):
+            self.key_name = self.id = None
+        def upload_part_from_file(self, fp, part_num, size):
+            assert self.id == 'upload-id'
+            parts[part_num] = fp.read(size)
+
+    data = ''.join(chr(ord('a') + i % 26) for i in range(26)) * (
+        (2 * MIN_PART_SIZE + 100) // 26)
+    session = mock.Mock(multipart_part_size=1, multipart_workers=3)
+    upload = session.aws.bucket.initiate_multipart_upload.return_value
+    upload.key_name, upload.id = 'file-by-sha384/abc', 'upload-id'
+    connections = []
+    def _create_connection():
+        connections.append(mock.Mock())
+        return connections[-1]
+    session.aws.create_connection.side_effect = _create_connection
+    fil = File('http://foo.com', StringIO(data))
+    with mock.patch('fn_scrapers.common.files.file.MultiPartUpload',
+                    FakeMultiPartUpload):
+        fil._upload_multipart('file-by-sha384/abc', {}, len(data), session)
+    assert sorted(parts) == [1, 2, 3]
+    assert ''.join(parts[i] for i in sorted(parts)) == data
+    upload.complete_upload.assert_called_once_with()
+    assert not upload.cancel_upload.called
+    assert connections
+    assert all(conn.close.called for conn in connections)
+
+def test_known_keys():
+    import mock
+    from fn_scrapers.common.files.dedup import KnownKeys
+
+    keys = KnownKeys(max_size=2)
+    bucket = mock.Mock()
+    bucket.get_key.return_value = None
+    assert not keys.exists(bucket, 'a')
+    bucket.get_key.return_value = object()
+    assert keys.exists(bucket, 'a')
+    assert keys.exists(bucket, 'a')
+    assert bucket.get_key.call_count == 2
+    keys.add('b')
+    assert 'a' in keys # 'a' is now most recent
+    keys.add('c')
+    assert 'a' in keys and 'c' in keys and 'b' not in keys
+
+def test_upload_skips_existing():
+    import mock
+    from fn_scrapers.common.files.dedup import KnownKeys
+
+    fil = File('http://foo.com/foo.txt', StringIO('foo'))
+    session = mock.Mock(known_keys=KnownKeys())
+    session.known_keys.add(fil.get_s3_endpoint())
+    session.aws.generate_s3_url.side_effect = lambda key: 'https://s3/' + key
+    with mock.patch('boto.s3.key.Key') as key:
+        url = fil.upload_to_s3(session=session, skip_existing=True)
+    assert url == 'https://s3/' + fil.get_s3_endpoint()
+    assert fil.s3_url == url
+    assert not key.called
+
+def test_batch_queue():
+    from fn_scrapers.common.files.batching import BatchQueue
+
+    batches = []
+    def handler(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    queue = BatchQueue(handler, max_size=3, max_wait=60)
+    futures = [queue.submit(i) for i in range(4)]
+    assert batches == [[0, 1, 2]]
+    assert not futures[3].done()
+    queue.close()
+    assert batches == [[0, 1, 2], [3]]
+    assert [future.result() for future in futures] == [0, 2, 4, 6]
+
+    queue = BatchQueue(handler, max_size=10, max_wait=0.01)
+    assert queue.submit(5).result(timeout=5) == 10
+    queue.close()
+    try:
+        queue.submit(6)
+        assert False, "submit after close should fail"
+    except RuntimeError:
+        pass
+
+def test_docserv_bulk():
+    import mock
+    from fn_scrapers.common.files.docserv_client import DocServiceClient
+
+    with mock.patch.object(DocServiceClient, '_create_thrift_client') as create:
+        client = DocServiceClient('localhost', 10, max_workers=2, batch_size=2)
+        thrift = create.return_value
+        thrift.getLastDownload.side_effect = lambda url: url.upper()
+        thrift.registerDownload.side_effect = lambda *args: len(args)
+        thrift.registerDocuments.side_effect = lambda did, docs: [did] * len(docs)
+
+        assert client.last_download_info_many(['a', 'b']) == {'a': 'A', 'b': 'B'}
+        assert client.register_downloads([(1, 2), (1, 2, 3)]) == [2, 3]
+        first = client.register_documents_async(1, ['x'])
+        second = client.register_documents_async(2, ['x', 'y'])
+        assert first.result(timeout=5) == [1]
+        assert second.result(timeout=5) == [2, 2]
+        client.close()
+
+def test_pipeline():
+    import mock
+    from fn_scrapers.common.files.pipeline import Pipeline, PipelineException
+
+    sessions = set()
+    def fake_request(url, session=None, **kwargs):
+        sessions.add(session)
+        if url == 'http://foo.com/bad':
+            raise ValueError('bad')
+        fil = mock.Mock(url=url, mimetype=None)
+        fil.extract_and_register_documents.side_effect = lambda *args, **kw: \
+            setattr(fil, 'extracted', True)
+        if url == 'http://foo.com/badext':
+            fil.extract_and_register_documents.side_effect = ValueError('bad')
+        return fil
+
+    session = mock.Mock()
+    session.copy.side_effect = lambda **kwargs: mock.Mock(**kwargs)
+    urls = ['http://foo.com/%s' % i for i in range(10)]
+    with mock.patch('fn_scrapers.common.files.request_file_with_cache',
+                    fake_request):
+        with Pipeline(extractor='text', session=session,
+                      workers={'download': 2}, queue_size=1,
+                      max_pending=3, return_exceptions=True) as pipeline:
+            results = list(pipeline.run(
+                urls + ['http://foo.com/bad', 'http://foo.com/badext',
+                        {'url': 'http://foo.com/noext', 'extractor': None,
+                         'mimetype': 'text/plain'}]))
+    assert len(results) == 13
+    errors = [res for res in results if isinstance(res, PipelineException)]
+    assert sorted((err.url, err.stage) for err in errors) == [
+        ('http://foo.com/bad', 'download'), ('http://foo.com/badext', 'extract')]
+    assert [err.fil.close.called for err in errors if err.fil] == [True]
+    # each download worker used its own session, closed with the pipeline
+    assert session not in sessions
+    assert 1 <= len(sessions) <= 2
+    assert all(sess.close.called and sess.http_session.close.called
+               for sess in sessions)
+    files = dict((res.url, res) for res in results if res not in errors)
+    assert sorted(files) == sorted(urls + ['http://foo.com/noext'])
+    assert all(files[url].extracted for url in urls)
+    assert files['http://foo.com/noext'].mimetype == 'text/plain'
+    assert not files['http://foo.com/noext'].extract_and_register_documents.called
+    assert files[urls[0]].upload_and_register.called
+
+def test_session_per_thread():
+    import threading
+    import mock
+    from fn_scrapers.common.files.session import Session
+
+    session = Session(connection_pool=mock.Mock())
+    session.set_as_instance()
+    try:
+        found = []
+        thread = threading.Thread(target=lambda: found.append(Session.get()))
+        thread.start()
+        thread.join()
+        assert Session.get() is session
+        assert found[0] is not session and found[0].aws is session.aws
+    finally:
+        session.close()
+        Session.instance = None
+
+def test_extract_async():
+    import threading
+    import mock
+    from concurrent.futures import ThreadPoolExecutor
+    from fn_scrapers.common.files.extraction import Extractor
+
+    release = threading.Event()
+    def slow_extract(name, fil, **kwargs):
+        release.wait(5)
+        return [name, fil.url]
+    remote = Extractor('slow', True, slow_extract)
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    session = mock.Mock(dev_mode=False, extraction_cache=None)
+    session.submit_extraction.side_effect = executor.submit
+    fil = File('http://foo.com', StringIO('foo'))
+    future = fil.extract(remote, session=session, wait=False)
+    assert not future.done()
+    release.set()
+    assert future.result(timeout=5) == ['slow', 'http://foo.com']
+
+    # local extractors run immediately
+    future = fil.extract('text', session=session, wait=False)
+    assert future.done() and future.result() == 'foo'
+    assert session.submit_extraction.call_count == 1
+    executor.shutdown()
+
+def test_pdftotext_extract():
+    import mock
+    from fn_scrapers.common.files.extraction import (
+        Extractors, pdftotext_extract, remote_parse)
+
+    proc = mock.Mock()
+    proc.stdout = StringIO('Title\n  body\xc2\xad\n\n\x0cPage two\n\x0c')
+    proc.wait.return_value = 0
+    fil = File('http://foo.com/foo.pdf', StringIO('%PDF-1.4'))
+    with mock.patch('subprocess32.Popen', return_value=proc) as popen:
+        entities = pdftotext_extract('local_text_pdf', fil)
+    assert popen.call_args[0][0][:4] == ['pdftotext', '-enc', 'UTF-8', '-layout']
+    assert [(ent.textEntity.pageNum, ent.textEntity.textContainers[0].text)
+            for ent in entities] == [(1, u'Title'), (1, u'  body-'), (2, u'Page two')]
+    assert remote_parse(entities)[0].text == u'Title\n  body-\nPage two\n'
+
+    # session policy - local extraction with remote fallback
+    session = mock.Mock(prefer_local_extraction=True, dev_mode=False,
+                        extraction_cache=None)
+    with mock.patch.object(Extractors.local_text_pdf, 'extract',
+                           return_value=entities) as local, \
+            mock.patch.object(Extractors.text_pdf, 'extract',
+                              return_value=['remote']):
+        assert fil.extract('text_pdf', session=session) is entities
+        local.return_value = [] # no text, e.g. a scanned PDF
+        assert fil.extract('text_pdf', session=session) == ['remote']
+
+def test_remote_parse_pages():
+    from fn_scrapers.common.files.extraction import remote_parse, remote_parse_pages
+
+    class Obj(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+    def entity(text=None, header=None, table=None, page=1):
+        containers = lambda value: [Obj(text=part) for part in value.split('|')]
+        return Obj(
+            textEntity=text and Obj(pageNum=page, textContainers=containers(text)),
+            headerEntity=header and Obj(pageNum=page, text=header),
+            tableEntity=table and Obj(pageNum=page, rows=[
+                Obj(cells=[Obj(textContainers=containers(cell)) for cell in row])
+                for row in table]))
+
+    entities = [entity(header=u'Title'), entity(text=u'foo|bar'),
+                entity(table=[[u'a', u'b|c'], [u'd']], page=2),
+                entity(text=u'baz', page=3)]
+    assert remote_parse(entities)[0].text == u'Title\nfoobar\nabc\nd\nbaz\n'
+    assert remote_parse([])[0].text == u''
+    pages = remote_parse_pages(entities)
+    assert not isinstance(pages, list)
+    assert [(doc.page_num, doc.text) for doc in pages] == [
+        (1, u'Title\nfoobar\n'), (2, u'abc\nd\n'), (3, u'baz\n')]
+
+def test_register_documents_batches():
+    import itertools
+    import mock
+    from fn_scrapers.common.files import file as file_module
+    from fn_scrapers.common.files.extraction import ScraperDocument
+
+    ids = itertools.count(1)
+    session = mock.Mock()
+    session.docserv_client.register_documents.side_effect = \
+        lambda download_id, docs: [next(ids) for _ in docs]
+    fil = File('http://foo.com', None, download_id=1)
+    consumed = []
+    def pages():
+        for page in range(1, 6):
+            consumed.append(page)
+            yield ScraperDocument(u'' if page == 3 else u'page', page_num=page)
+
+    with mock.patch.object(file_module, 'REGISTER_BATCH_SIZE', 2):
+        docs, doc_ids = fil.register_documents(pages(), session=session)
+    assert docs is None
+    assert doc_ids == fil.document_ids == [1, 2, None, 3, 4]
+    calls = session.docserv_client.register_documents.call_args_list
+    assert [len(call[0][1]) for call in calls] == [2, 1, 1]
+
+    docs, doc_ids = fil.register_documents([u'foo', u''], session=session)
+    assert [doc.text for doc in docs] == [u'foo', u'']
+    assert doc_ids == [5, None]
+
+def test_extraction_cache():
+    import os
+    import shutil
+    import tempfile
+    import mock
+    from fn_scrapers.common.files.extraction import Extractor
+    from fn_scrapers.common.files.extraction_cache import ExtractionCache
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = ExtractionCache(os.path.join(tmpdir, 'cache.db'), max_size=120)
+        key = cache.key('abc', 'text_pdf', {'encoding': 'utf-8'})
+        assert key == cache.key(u'abc', 'text_pdf', {'encoding': 'utf-8'})
+        assert key != cache.key('abc', 'text_pdf')
+        assert cache.get(key) == (False, None)
+        assert cache.store(key, 'text_pdf', [u'foo'])
+        assert cache.get(key) == (True, [u'foo'])
+        assert not cache.store('big', 'text_pdf', os.urandom(1000))
+        cache.store('other', 'text_pdf', os.urandom(100)) # evicts key
+        assert cache.get(key) == (False, None)
+        assert cache.stats.as_dict()['evictions'] == 1
+
+        extract = mock.Mock(return_value=[u'entities'])
+        remote = Extractor('remote', True, extract)
+        session = mock.Mock(dev_mode=False, prefer_local_extraction=False,
+                            extraction_cache=cache)
+        fil = File('http://foo.com', StringIO('foo'))
+        assert fil.extract(remote, session=session) == [u'entities']
+        assert fil.extract(remote, session=session) == [u'entities']
+        assert extract.call_count == 1
+        cache.close()
+
+        # results are unpickled, so files others can write are refused
+        shared = os.path.join(tmpdir, 'shared.db')
+        os.close(os.open(shared, os.O_CREAT, 0o600))
+        os.chmod(shared, 0o666)
+        try:
+            ExtractionCache(shared)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_download_index():
+    from datetime import datetime
+    import mock
+    from fn_scrapers.common.files import request_file_with_cache
+    from fn_scrapers.common.files.download_index import DownloadIndex
+
+    index = DownloadIndex(ttl=60)
+    assert index.get('http://foo.com/a') is None
+    index.record('http://foo.com/a', None, None) # nothing registered yet
+    assert index.get('http://foo.com/a') is None
+    index.record('http://foo.com/a', 12, 'https://s3/key', {'ETag': '"x"'},
+                 file_hash='abc')
+    ldi = index.get('http://foo.com/a')
+    assert (ldi.id, ldi.s3Url, ldi.headers, ldi.hash) == (
+        12, 'https://s3/key', {'ETag': '"x"'}, 'abc')
+
+    # fresh entries skip document service
+    session = mock.Mock(download_index=index, skip_checks=False,
+                        start_time=datetime(2000, 1, 1))
+    with mock.patch('fn_scrapers.common.files.download_from_s3') as download:
+        fil = request_file_with_cache('http://foo.com/a', session=session,
+                                      file_obj=StringIO())
+    assert fil.is_cached and fil.download_id == 12
+    assert download.call_args[0][0] == 'https://s3/key'
+    assert not session.docserv_client.last_download_info.called
+
+    index.ttl = -1 # expired
+    assert index.get('http://foo.com/a') is None
+    index.purge()
+    index.ttl = 60
+    assert index.get('http://foo.com/a') is None
+
+def test_connection_pool():
+    import threading
+    import mock
+    from fn_scrapers.common.files.session import ConnectionPool, Session
+
+    aws = {'access_key': 'key', 'secret_access_key': 'secret', 'bucket': 'b'}
+    with mock.patch('fn_scrapers.common.files.session.S3Connection') as s3_conn:
+        pool = ConnectionPool(aws, 'http://docservice')
+        first = Session(connection_pool=pool)
+        second = Session(connection_pool=pool)
+        assert not s3_conn.called
+        assert first.aws is second.aws
+        assert first.docserv_client is second.docserv_client
+        assert first.aws.generate_s3_url('k') == 'https://s3.amazonaws.com/b/k'
+        assert not s3_conn.called
+
+        first.aws.bucket # pylint: disable=pointless-statement
+        second.aws.bucket # pylint: disable=pointless-statement
+        s3_conn.return_value.get_bucket.assert_called_once_with(
+            'b', validate=False)
+        thread = threading.Thread(target=lambda: first.aws.conn)
+        thread.start()
+        thread.join()
+        assert s3_conn.call_count == 2
+
+        local = first.create_local(skip_checks=True)
+        assert Session.get() is local and local.skip_checks
+        local.close()
+        assert not first.is_closed
+
+        first.close()
+        assert not pool.is_closed
+        assert not s3_conn.return_value.close.called
+        pool.close()
+        assert s3_conn.return_value.close.call_count == 2
@@ -11,6 +11,7 @@ from fn_scrapers.api.resources import (
     injector, ScraperArguments, FilesSession, HttpSession)
 from fn_scrapers.api.utils import JSONEncoderPlus
 from fn_scrapers.common.dict import dict_deep_merge
+from fn_scrapers.common.http import HostUnavailableError, wait_until_available
 from fn_service.server import RequestProcessId, LoggerState
 
 
@@ -77,7 +78,8 @@ class GenericScraper(object):
             exchange, routing_key, source, message, json_encoder=encoder)
 
 
-    def scraper_loop(self, iterable, consumer, name=None, logger=None, log_ok=True):
+    def scraper_loop(self, iterable, consumer, name=None, logger=None, log_ok=True,
+                     defer_unavailable=True):
         '''
         Functional scraper loop implementation with logging and exception
         handling.
@@ -94,6 +96,9 @@ class GenericScraper(object):
             class name)
         :param logger: Optional logger to use (will construct one if none)
         :param log_ok: Whether to log ok messages on success
+        :param defer_unavailable: Whether to retry items that failed with
+            http.HostUnavailableError (host circuit open) once at the end of
+            the loop instead of failing them
         
         '''
 
@@ -127,9 +132,8 @@ class GenericScraper(object):
 
         logger = logger or logging.getLogger(self.__class__.__name__)
 
-        for item, event_keys in iterable:
-            if not isinstance(event_keys, Mapping):
-                event_keys = {'obj_id': event_keys}
+        def _consume(item, event_keys, deferred=None):
+            '''Consumes an item, appending it to deferred if its host is down. '''
             with self.logger_state.set_event_keys(event_keys):
                 try:
                     result = consumer(item)
@@ -139,6 +143,12 @@ class GenericScraper(object):
                     pass
                 except ItemSkipped as exception:
                     _log(OK_LVL, "scrape_skipped", name, exception=exception)
+                except HostUnavailableError as exception:
+                    if deferred is None:
+                        _log(logging.CRITICAL, 'failed_scrape', name, exception=exception)
+                    else:
+                        logger.info(u'Deferred scrape "%s": %s', name, exception)
+                        deferred.append((item, event_keys, exception))
                 except Exception as exception:
                     _log(logging.CRITICAL, 'failed_scrape', name, exception=exception)
                 else:
@@ -149,3 +159,15 @@ class GenericScraper(object):
                     elif result:
                         kwargs['result'] = str(result)
                     _log(level, 'scrape_success', name, **kwargs)
+
+        deferred = [] if defer_unavailable else None
+        for item, event_keys in iterable:
+            if not isinstance(event_keys, Mapping):
+                event_keys = {'obj_id': event_keys}
+            _consume(item, event_keys, deferred)
+
+        # items whose host was down are retried once, at the end of the run
+        if deferred:
+            wait_until_available([exception for _, _, exception in deferred])
+            for item, event_keys, _ in deferred:
+                _consume(item, event_keys)
@@ -2,7 +2,7 @@ from __future__ import absolute_import
 
 import logging
 from tempfile import TemporaryFile
-from urlparse import urlparse, urljoin
+from urlparse import urljoin
 
 import certifi
 import requests
@@ -15,10 +15,20 @@ from fn_ratelimiter_client.blocking_util import (
     standard_retry)
 from fn_ratelimiter_common.const import CLIENT_DEFAULT_IDLE_TIMEOUT
 
-from .session import Session
+from fn_scrapers.common import cpu
+
+from .cache import ResponseCache
+from .engine import RequestEngine
+from .pool import ConnectionPool, PoolStats
+from .reservation import Reservation, get_host
+from .retry import HostUnavailableError, RetryEngine, wait_until_available
+from .session import Session, SessionStats
 
 logger = logging.getLogger(__name__)
 
+# Read size used when streaming downloads to disk.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 class HttpException(Exception):
     '''Generic HTTP Exception.'''
     def __init__(self, message, exception=None, url=None):
@@ -30,18 +40,25 @@ def delay_for_host(url, quantity=1, http_session=None):
     '''
     Block until cleared by ratelimiter.
 
+    Single requests are served from an open Session.reserve() reservation
+    for the host, without a ratelimiter round trip, when one exists.
+
     Args:
         url: URL or name to check for. URL is transformed to name if "/" is in
             string.
         quantity: Optional request quantity for bulk delays.
         http_session: Optional http.Session object
     Returns:
-        fn_ratelimiter_client.response_cache.RateLimiterResponse
+        fn_ratelimiter_client.response_cache.RateLimiterResponse, or None if
+        the request was cleared by a local reservation.
     Raises:
         HostBlockedError: If the host should not be contacted at all.
     '''
     http_session = http_session or Session.get()
-    host = urlparse(url).netloc if '/' in url else url
+    host = get_host(url)
+    reservation = http_session.reservations.get(host)
+    if quantity == 1 and reservation and reservation.acquire():
+        return None
     return http_session.client.delay_for_host(host, quantity)
 
 
@@ -53,16 +70,32 @@ def request(url, http_session=None, **kwargs):
         url: URL to request.
         rl_client: Optional rate limiter client.
         req_session: Optional requests.Session instance.
-        retry_policy: Optional retry policy
+        retry_policy: Optional retry policy, bypasses the session's retry
+            engine.
+        use_cache: Optional, set to False to bypass the session's response
+            cache. Default True.
         kwargs: All unrecognized keyword arguments are sent to requests.request.
     Returns:
         requests.Response: Response object of the object being requested.
             http://docs.python-requests.org/en/master/api/#requests.Response
+            Responses answered from the response cache have from_cache set.
+    Raises:
+        HostUnavailableError: If the session's retry engine considers the
+            host down.
     '''
     logger.debug('Requesting url: %s', url)
     http_session = http_session or Session.get()
 
     method = kwargs.pop('method', 'GET')
+    cache = http_session.response_cache
+    if not kwargs.pop('use_cache', True) or kwargs.get('stream'):
+        cache = None
+
+    retry_policy = kwargs.pop('retry_policy', None)
+    retry_engine = None if retry_policy else http_session.retry_engine
+    if retry_engine is not None:
+        # fail fast before waiting on the ratelimiter
+        retry_engine.check(get_host(url), probe=False)
 
     delay_for_host(url, http_session=http_session)
 
@@ -74,7 +107,18 @@ def request(url, http_session=None, **kwargs):
         kwargs['headers'] = {}
     if 'User-Agent' not in kwargs['headers']:
         kwargs['headers']['User-Agent'] = http_session.user_agent
-    retry_policy = kwargs.get('retry_policy', http_session.retry_policy)
+
+    cache_key = entry = None
+    if cache is not None:
+        cache_key = cache.key(method, url, kwargs.get('params'),
+                              kwargs.get('data'), kwargs.get('json'))
+        entry = cache.get(cache_key)
+        conditional = entry.conditional_headers() if entry else {}
+        if any(name in kwargs['headers'] for name in conditional):
+            # the caller is doing its own revalidation
+            cache = entry = None
+        elif conditional:
+            kwargs['headers'] = dict(kwargs['headers'], **conditional)
 
     def _try():
         response = http_session.req_session.request(method, url, **kwargs)
@@ -82,20 +126,91 @@ def request(url, http_session=None, **kwargs):
         return response
 
     try:
-        return standard_retry(_try, retry_policy)
+        if retry_engine is not None:
+            response = retry_engine.call(get_host(url), _try)
+        else:
+            response = standard_retry(
+                _try, retry_policy or http_session.retry_policy)
     except requests.exceptions.HTTPError as exc:
         raise HttpException(str(exc), exception=exc, url=url)
 
-def request_file(url, file_obj=None, http_session=None, **kwargs):
+    if entry is not None and response.status_code == 304:
+        return cache.revalidated(entry, response)
+    if cache is not None:
+        cache.stats.increment('misses')
+        cache.store(cache_key, response)
+    return response
+
+def _worker_call(func, http_session):
+    # requests.Session is not thread-safe, so every engine worker thread
+    # uses its own copy of http_session.
+    def _call(url, *args, **kwargs):
+        return func(url, *args, http_session=http_session.worker_session(),
+                    **kwargs)
+    return _call
+
+def async_request(url, func=None, engine=None, http_session=None, **kwargs):
     '''
-    Request a file via requests library.
+    Non-blocking http.request. The request is run on the engine's thread pool
+    once the host has a free slot, and still waits on delay_for_host.
+
+    Args:
+        url: URL to request.
+        func: Optional http function to run (request_json, request_lxml_html,
+            etc). Defaults to http.request.
+        engine: Optional RequestEngine instance (shared engine by default).
+        http_session: Optional http.Session object. Defaults to the session
+            of the calling thread. Each worker thread uses its own copy (see
+            Session.worker_session).
+        kwargs: All unrecognized keyword arguments are sent to func.
+    Returns:
+        concurrent.futures.Future resolving to the return value of func.
+    '''
+    engine = engine or RequestEngine.get()
+    return engine.submit(
+        _worker_call(func or request, http_session or Session.get()),
+        url, **kwargs)
+
+def gather_requests(urls, func=None, engine=None, http_session=None,
+                    return_exceptions=False, **kwargs):
+    '''
+    Request many urls concurrently, honouring the per-host limits of the
+    engine and the ratelimiter.
+
+    Args:
+        urls: Iterable of URLs to request.
+        func: Optional http function to run (request_json, request_lxml_html,
+            etc). Defaults to http.request.
+        engine: Optional RequestEngine instance (shared engine by default).
+        http_session: Optional http.Session object. Defaults to the session
+            of the calling thread. Each worker thread uses its own copy (see
+            Session.worker_session).
+        return_exceptions: Optional, if True exceptions are returned in place
+            of results instead of being raised.
+        kwargs: All unrecognized keyword arguments are sent to func.
+    Returns:
+        List of results in the same order as urls.
+    '''
+    engine = engine or RequestEngine.get()
+    return engine.gather(
+        _worker_call(func or request, http_session or Session.get()), urls,
+        return_exceptions=return_exceptions, **kwargs)
+
+def request_file(url, file_obj=None, http_session=None, hasher=None, **kwargs):
+    '''
+    Request a file via requests library. The body is streamed to file_obj in
+    a single pass, enforcing the session max_size as it goes.
 
     Args:
         url: URL to request.
         file_obj: Optional file pointer to write to.
+        hasher: Optional object with an update(bytes) method (a hashlib
+            object, for example) fed every chunk as it is written, so the
+            file does not have to be re-read to hash it.
         rl_client: Optional rate limiter client.
         req_session: Optional requests.Session instance.
         retry_policy: Optional retry policy
+        chunk_size: Optional read size, defaults to DOWNLOAD_CHUNK_SIZE.
         kwargs: All unrecognized keyword arguments are sent to requests.request.
     Returns:
         two-tuple: (File object, requests.Response object)
@@ -103,7 +218,7 @@ def request_file(url, file_obj=None, http_session=None, **kwargs):
     '''
     http_session = http_session or Session.get()
 
-    chunk_size = kwargs.pop('chunk_size', 1024)
+    chunk_size = kwargs.pop('chunk_size', DOWNLOAD_CHUNK_SIZE)
     decode_unicode = kwargs.pop('decode_unicode', False)
     file_obj = file_obj or TemporaryFile()
 
@@ -113,15 +228,18 @@ def request_file(url, file_obj=None, http_session=None, **kwargs):
 
     byte_size = 0
     for chunk in response.iter_content(chunk_size, decode_unicode):
-        if chunk:
-            byte_size += len(chunk)
-            if byte_size > http_session.max_size:
-                try:
-                    file_obj.close()
-                except IOError:
-                    pass
-                raise HttpException('Max file size exceeded.')
+        if not chunk:
+            continue
+        byte_size += len(chunk)
+        if byte_size > http_session.max_size:
+            try:
+                file_obj.close()
+            except IOError:
+                pass
+            raise HttpException('Max file size exceeded.')
         file_obj.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
     logger.debug("Loaded {} bytes".format(byte_size))
     file_obj.seek(0)
     return file_obj, response
@@ -244,3 +362,27 @@ def request_html5(url, rep_nbsp=False, abs_links=False, encoding=None, **kwargs)
 
     return htm
 
+def request_xpath(url, xpaths, rep_nbsp=False, abs_links=False, html5=False,
+                  encoding=None, **kwargs):
+    '''
+    Performs an http request, then parses the page and evaluates xpaths in a
+    common.cpu worker process, keeping parsing off the (GIL holding) scraper
+    thread.
+
+    Args:
+        url: URL to request.
+        xpaths: Dictionary of name to xpath expression, see cpu.xpath_task.
+        rep_nbsp: Optional, replaces nbsp entities with spaces if True.
+        abs_links: Optional, change links to absolute urls.
+        html5: Optional, use the html5lib parser.
+        encoding: Optional, encoding to decode bytes to string with.
+        kwargs: Any unrecognized arguments are passed to http.request or
+            requests.request.
+    Returns:
+        Dictionary of name to list of strings.
+    '''
+    content = _get_content(url, encoding, **kwargs)
+    return cpu.run(cpu.xpath_task, content, xpaths,
+                   base_url=url if abs_links else None, html5=html5,
+                   rep_nbsp=rep_nbsp)
+
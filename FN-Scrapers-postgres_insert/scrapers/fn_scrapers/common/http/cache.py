@@ -0,0 +1,176 @@
+'''
+common.http.cache
+
+Opt-in, size-bounded on-disk response cache for http.request. Responses
+carrying an ETag or Last-Modified header are stored (keyed by method, url,
+params and body); later requests for the same key are sent with
+If-None-Match/If-Modified-Since and a 304 is answered from the cache:
+
+    http.Session.get().response_cache = http.ResponseCache(
+        '/tmp/fnscrapers-http-cache.db', max_size=512*1024*1024)
+    ...
+    logger.info("Cache stats: %s", session.response_cache.stats.as_dict())
+
+Entries are evicted least-recently-used first once the stored bodies exceed
+max_size. Streamed requests (request_file) are never cached.
+'''
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import sqlite3
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from ..sqlite_cache import CacheStats, LRUStore
+
+logger = logging.getLogger(__name__)
+
+# headers of a 304 response that replace the cached ones
+REVALIDATED_HEADERS = (
+    'Cache-Control', 'Date', 'ETag', 'Expires', 'Last-Modified', 'Vary')
+
+_COLUMNS = (
+    ('url', 'TEXT NOT NULL'),
+    ('status_code', 'INTEGER NOT NULL'),
+    ('headers', 'TEXT NOT NULL'),
+    ('body', 'BLOB NOT NULL'),
+)
+
+
+def _key_part(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, sort_keys=True, default=str)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class CacheEntry(object):
+    '''A stored response.'''
+    def __init__(self, key, url, status_code, headers, body):
+        self.key = key
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.body = body
+
+    def conditional_headers(self):
+        '''
+        Returns:
+            dictionary of revalidation headers for this entry.
+        '''
+        headers = {}
+        if 'ETag' in self.headers:
+            headers['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+
+class ResponseCache(object):
+    '''
+    sqlite backed LRU response cache, safe to share between threads.
+    '''
+    def __init__(self, path, max_size=256*1024*1024):
+        '''
+        Constructor.
+
+        Args:
+            path: sqlite database file (created if missing).
+            max_size: Optional maximum total size of stored bodies in bytes.
+        '''
+        self.path = path
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self._store = LRUStore(path, 'responses', _COLUMNS, max_size,
+                               stats=self.stats)
+
+    @staticmethod
+    def key(method, url, params=None, data=None, json_body=None):
+        '''
+        Returns:
+            cache key for a request.
+        '''
+        hasher = hashlib.sha1()
+        for part in (method.upper(), url, params, data, json_body):
+            hasher.update(_key_part(part))
+            hasher.update('\0')
+        return hasher.hexdigest()
+
+    def get(self, key):
+        '''
+        Returns:
+            CacheEntry, or None if key is not stored.
+        '''
+        row = self._store.get(key)
+        if row is None:
+            return None
+        url, status_code, headers, body = row
+        return CacheEntry(key, url, status_code, json.loads(headers), bytes(body))
+
+    def store(self, key, response):
+        '''
+        Store a response if it can be revalidated later.
+
+        Returns:
+            True if the response was stored.
+        '''
+        if response.status_code != 200:
+            return False
+        if 'ETag' not in response.headers and \
+                'Last-Modified' not in response.headers:
+            return False
+        body = response.content
+        if len(body) > self.max_size:
+            return False
+        self._store.put(
+            key, (response.url, response.status_code,
+                  json.dumps(dict(response.headers)), sqlite3.Binary(body)),
+            len(body))
+        self.stats.increment('stores')
+        return True
+
+    def revalidated(self, entry, response):
+        '''
+        Build the response to return for a 304 answer to a conditional
+        request made for entry, refreshing the stored validators.
+
+        Returns:
+            requests.Response object with the cached body and the
+            attribute from_cache set to True.
+        '''
+        for name in REVALIDATED_HEADERS:
+            if name in response.headers:
+                entry.headers[name] = response.headers[name]
+        self._store.update(entry.key, headers=json.dumps(dict(entry.headers)))
+        self.stats.increment('hits')
+        self.stats.increment('bytes_saved', len(entry.body))
+
+        cached = requests.Response()
+        cached.status_code = entry.status_code
+        cached.reason = 'OK'
+        cached.headers = CaseInsensitiveDict(entry.headers)
+        cached.encoding = get_encoding_from_headers(cached.headers)
+        cached.url = response.url
+        cached.request = response.request
+        cached.elapsed = response.elapsed
+        cached.connection = getattr(response, 'connection', None)
+        cached._content = entry.body # pylint: disable=protected-access
+        cached._content_consumed = True # pylint: disable=protected-access
+        cached.from_cache = True
+        return cached
+
+    def clear(self):
+        '''Remove all entries.'''
+        self._store.clear()
+
+    def close(self):
+        '''Close the database.'''
+        self._store.close()
@@ -0,0 +1,163 @@
+'''
+common.http.engine
+
+Non-blocking request execution for common.http. The RequestEngine runs http
+functions (http.request, http.request_lxml_html, ...) on a thread pool and
+returns futures, keeping at most max_per_host requests in flight per host
+while many hosts proceed in parallel. Every request still goes through
+http.request and therefore delay_for_host, so the ratelimiter quota is
+honoured - the engine only stops a scraper from idling on network latency.
+
+    futures = [http.async_request(url) for url in urls]
+    pages = http.gather_requests(urls, func=http.request_lxml_html)
+'''
+
+from __future__ import absolute_import
+
+from collections import defaultdict, deque
+import logging
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .reservation import get_host
+
+logger = logging.getLogger(__name__)
+
+
+class RequestEngine(object):
+    '''
+    Thread pool executor with per-host concurrency limits.
+    '''
+    instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_workers=16, max_per_host=4):
+        '''
+        Constructor.
+
+        Args:
+            max_workers: Optional total number of requests in flight.
+            max_per_host: Optional number of requests in flight per host.
+        '''
+        self.is_closed = False
+        self.max_per_host = max_per_host
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._in_flight = defaultdict(int)
+        self._pending = defaultdict(deque)
+
+    @classmethod
+    def get(cls):
+        '''
+        Returns the shared engine instance, creating it if needed.
+        '''
+        with cls._instance_lock:
+            if cls.instance is None or cls.instance.is_closed:
+                cls.instance = cls()
+            return cls.instance
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, func, url, *args, **kwargs):
+        '''
+        Schedule func(url, *args, **kwargs) to run once the host of url has a
+        free slot.
+
+        Returns:
+            concurrent.futures.Future
+        '''
+        future = Future()
+        host = get_host(url)
+        with self._lock:
+            if self.is_closed:
+                raise RuntimeError("RequestEngine is closed.")
+            self._pending[host].append((future, func, url, args, kwargs))
+        self._dispatch(host)
+        return future
+
+    def _dispatch(self, host):
+        with self._lock:
+            if self.is_closed:
+                # queued tasks were failed by close()
+                return
+            if not self._pending[host]:
+                del self._pending[host]
+                if not self._in_flight[host]:
+                    del self._in_flight[host]
+                return
+            if self._in_flight[host] >= self.max_per_host:
+                return
+            self._in_flight[host] += 1
+            task = self._pending[host].popleft()
+        try:
+            self.executor.submit(self._run, host, *task)
+        except RuntimeError:
+            # closed in the meantime
+            with self._lock:
+                self._in_flight[host] -= 1
+            _fail_closed(task[0])
+
+    def _run(self, host, future, func, url, args, kwargs):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = func(url, *args, **kwargs)
+                except Exception as exc: # pylint: disable=broad-except
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+        finally:
+            with self._lock:
+                self._in_flight[host] -= 1
+            self._dispatch(host)
+
+    def gather(self, func, urls, return_exceptions=False, **kwargs):
+        '''
+        Run func(url, **kwargs) for every url and wait for all of them.
+
+        Args:
+            func: Function taking a url as the first argument.
+            urls: Iterable of urls.
+            return_exceptions: Optional, if True exceptions are returned in
+                place of results instead of being raised.
+        Returns:
+            List of results in the same order as urls.
+        Raises:
+            The first exception (in url order) if return_exceptions is False.
+        '''
+        futures = [self.submit(func, url, **kwargs) for url in urls]
+        results = []
+        for future in futures:
+            exc = future.exception()
+            if exc is not None and not return_exceptions:
+                for pending in futures:
+                    pending.cancel()
+                raise exc
+            results.append(exc if exc is not None else future.result())
+        return results
+
+    def close(self, wait=True):
+        '''
+        Shut down the worker threads. Requests that are still queued (not in
+        flight) fail with RuntimeError.
+
+        Args:
+            wait: Optional, wait for in flight requests. Default True.
+        '''
+        with self._lock:
+            self.is_closed = True
+            tasks = [task for queue in self._pending.values() for task in queue]
+            self._pending.clear()
+        for task in tasks:
+            _fail_closed(task[0])
+        self.executor.shutdown(wait=wait)
+
+
+def _fail_closed(future):
+    if future.set_running_or_notify_cancel():
+        future.set_exception(RuntimeError("RequestEngine is closed."))
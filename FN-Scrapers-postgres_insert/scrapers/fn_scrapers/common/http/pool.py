@@ -0,0 +1,224 @@
+'''
+common.http.pool
+
+Connection pooling for http.Session. A ConnectionPool owns the requests
+transport adapters (and therefore the urllib3 connection pools) so that many
+http.Session objects - one per request scope or per thread - share keep-alive
+sockets to the same hosts instead of reconnecting:
+
+    pool = http.ConnectionPool(pool_maxsize=16,
+                               host_pool_sizes={'www.legis.ga.gov': 32})
+    session = http.Session(rl_config=client, connection_pool=pool)
+    ...
+    logger.info("Pool stats: %s", session.pool_stats.as_dict())
+
+Adapters are thread-safe, so a single ConnectionPool is intended to be shared
+by every thread of a scraper.
+'''
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+import logging
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.connectionpool import (
+    HTTPConnectionPool, HTTPSConnectionPool)
+
+try:
+    from hyper.contrib import HTTP20Adapter # github Lukasa/hyper
+except ImportError:
+    HTTP20Adapter = None
+
+logger = logging.getLogger(__name__)
+
+# TCP keep-alive probing, in seconds (idle time, probe interval) and probes.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 15
+KEEPALIVE_COUNT = 4
+
+
+def keepalive_socket_options(idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL,
+                             count=KEEPALIVE_COUNT):
+    '''
+    Socket options enabling TCP keep-alive on top of the urllib3 defaults, so
+    idle pooled sockets survive NAT/load balancer timeouts between requests.
+    Platform specific options are only set where available.
+
+    Returns:
+        list of (level, option, value) tuples.
+    '''
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval),
+                        ('TCP_KEEPCNT', count)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+class PoolStats(object):
+    '''
+    Thread-safe pool hit/miss counters. A hit is a request served on an
+    already-connected socket; a miss required a new connection.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hosts = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    def record(self, host, hit):
+        '''
+        Record a connection checkout.
+
+        Args:
+            host: Host name the connection is for.
+            hit: True if an open socket was reused.
+        '''
+        key = 'hits' if hit else 'misses'
+        with self._lock:
+            setattr(self, key, getattr(self, key) + 1)
+            self.hosts[host][key] += 1
+
+    @property
+    def hit_ratio(self):
+        '''Fraction of checkouts that reused a socket (0.0 if none yet).'''
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def as_dict(self):
+        '''
+        Returns:
+            dictionary snapshot of the counters, suitable for logging.
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hosts': {host: dict(counts) for host, counts in self.hosts.items()},
+            }
+
+
+class _CountingPoolMixin(object):
+    '''
+    urllib3 connection pool mixin recording hits/misses into pool_stats. A
+    connection without a socket is either new or was reset after being
+    dropped by the server - both mean a new TCP (and TLS) handshake.
+    '''
+    pool_stats = None
+
+    def _get_conn(self, timeout=None):
+        conn = super(_CountingPoolMixin, self)._get_conn(timeout=timeout)
+        self.pool_stats.record(self.host, getattr(conn, 'sock', None) is not None)
+        return conn
+
+
+class PooledAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter with keep-alive socket options and hit/miss accounting.
+
+    The adapter is shared between requests.Session objects, so close() is a
+    no-op; the owning ConnectionPool releases the sockets with close_pool().
+    '''
+    def __init__(self, pool_stats, socket_options=None, **kwargs):
+        # set before HTTPAdapter.__init__, which calls init_poolmanager
+        self.pool_stats = pool_stats
+        self.socket_options = socket_options
+        super(PooledAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        if self.socket_options is not None:
+            pool_kwargs['socket_options'] = self.socket_options
+        super(PooledAdapter, self).init_poolmanager(
+            connections, maxsize, block=block, **pool_kwargs)
+        attrs = {'pool_stats': self.pool_stats}
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('CountingHTTPConnectionPool',
+                         (_CountingPoolMixin, HTTPConnectionPool), attrs),
+            'https': type('CountingHTTPSConnectionPool',
+                          (_CountingPoolMixin, HTTPSConnectionPool), attrs),
+        }
+
+    def close(self):
+        pass
+
+    def close_pool(self):
+        '''Closes all pooled connections.'''
+        super(PooledAdapter, self).close()
+
+
+class ConnectionPool(object):
+    '''
+    Shared transport tier for http.Session objects.
+    '''
+    def __init__(self, pool_connections=DEFAULT_POOLSIZE,
+                 pool_maxsize=DEFAULT_POOLSIZE, pool_block=False,
+                 host_pool_sizes=None, keepalive=True, http2_hosts=None):
+        '''
+        Constructor.
+
+        Args:
+            pool_connections: Optional number of hosts to keep pools for.
+            pool_maxsize: Optional number of sockets kept open per host. Should
+                be at least the scraper's thread count.
+            pool_block: Optional, if True threads wait for a free socket
+                instead of opening (and then discarding) extra connections.
+            host_pool_sizes: Optional dictionary of host name to pool_maxsize,
+                overriding pool_maxsize for busy hosts.
+            keepalive: Optional, enables TCP keep-alive probes. Default True.
+            http2_hosts: Optional list of host names to request over HTTP/2.
+                Requires the hyper package; HTTP/1.1 is used if the server
+                does not negotiate HTTP/2.
+        '''
+        self.stats = PoolStats()
+        socket_options = keepalive_socket_options() if keepalive else None
+
+        default = PooledAdapter(
+            self.stats, socket_options, pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self.adapters = {'http://': default, 'https://': default}
+
+        for host, maxsize in (host_pool_sizes or {}).items():
+            adapter = PooledAdapter(
+                self.stats, socket_options, pool_connections=1,
+                pool_maxsize=maxsize, pool_block=pool_block)
+            self.adapters['http://' + host] = adapter
+            self.adapters['https://' + host] = adapter
+
+        if http2_hosts and HTTP20Adapter is None:
+            logger.warning("hyper is not installed, HTTP/2 is disabled.")
+        elif http2_hosts:
+            adapter = HTTP20Adapter()
+            for host in http2_hosts:
+                self.adapters['https://' + host] = adapter
+
+    def mount(self, req_session):
+        '''
+        Mount the shared adapters on a requests.Session object.
+
+        Returns:
+            req_session
+        '''
+        for prefix, adapter in self.adapters.items():
+            req_session.mount(prefix, adapter)
+        return req_session
+
+    def create_requests_session(self):
+        '''
+        Returns:
+            requests.Session object using the shared connection pools.
+        '''
+        return self.mount(requests.Session())
+
+    def close(self):
+        '''Closes all pooled connections.'''
+        for adapter in set(self.adapters.values()):
+            if isinstance(adapter, PooledAdapter):
+                adapter.close_pool()
+            else:
+                adapter.close()
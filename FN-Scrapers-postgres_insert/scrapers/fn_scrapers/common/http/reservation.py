@@ -0,0 +1,114 @@
+'''
+common.http.reservation
+
+Batched ratelimiter permits. A Reservation asks the ratelimiter for permits
+batch_size at a time (one delay_for_host round trip per batch) and hands them
+out locally to delay_for_host, so a crawl of N pages to one host costs N /
+batch_size ratelimiter calls instead of N:
+
+    with http.Session.get().reserve(url, total=len(pages)):
+        for page in pages:
+            http.request(page)
+
+Permits are fetched lazily, so at most one partial batch is left unused when
+the reservation is closed early.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import threading
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def get_host(url):
+    '''
+    Ratelimiter host name for a url. Strings without "/" are assumed to
+    already be host names.
+    '''
+    return urlparse(url).netloc if '/' in url else url
+
+
+class Reservation(object):
+    '''
+    Locally held ratelimiter permits for one host.
+    '''
+    def __init__(self, client, host, total=None, batch_size=50,
+                 on_close=None):
+        '''
+        Constructor.
+
+        Args:
+            client: BlockingRateLimiterClient to reserve permits from.
+            host: Host name to reserve permits for.
+            total: Optional maximum number of permits to hand out. Unbounded
+                (until closed) if not provided.
+            batch_size: Optional number of permits to reserve per round trip.
+            on_close: Optional callback, called with the reservation on close.
+        '''
+        self.client = client
+        self.host = host
+        self.total = total
+        self.batch_size = batch_size
+        self.on_close = on_close
+
+        self.is_closed = False
+        self.available = 0
+        self.reserved = 0
+        self.used = 0
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def acquire(self):
+        '''
+        Take one permit, blocking on the ratelimiter for a new batch if none
+        are available locally.
+
+        Returns:
+            True if a permit was taken, False if the reservation is closed or
+            its total is exhausted (the caller should fall back to a regular
+            delay_for_host call).
+        Raises:
+            HostBlockedError: If the host should not be contacted at all.
+        '''
+        with self._lock:
+            if self.is_closed:
+                return False
+            if not self.available:
+                quantity = self.batch_size
+                if self.total is not None:
+                    quantity = min(quantity, self.total - self.reserved)
+                if quantity <= 0:
+                    return False
+                self.client.delay_for_host(self.host, quantity)
+                self.round_trips += 1
+                self.reserved += quantity
+                self.available = quantity
+            self.available -= 1
+            self.used += 1
+            return True
+
+    def close(self):
+        '''
+        Stop handing out permits. Unused permits are logged, the ratelimiter
+        has already accounted for them.
+        '''
+        with self._lock:
+            if self.is_closed:
+                return
+            self.is_closed = True
+        if self.available:
+            logger.debug("Reservation for %s closed with %s unused permits",
+                         self.host, self.available)
+        logger.debug("Reservation for %s: %s permits used in %s round trips",
+                     self.host, self.used, self.round_trips)
+        if self.on_close:
+            self.on_close(self)
@@ -0,0 +1,287 @@
+'''
+common.http.retry
+
+Shared retry engine with per-host health tracking. Failed requests are
+retried with exponential backoff and full jitter, and every host has a
+circuit breaker: after failure_threshold consecutive failures the host is
+considered down and calls fail fast with HostUnavailableError instead of
+every thread spending minutes in retries. Once reset_timeout has passed a
+single probe request is let through; success closes the circuit, failure
+opens it again for twice as long (up to max_reset_timeout).
+
+    engine = http.RetryEngine(max_attempts=5, failure_threshold=5)
+    session = http.Session(rl_config=client, retry_engine=engine)
+
+scraper_loop and BillScraper.scrape_bills catch HostUnavailableError and
+defer the item to the end of the run (see wait_until_available).
+'''
+
+from __future__ import absolute_import
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+class HostUnavailableError(Exception):
+    '''The circuit breaker for a host is open.'''
+    def __init__(self, host, retry_at, exception=None):
+        super(HostUnavailableError, self).__init__(
+            "Host {} is unavailable, retry after {}".format(
+                host, time.strftime('%H:%M:%S', time.localtime(retry_at))))
+        self.host = host
+        self.retry_at = retry_at
+        self.exception = exception
+
+
+class HostHealth(object):
+    '''Circuit breaker state of one host.'''
+    def __init__(self, host, reset_timeout):
+        self.host = host
+        self.state = CLOSED
+        self.failures = 0
+        self.reset_timeout = reset_timeout
+        self.retry_at = 0
+        self.last_exception = None
+
+    def as_dict(self):
+        '''
+        Returns:
+            dictionary snapshot of the state, suitable for logging.
+        '''
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_at': self.retry_at,
+        }
+
+
+class RetryEngine(object):
+    '''
+    Retry executor and per-host circuit breakers, safe to share between
+    threads and sessions.
+    '''
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0,
+                 max_retry_time=300, failure_threshold=5, reset_timeout=60.0,
+                 max_reset_timeout=900.0, retry_statuses=RETRY_STATUSES):
+        '''
+        Constructor.
+
+        Args:
+            max_attempts: Optional number of attempts per call.
+            base_delay: Optional backoff base in seconds; attempt n waits a
+                random time up to base_delay * 2 ** n.
+            max_delay: Optional maximum backoff in seconds.
+            max_retry_time: Optional maximum seconds spent retrying a call.
+            failure_threshold: Optional number of consecutive failures that
+                opens a host's circuit.
+            reset_timeout: Optional seconds before an open circuit lets a
+                probe request through.
+            max_reset_timeout: Optional maximum reset timeout after repeated
+                failed probes.
+            retry_statuses: Optional HTTP status codes that are retried.
+        '''
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_time = max_retry_time
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.retry_statuses = frozenset(retry_statuses)
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def _health(self, host):
+        health = self.hosts.get(host)
+        if health is None:
+            health = self.hosts[host] = HostHealth(host, self.reset_timeout)
+        return health
+
+    def check(self, host, probe=True):
+        '''
+        Fail fast if host is down. When the reset timeout has passed, the
+        calling thread becomes the probe for the host.
+
+        Args:
+            host: Host name.
+            probe: Optional, if False only checks, without becoming the probe.
+        Raises:
+            HostUnavailableError: If the host's circuit is open.
+        '''
+        with self._lock:
+            health = self._health(host)
+            if health.state == CLOSED:
+                return
+            if health.state == OPEN and time.time() >= health.retry_at:
+                if probe:
+                    logger.info("Probing %s after %.0fs", host,
+                                health.reset_timeout)
+                    health.state = HALF_OPEN
+                return
+            raise HostUnavailableError(
+                host, health.retry_at, exception=health.last_exception)
+
+    def is_available(self, host):
+        '''
+        Returns:
+            False if calls to host currently fail fast.
+        '''
+        with self._lock:
+            health = self.hosts.get(host)
+            return (health is None or health.state == CLOSED or
+                    (health.state == OPEN and time.time() >= health.retry_at))
+
+    def record_success(self, host):
+        '''Mark host healthy, closing its circuit.'''
+        with self._lock:
+            health = self._health(host)
+            if health.state != CLOSED:
+                logger.info("Host %s is available again", host)
+            health.state = CLOSED
+            health.failures = 0
+            health.reset_timeout = self.reset_timeout
+            health.last_exception = None
+
+    def release_probe(self, host):
+        '''
+        End a call that tells nothing about the health of host (it failed
+        before, or without, a response). A probing call leaves the circuit
+        open, so the next call probes again.
+        '''
+        with self._lock:
+            health = self._health(host)
+            if health.state == HALF_OPEN:
+                health.state = OPEN
+
+    def record_failure(self, host, exception=None):
+        '''
+        Count a failed call to host, opening its circuit once
+        failure_threshold consecutive calls failed or a probe failed.
+
+        Returns:
+            True if the circuit is open.
+        '''
+        with self._lock:
+            health = self._health(host)
+            health.failures += 1
+            health.last_exception = exception
+            if health.state == HALF_OPEN:
+                health.reset_timeout = min(
+                    health.reset_timeout * 2, self.max_reset_timeout)
+            elif health.state == CLOSED and \
+                    health.failures < self.failure_threshold:
+                return False
+            if health.state != OPEN:
+                logger.warning(
+                    "Host %s is down after %s failures, failing fast for %.0fs",
+                    host, health.failures, health.reset_timeout)
+            health.state = OPEN
+            health.retry_at = time.time() + health.reset_timeout
+            return True
+
+    def is_retryable(self, exception):
+        '''
+        Returns:
+            True for connection errors, timeouts and retry_statuses responses.
+        '''
+        if isinstance(exception, requests.exceptions.HTTPError):
+            response = exception.response
+            return response is not None and \
+                response.status_code in self.retry_statuses
+        return isinstance(exception, (requests.exceptions.ConnectionError,
+                                      requests.exceptions.Timeout))
+
+    def backoff(self, attempt, exception=None):
+        '''
+        Returns:
+            seconds to wait before retry number attempt (starting at 0): a
+            numeric Retry-After header if the server sent one, otherwise a
+            random time up to base_delay * 2 ** attempt. Never more than
+            max_delay.
+        '''
+        response = getattr(exception, 'response', None)
+        retry_after = response.headers.get('Retry-After') \
+            if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_delay)
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, host, func):
+        '''
+        Run func, retrying retryable failures with backoff.
+
+        Args:
+            host: Host name used for health tracking.
+            func: Function without arguments.
+        Returns:
+            func's return value.
+        Raises:
+            HostUnavailableError: If the host's circuit is (or becomes) open.
+            Exception: func's exception if it is not retryable or retries are
+                exhausted.
+        '''
+        deadline = time.time() + self.max_retry_time
+        attempt = 0
+        while True:
+            self.check(host)
+            try:
+                result = func()
+            except Exception as exc: # pylint: disable=broad-except
+                if not self.is_retryable(exc):
+                    if getattr(exc, 'response', None) is not None:
+                        # the host answered
+                        self.record_success(host)
+                    else:
+                        self.release_probe(host)
+                    raise
+                if self.record_failure(host, exc):
+                    raise HostUnavailableError(
+                        host, self.hosts[host].retry_at, exception=exc)
+                attempt += 1
+                delay = self.backoff(attempt - 1, exc)
+                if attempt >= self.max_attempts or \
+                        time.time() + delay > deadline:
+                    raise
+                logger.debug("Retrying %s in %.1fs (attempt %s): %s",
+                             host, delay, attempt, exc)
+                time.sleep(delay)
+            else:
+                self.record_success(host)
+                return result
+
+    def as_dict(self):
+        '''
+        Returns:
+            dictionary of host to health snapshot for hosts that are not
+            healthy, suitable for logging.
+        '''
+        with self._lock:
+            return {host: health.as_dict() for host, health in self.hosts.items()
+                    if health.state != CLOSED or health.failures}
+
+
+def wait_until_available(errors, max_wait=300):
+    '''
+    Sleep until the hosts of HostUnavailableErrors accept probe requests,
+    at most max_wait seconds. Used before retrying deferred items.
+    '''
+    if not errors:
+        return
+    wait = min(max(error.retry_at for error in errors) - time.time(), max_wait)
+    if wait > 0:
+        logger.info("Waiting %.0fs for unavailable hosts: %s", wait,
+                    ', '.join(sorted(set(error.host for error in errors))))
+        time.sleep(wait)
@@ -4,17 +4,64 @@ from copy import copy
 import json
 import threading
 
-import requests
-
 import fn_ratelimiter_common.config as ratelimiter_config
 from fn_ratelimiter_client.blocking_client import (
     BlockingRateLimiterClientFactory, BlockingRateLimiterClient)
 import fn_ratelimiter_client.blocking_util as rl_util
 
+from .pool import ConnectionPool
+from .reservation import Reservation, get_host
+
+
+class SessionStats(object):
+    '''
+    Thread-safe Session.get counters. A high shared count means several
+    threads funnel their requests through the one global session because
+    per_thread was turned off on the session class.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.local = 0
+        self.shared = 0
+        self.copies = 0
+
+    def increment(self, name, value=1):
+        '''Increment the counter called name.'''
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        '''
+        Returns:
+            dictionary snapshot of the counters, suitable for logging.
+        '''
+        with self._lock:
+            return {
+                'local': self.local,
+                'shared': self.shared,
+                'copies': self.copies,
+            }
+
 
 class Session(object):
+    '''
+    Collection object of HTTP settings and handlers: rate limiter client,
+    requests session and connection pool.
+
+    Session.get() returns the calling thread's session (see create_local),
+    then the global instance. With per_thread set (the default), threads
+    other than the one that set the global instance get their own copy of
+    it, with a separate requests.Session sharing the connection pool and rate
+    limiter client. Copies of a closed session are replaced. To share the
+    global instance (and its requests.Session) between threads instead:
+
+        http.Session.per_thread = False
+    '''
     instance = None
     thread_local = threading.local()
+    per_thread = True
+    stats = SessionStats()
+    _owner = None
     _user_agent = 'FiscalNote/1.0'
     _max_size = 200*1024*1024
 
@@ -36,14 +83,31 @@ class Session(object):
                         client: { disable_rate_limiting bool }
                     }
             req_session: Opional requests.Session object. One will be created
-                if not provided.
+                using connection_pool if not provided.
+            connection_pool: Optional http.ConnectionPool shared with other
+                sessions. A private pool is created if not provided.
+            response_cache: Optional http.ResponseCache used by
+                http.request for conditional revalidation. Disabled if not
+                provided.
             user_agent: Optional User Agent string.
             retry_policy: Optional retry policy (default is standard).
+            retry_engine: Optional http.RetryEngine shared with other
+                sessions. Used by http.request instead of retry_policy, so
+                that requests to a host that is down fail fast.
         '''
         self.is_closed = False
         self.factory = None
         self.client = None
-        self.req_session = req_session or requests.Session()
+        self._parent = None
+        self._worker_local = threading.local()
+        self._worker_sessions = []
+
+        self.connection_pool = kwargs.pop('connection_pool', None)
+        self._owns_pool = self.connection_pool is None
+        if self._owns_pool:
+            self.connection_pool = ConnectionPool()
+        self.req_session = (
+            req_session or self.connection_pool.create_requests_session())
 
         if rl_config is None:
             config = ratelimiter_config.read_config()
@@ -64,10 +128,14 @@ class Session(object):
                 self.factory = BlockingRateLimiterClientFactory(config)
             self.client = self.factory.create_blocking_rate_limiter_client()
 
+        self.reservations = {}
+        self.response_cache = kwargs.pop('response_cache', None)
+
         self.user_agent = kwargs.pop('user_agent', self.__class__._user_agent)
         self.max_size = kwargs.pop('max_size', self.__class__._max_size)
         self.retry_policy = kwargs.pop(
             "retry_policy", rl_util.STANDARD_REQUESTS_RETRY_POLICY)
+        self.retry_engine = kwargs.pop('retry_engine', None)
 
     @classmethod
     def new(cls, *args, **kwargs):
@@ -89,24 +157,34 @@ class Session(object):
             create: Whether to create a session if none exist. If False and
                 no session found, get() returns None.
         Returns:
-            files.Session object, or None if create=False and none exist.
+            http.Session object, or None if create=False and none exist.
         '''
-        if 'http_session' in cls.thread_local.__dict__:
-            if not cls.thread_local.http_session.is_closed:
-                return cls.thread_local.files_session
-        if cls.instance and not cls.instance.is_closed:
-            return cls.instance
+        session = getattr(cls.thread_local, 'http_session', None)
+        if session is not None and not session.is_closed and \
+                (session._parent is None or not session._parent.is_closed):
+            cls.stats.increment('local')
+            return session
+        instance = cls.instance
+        if instance and not instance.is_closed:
+            if threading.current_thread().ident == cls._owner:
+                return instance
+            if cls.per_thread:
+                return instance.create_local()
+            cls.stats.increment('shared')
+            return instance
         if not create:
             return None
         session = cls.load()
-        cls.instance = session
+        session.set_as_instance()
         return session
 
     def set_as_instance(self):
         '''
-        Sets the current object as the global instance.
+        Sets the current object as the global instance, owned by the calling
+        thread.
         '''
         Session.instance = self
+        Session._owner = threading.current_thread().ident
 
     @classmethod
     def load(cls, rl_config=None):
@@ -134,23 +212,113 @@ class Session(object):
     def copy(self, **kwargs):
         '''
         Shallow copies the current config object. Any arguments passed via
-        kwargs will be set to the new object.
+        kwargs will be set to the new object. The copy shares the rate limiter
+        client, reservations and connection pool, which are closed by the
+        original only.
+
+        Returns:
+            http.Session object.
         '''
         new_instance = copy(self)
+        new_instance._parent = self
+        new_instance._worker_local = threading.local()
+        new_instance._worker_sessions = []
         for key in kwargs:
             setattr(new_instance, key, kwargs[key])
+        return new_instance
 
     def create_local(self, **kwargs):
         '''
         Create a thread-local instance of the current session, decoupling the
-        requests.session property.
+        requests.session property: the copy gets its own requests.Session
+        (using the same connection pool) unless req_session is given. The
+        copy becomes the calling thread's Session.get() result.
+
+        Returns:
+            http.Session object.
+        '''
+        if 'req_session' not in kwargs:
+            kwargs['req_session'] = self.create_requests_session()
+        session = self.copy(**kwargs)
+        self.thread_local.http_session = session
+        self.stats.increment('copies')
+        return session
+
+    def create_requests_session(self):
+        '''
+        Returns:
+            new requests.Session using the connection pool of this session.
+        '''
+        return self.connection_pool.create_requests_session()
+
+    def worker_session(self):
+        '''
+        Copy of this session for the calling worker thread (of a
+        RequestEngine, for example), with its own requests.Session using the
+        same connection pool. Created on first use and reused by later calls
+        from the same thread. Unlike create_local, the Session.get() result of
+        the thread is not changed. Worker copies are closed with this session.
+
+        Returns:
+            http.Session object.
+        '''
+        session = getattr(self._worker_local, 'session', None)
+        if session is None or session.is_closed:
+            session = self.copy(req_session=self.create_requests_session())
+            self._worker_local.session = session
+            self._worker_sessions.append(session)
+            self.stats.increment('copies')
+        return session
+
+    def reserve(self, url, total=None, batch_size=50):
+        '''
+        Reserve ratelimiter permits for a host in batches. While the
+        reservation is open, delay_for_host calls for the host (from any copy
+        of this session) are served from it.
+
+        Args:
+            url: URL or host name to reserve permits for.
+            total: Optional number of requests expected. Unbounded if None.
+            batch_size: Optional number of permits per ratelimiter call.
+        Returns:
+            http.Reservation object; close it (or use it as a context manager)
+            when the crawl is done.
+        '''
+        host = get_host(url)
+        if host in self.reservations:
+            self.reservations[host].close()
+        reservation = Reservation(
+            self.client, host, total=total, batch_size=batch_size,
+            on_close=self._remove_reservation)
+        self.reservations[host] = reservation
+        return reservation
+
+    def _remove_reservation(self, reservation):
+        if self.reservations.get(reservation.host) is reservation:
+            del self.reservations[reservation.host]
+
+    @property
+    def pool_stats(self):
+        '''
+        http.PoolStats of the connection pool (shared by all sessions using
+        the same pool).
         '''
-        if 'session' not in kwargs:
-            # TODO: new session, or copy?
-            kwargs['session'] = requests.Session()
-        self.thread_local.http_session = self.copy(**kwargs)
+        return self.connection_pool.stats
 
     def close(self):
         '''Close the current rate limiter client. '''
+        if self.is_closed:
+            return
+        self.is_closed = True
+        for session in self._worker_sessions:
+            session.close()
+        if self._parent is not None:
+            if self.req_session is not self._parent.req_session:
+                self.req_session.close()
+            return
+        for reservation in list(self.reservations.values()):
+            reservation.close()
         self.client.close()
         self.req_session.close()
+        if self._owns_pool:
+            self.connection_pool.close()
@@ -1,23 +1,50 @@
 from __future__ import absolute_import
 
+import os
+import tempfile
+import threading
+import time
+
 import requests
 
-from . import request_html5
+from . import request_html5, gather_requests, delay_for_host
+from .cache import ResponseCache
+from .engine import RequestEngine
+from .pool import ConnectionPool, PoolStats
+from .retry import HostUnavailableError, RetryEngine
 from .session import Session, rl_util
 
 class MockHttpSession(Session):
     def __init__(self, callback):
         self.is_closed = False
         self.client = MockRateLimiterClient()
+        self.callback = callback
         self.req_session = MockRequestsSession(callback=callback)
+        self.connection_pool = ConnectionPool()
+        self._owns_pool = True
+        self._parent = None
+        self._worker_local = threading.local()
+        self._worker_sessions = []
+        self.reservations = {}
+        self.response_cache = None
+        self.retry_engine = None
         self.set_as_instance()
         self.user_agent = self.__class__._user_agent
         self.max_size = self.__class__._max_size
         self.retry_policy = rl_util.STANDARD_REQUESTS_RETRY_POLICY
 
+    def create_requests_session(self):
+        return MockRequestsSession(callback=self.callback)
+
 
 class MockRateLimiterClient(object):
+    def __init__(self):
+        self.calls = []
+
     def delay_for_host(self, *args, **kwargs):
+        self.calls.append(args)
+
+    def close(self):
         pass
 
 class MockRequestsSession(object):
@@ -27,6 +54,9 @@ class MockRequestsSession(object):
     def request(self, *args, **kwargs):
         return self.callback(args, kwargs)
 
+    def close(self):
+        pass
+
 class MockResponse:
     def __init__(self, **kwargs):
         self.content = kwargs.get('content')
@@ -57,3 +87,294 @@ def test_html5_links():
 
     # things that don't work:
     # assert _test(href='://foo.bar/') == 'http://foo.bar/'
+
+def test_gather_requests():
+    '''
+    Results keep url order and no host exceeds max_per_host in flight.
+    '''
+    lock = threading.Lock()
+    active = {}
+    peak = {}
+    def _callback(args, kwargs):
+        host = args[1].split('/')[2]
+        with lock:
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+        time.sleep(0.01)
+        with lock:
+            active[host] -= 1
+        return MockResponse(content=args[1])
+    MockHttpSession(_callback)
+
+    urls = ['http://{}.com/{}'.format(host, i)
+            for i in range(10) for host in ('foo', 'bar')]
+    with RequestEngine(max_workers=8, max_per_host=2) as engine:
+        responses = gather_requests(urls, engine=engine)
+    assert [res.content for res in responses] == urls
+    assert peak == {'foo.com': 2, 'bar.com': 2}
+
+
+def test_request_engine_close():
+    '''
+    Closing the engine fails the requests that are still queued instead of
+    leaving their futures pending.
+    '''
+    started = threading.Event()
+    release = threading.Event()
+    def _slow(url):
+        started.set()
+        release.wait(5)
+        return url
+
+    engine = RequestEngine(max_workers=4, max_per_host=1)
+    futures = [engine.submit(_slow, 'http://foo.com/{}'.format(i))
+               for i in range(5)]
+    started.wait(5)
+    threading.Timer(0.05, release.set).start()
+    engine.close()
+    assert all(future.done() for future in futures)
+    assert futures[0].result() == 'http://foo.com/0'
+    assert all(isinstance(future.exception(), RuntimeError)
+               for future in futures[1:])
+    assert not engine._pending
+    try:
+        engine.submit(_slow, 'http://foo.com/')
+        assert False
+    except RuntimeError:
+        pass
+
+
+def test_gather_requests_worker_sessions():
+    '''
+    Every engine worker thread gets its own copy of the session, with its own
+    requests session, and the copies are closed with the session.
+    '''
+    lock = threading.Lock()
+    used = {}
+    def _request(url, http_session=None):
+        with lock:
+            used.setdefault(threading.current_thread().ident, set()).add(
+                id(http_session.req_session))
+        time.sleep(0.01)
+        return http_session
+    session = MockHttpSession(lambda a, k: MockResponse())
+
+    urls = ['http://foo.com/{}'.format(i) for i in range(20)]
+    with RequestEngine(max_workers=4, max_per_host=4) as engine:
+        sessions = gather_requests(urls, func=_request, engine=engine)
+    assert session not in sessions
+    assert all(len(req_sessions) == 1 for req_sessions in used.values())
+    req_sessions = set.union(*used.values())
+    assert len(req_sessions) == len(used)
+    assert id(session.req_session) not in req_sessions
+
+    session.close()
+    assert all(copy.is_closed for copy in sessions)
+
+
+def test_reservation():
+    '''
+    Reserved permits are fetched in batches and handed out locally.
+    '''
+    session = MockHttpSession(lambda a, k: MockResponse())
+    with session.reserve('http://foo.com/bar', total=5, batch_size=2) as res:
+        for _ in range(6):
+            delay_for_host('http://foo.com/baz')
+        delay_for_host('http://bar.com/baz')
+    assert session.client.calls == [
+        ('foo.com', 2), ('foo.com', 2), ('foo.com', 1),
+        ('foo.com', 1), # total exhausted, regular delay
+        ('bar.com', 1),
+    ]
+    assert res.used == 5
+    assert res.round_trips == 3
+    assert session.reservations == {}
+
+    delay_for_host('http://foo.com/baz')
+    assert session.client.calls[-1] == ('foo.com', 1)
+
+def test_session_registry():
+    '''
+    Worker threads get their own copy of the instance by default, or the
+    shared instance with per_thread turned off; copies do not close shared
+    state.
+    '''
+    assert Session.per_thread
+    session = MockHttpSession(lambda a, k: MockResponse())
+    found = []
+    def _get():
+        found.append(Session.get())
+        found.append(Session.get())
+
+    copies = Session.stats.copies
+    thread = threading.Thread(target=_get)
+    thread.start()
+    thread.join()
+    local = found[0]
+    assert local is found[1] and local is not session
+    assert local.client is session.client
+    assert local.req_session is not session.req_session
+    assert Session.stats.copies == copies + 1
+    assert Session.get() is session
+
+    del found[:]
+    shared = Session.stats.shared
+    Session.per_thread = False
+    try:
+        thread = threading.Thread(target=_get)
+        thread.start()
+        thread.join()
+    finally:
+        Session.per_thread = True
+    assert found == [session, session]
+    assert Session.stats.shared == shared + 2
+
+    local.close()
+    assert local.is_closed and not session.is_closed
+    assert session.copy(user_agent='foo').user_agent == 'foo'
+
+    # a thread's copy of a closed instance is replaced
+    session.create_local()
+    session.close()
+    new_session = MockHttpSession(lambda a, k: MockResponse())
+    assert Session.get() is new_session
+
+def test_retry_engine():
+    '''
+    Retryable failures are retried, repeated failures open the host's
+    circuit and calls fail fast until a probe succeeds.
+    '''
+    engine = RetryEngine(max_attempts=3, base_delay=0, failure_threshold=4,
+                         reset_timeout=0.05)
+    calls = []
+    def _fail():
+        calls.append(1)
+        raise requests.exceptions.ConnectionError('down')
+
+    try:
+        engine.call('foo.com', _fail)
+    except requests.exceptions.ConnectionError:
+        pass
+    assert len(calls) == 3
+    try:
+        engine.call('foo.com', _fail)
+    except HostUnavailableError as exc:
+        assert exc.host == 'foo.com'
+    assert len(calls) == 4
+    assert not engine.is_available('foo.com')
+    assert engine.is_available('bar.com')
+    try:
+        engine.call('foo.com', _fail)
+        assert False
+    except HostUnavailableError:
+        assert len(calls) == 4 # failed fast
+
+    time.sleep(0.06)
+    assert engine.call('foo.com', lambda: 'ok') == 'ok'
+    assert engine.is_available('foo.com') and engine.as_dict() == {}
+
+    def _not_found():
+        response = requests.Response()
+        response.status_code = 404
+        raise requests.exceptions.HTTPError('404', response=response)
+    try:
+        engine.call('foo.com', _not_found)
+    except requests.exceptions.HTTPError:
+        pass
+    assert engine.hosts['foo.com'].failures == 0
+
+    # other errors (e.g. thrift exceptions) neither close nor count against
+    # the circuit, and a probe ending with one leaves it open
+    def _thrift_error():
+        raise ValueError('bad request')
+    for _ in range(4):
+        try:
+            engine.call('foo.com', _fail)
+        except (requests.exceptions.ConnectionError, HostUnavailableError):
+            pass
+    assert not engine.is_available('foo.com')
+    time.sleep(0.06)
+    try:
+        engine.call('foo.com', _thrift_error)
+    except ValueError:
+        pass
+    assert engine.hosts['foo.com'].state == 'open'
+    assert engine.is_available('foo.com')
+    assert engine.call('foo.com', lambda: 'ok') == 'ok'
+    assert engine.hosts['foo.com'].state == 'closed'
+
+def test_connection_pool_mount():
+    '''
+    Sessions created from one pool share adapters, with per-host sizing.
+    '''
+    pool = ConnectionPool(pool_maxsize=4, host_pool_sizes={'foo.com': 32})
+    first = pool.create_requests_session()
+    second = pool.create_requests_session()
+
+    adapter = first.get_adapter('https://bar.com/baz')
+    assert adapter is second.get_adapter('http://bar.com/baz')
+    assert adapter._pool_maxsize == 4
+    host_adapter = first.get_adapter('https://foo.com/bar')
+    assert host_adapter is second.get_adapter('https://foo.com/bar')
+    assert host_adapter._pool_maxsize == 32
+
+    # closing a requests session must not close the shared pools
+    adapter.poolmanager.connection_from_url('https://bar.com/baz')
+    first.close()
+    assert len(adapter.poolmanager.pools) == 1
+    pool.close()
+    assert len(adapter.poolmanager.pools) == 0
+
+def test_pool_stats():
+    stats = PoolStats()
+    stats.record('foo.com', False)
+    stats.record('foo.com', True)
+    stats.record('foo.com', True)
+    stats.record('bar.com', False)
+    assert stats.hits == 2
+    assert stats.misses == 2
+    assert stats.hit_ratio == 0.5
+    assert stats.as_dict()['hosts']['foo.com'] == {'hits': 2, 'misses': 1}
+
+def _response(status_code=200, content='', headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = 'http://foo.com/bar'
+    response.headers.update(headers or {})
+    response._content = content
+    return response
+
+def test_response_cache():
+    '''
+    Responses with validators are stored, revalidated, and evicted LRU.
+    '''
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        cache = ResponseCache(path, max_size=10)
+        key = cache.key('GET', 'http://foo.com/bar')
+        assert key != cache.key('POST', 'http://foo.com/bar', data={'a': 1})
+        assert cache.get(key) is None
+
+        assert not cache.store(key, _response(content='abc'))
+        assert cache.store(key, _response(content='abcdef', headers={
+            'ETag': '"1"', 'Content-Type': 'text/html; charset=utf-8'}))
+        entry = cache.get(key)
+        assert entry.conditional_headers() == {'If-None-Match': '"1"'}
+
+        cached = cache.revalidated(entry, _response(304, headers={'ETag': '"2"'}))
+        assert cached.content == 'abcdef'
+        assert cached.text == u'abcdef'
+        assert cached.from_cache
+        assert cache.get(key).headers['ETag'] == '"2"'
+        assert cache.stats.bytes_saved == 6
+
+        other = cache.key('GET', 'http://foo.com/baz')
+        cache.store(other, _response(content='ghijkl', headers={
+            'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT'}))
+        assert cache.get(key) is None
+        assert cache.get(other).body == 'ghijkl'
+        assert cache.stats.evictions == 1
+        cache.close()
+    finally:
+        os.remove(path)
@@ -0,0 +1,183 @@
+'''
+common.sqlite_cache
+
+Size-bounded sqlite store shared by the on-disk caches (http.ResponseCache,
+files.ExtractionCache). Every entry has a key, the cache's own columns, a
+size and an access time; entries are evicted least-recently-used first once
+their total size exceeds max_size:
+
+    store = LRUStore(path, 'responses', (('body', 'BLOB NOT NULL'),),
+                     max_size=256*1024*1024, stats=CacheStats())
+    store.put(key, (sqlite3.Binary(body),), len(body))
+    row = store.get(key, ('body',))
+'''
+
+from __future__ import absolute_import
+
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+
+class CacheStats(object):
+    '''Thread-safe cache counters.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def increment(self, name, value=1):
+        '''Increment the counter called name.'''
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        '''
+        Returns:
+            dictionary snapshot of the counters, suitable for logging.
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes_saved': self.bytes_saved,
+                'stores': self.stores,
+                'evictions': self.evictions,
+            }
+
+
+def _check_private(path):
+    # create the file readable and writable by its owner only, and refuse
+    # one that somebody else could have written
+    os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or \
+            info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ValueError(
+            'Cache file {} must be owned by and only writable by the current '
+            'user.'.format(path))
+
+
+class LRUStore(object):
+    '''
+    sqlite table with least-recently-used eviction, safe to share between
+    threads.
+    '''
+    def __init__(self, path, table, columns, max_size, stats=None,
+                 private=False):
+        '''
+        Constructor.
+
+        Args:
+            path: sqlite database file (created if missing).
+            table: Table name.
+            columns: Sequence of (name, sqlite type) tuples of the values
+                stored besides the key, size and access time.
+            max_size: Maximum total size of the entries in bytes.
+            stats: Optional CacheStats counting evictions.
+            private: Optional, if True the file must be owned by and only
+                writable by the current user, e.g. because the stored values
+                are unpickled. Raises ValueError otherwise.
+        '''
+        if private:
+            _check_private(path)
+        self.path = path
+        self.table = table
+        self.columns = tuple(name for name, _ in columns)
+        self.max_size = max_size
+        self.stats = stats or CacheStats()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, {}, '
+            'size INTEGER NOT NULL, accessed_at REAL NOT NULL)'.format(
+                table, ', '.join(
+                    '{} {}'.format(name, type_) for name, type_ in columns)))
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS {0}_accessed_at '
+            'ON {0} (accessed_at)'.format(table))
+        self._conn.commit()
+
+    def get(self, key, columns=None):
+        '''
+        Look up an entry, marking it as recently used.
+
+        Args:
+            columns: Optional column names to return. Defaults to all columns.
+        Returns:
+            tuple of the column values, or None if key is not stored.
+        '''
+        columns = columns or self.columns
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT {} FROM {} WHERE key = ?'.format(
+                    ', '.join(columns), self.table), (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                'UPDATE {} SET accessed_at = ? WHERE key = ?'.format(self.table),
+                (time.time(), key))
+            self._conn.commit()
+        return row
+
+    def put(self, key, values, size):
+        '''
+        Store (or replace) an entry and evict least recently used entries
+        while the total size exceeds max_size.
+
+        Args:
+            values: Values of all the columns, in order.
+            size: Size of the entry in bytes.
+        '''
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO {} (key, {}, size, accessed_at) '
+                'VALUES (?, {}?, ?)'.format(
+                    self.table, ', '.join(self.columns),
+                    '?, ' * len(self.columns)),
+                (key,) + tuple(values) + (size, time.time()))
+            self._evict()
+            self._conn.commit()
+
+    def update(self, key, **values):
+        '''Update columns of an entry, without marking it as used.'''
+        names = sorted(values)
+        with self._lock:
+            self._conn.execute(
+                'UPDATE {} SET {} WHERE key = ?'.format(
+                    self.table, ', '.join(name + ' = ?' for name in names)),
+                tuple(values[name] for name in names) + (key,))
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM {}'.format(self.table)).fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self._conn.execute(
+            'SELECT key, size FROM {} ORDER BY accessed_at'.format(self.table)).fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        self._conn.executemany(
+            'DELETE FROM {} WHERE key = ?'.format(self.table), evicted)
+        self.stats.increment('evictions', len(evicted))
+
+    def clear(self):
+        '''Remove all entries.'''
+        with self._lock:
+            self._conn.execute('DELETE FROM {}'.format(self.table))
+            self._conn.commit()
+
+    def close(self):
+        '''Close the database.'''
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,25 @@
+from fn_scrapers.common.cpu import CpuExecutor, findall_task, xpath_task
+
+HTML = '<html><body><a href="/a">A</a><p>foo <b>bar</b></p></body></html>'
+
+def test_xpath_task():
+    res = xpath_task(HTML, {'links': '//a/@href', 'text': '//p',
+                            'count': 'count(//a)'}, base_url='http://foo.com/')
+    assert res == {'links': [u'http://foo.com/a'], 'text': [u'foo bar'],
+                   'count': 1.0}
+    assert type(res['links'][0]) is unicode
+    res = xpath_task(HTML, {'links': '//a/@href'}, base_url='http://foo.com/',
+                     html5=True)
+    assert res == {'links': [u'http://foo.com/a']}
+
+def test_cpu_executor():
+    with CpuExecutor(max_workers=2) as executor:
+        assert executor.submit(xpath_task, HTML, {'b': '//b/text()'}).result() \
+            == {'b': [u'bar']}
+        assert executor.map(findall_task, [r'\d', r'[a-z]'], ['a1b2', 'a1']) \
+            == [['1', '2'], ['a']]
+
+    # inline mode
+    executor = CpuExecutor(max_workers=0)
+    future = executor.submit(findall_task, r'(', 'a')
+    assert future.done() and future.exception() is not None
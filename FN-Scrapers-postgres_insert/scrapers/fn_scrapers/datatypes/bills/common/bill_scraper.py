@@ -29,6 +29,7 @@ from fn_scrapers.api.resources import (
     ScraperRequestModule,
 )
 from fn_scrapers.api.scrape_item_publisher import ScrapeItemPublisher
+from fn_scrapers.common.http import HostUnavailableError, wait_until_available
 
 from fn_scraperutils.scraper import Scraper
 from fn_scraperutils.config import Config
@@ -148,6 +149,9 @@ def create_subrequest_handler_desc(thread_pool, scraper_cls):
             self.logger_state = logger_state
 
         def scrape_bill(self, session, bill_id, *args, **kwargs):
+            # With defer_unavailable, a HostUnavailableError is returned (not
+            # raised) so that scrape_bills can retry the bill at the end.
+            defer_unavailable = kwargs.pop('defer_unavailable', False)
             try:
                 inst = self.inj.get(scraper_cls)
                 with self.logger_state.set_request_contexts({
@@ -156,6 +160,10 @@ def create_subrequest_handler_desc(thread_pool, scraper_cls):
                 }) as ctx:
                     logger.info("Scraping bill '%s' under request context: request=%s", bill_id, ctx["request"])
                     return inst.scrape_bill_with_error_check(session, bill_id, *args, **kwargs)
+            except HostUnavailableError as e:
+                if defer_unavailable:
+                    return e
+                raise MessageFailedError(traceback.format_exc())
             except:
                 raise MessageFailedError(traceback.format_exc())
 
@@ -349,47 +357,83 @@ class BillScraper(object):
     def scrape_bills(self, session, session_bills):
         """
         Scrape all the bills in the bill_ids list, catching any exceptions thrown by critical errors.
+
+        Bills that fail because their host is down (http.HostUnavailableError) are deferred and
+        retried once after all other bills.
         """
         sorted_bill_ids = sorted(session_bills.keys())
         if self.args.concurrency == 1:
-            for bill_id in sorted_bill_ids:
-                try:
-                    with self.logger_state.set_request_contexts({
-                        "request": str(uuid.uuid4()),
-                        "scraper_external_id": bill_id
-                    }) as ctx:
-                        logger.info("Scraping bill '%s' under request context: request=%s", bill_id, ctx["request"])
-                        self.scrape_bill_with_error_check(session, bill_id, bill_info=session_bills[bill_id])
-                except Exception as e:
-                    traceback.print_exc()
-                    self.scraper.send_failed_event(self.locality, e, trace=traceback.format_exc(), obj_id=bill_id)
-                    continue
+            deferred = self._scrape_bills_sequential(session, session_bills, sorted_bill_ids, True)
+            if deferred:
+                wait_until_available(deferred.values())
+                self._scrape_bills_sequential(session, session_bills, sorted(deferred), False)
         else:
             from fn_service.components.direct import RequestContext
             with thread_pool_blocking(self.reactor, self.args.concurrency) as thread_pool:
                 handler_desc = create_subrequest_handler_desc(thread_pool, self.__class__)
                 handler = self.direct_handler_creator.create_blocking_direct_handler_factory(handler_desc) \
                     .create_handler()
-                results = []
-
-                for bill_id in sorted_bill_ids:
-                    result = handler.scrape_bill(RequestContext(
-                        args=(session, bill_id),
-                        kwargs=dict(bill_info=session_bills[bill_id]),
-                        request_modules=[
-                            ScraperRequestModule(self.session_start_time_raw, self.scraper_tags),
-                            SubrequestModule(
-                                self.logger_state.component,
-                                self.process_id,
-                                self.logger_state.request_id)]))
-                    results.append((bill_id, result))
-
-                for bill_id, result in results:
-                    try:
-                        result.get()
-                    except Exception as e:
-                        traceback.print_exc()
-                        self.scraper.send_failed_event(self.locality, e, trace=traceback.format_exc(), obj_id=bill_id)
+
+                def _scrape_bills_concurrent(bill_ids, defer_unavailable):
+                    results = []
+                    for bill_id in bill_ids:
+                        result = handler.scrape_bill(RequestContext(
+                            args=(session, bill_id),
+                            kwargs=dict(bill_info=session_bills[bill_id],
+                                        defer_unavailable=defer_unavailable),
+                            request_modules=[
+                                ScraperRequestModule(self.session_start_time_raw, self.scraper_tags),
+                                SubrequestModule(
+                                    self.logger_state.component,
+                                    self.process_id,
+                                    self.logger_state.request_id)]))
+                        results.append((bill_id, result))
+
+                    deferred = {}
+                    for bill_id, result in results:
+                        try:
+                            value = result.get()
+                        except Exception as e:
+                            traceback.print_exc()
+                            self.scraper.send_failed_event(self.locality, e, trace=traceback.format_exc(), obj_id=bill_id)
+                        else:
+                            if isinstance(value, HostUnavailableError):
+                                logger.info("Deferred bill '%s': %s", bill_id, value)
+                                deferred[bill_id] = value
+                    return deferred
+
+                deferred = _scrape_bills_concurrent(sorted_bill_ids, True)
+                if deferred:
+                    wait_until_available(deferred.values())
+                    _scrape_bills_concurrent(sorted(deferred), False)
+
+    def _scrape_bills_sequential(self, session, session_bills, bill_ids, defer_unavailable):
+        """
+        Scrape bills one at a time.
+
+        :return: Dictionary of bill id to HostUnavailableError for deferred bills
+        """
+        deferred = {}
+        for bill_id in bill_ids:
+            try:
+                with self.logger_state.set_request_contexts({
+                    "request": str(uuid.uuid4()),
+                    "scraper_external_id": bill_id
+                }) as ctx:
+                    logger.info("Scraping bill '%s' under request context: request=%s", bill_id, ctx["request"])
+                    self.scrape_bill_with_error_check(session, bill_id, bill_info=session_bills[bill_id])
+            except HostUnavailableError as e:
+                if not defer_unavailable:
+                    traceback.print_exc()
+                    self.scraper.send_failed_event(self.locality, e, trace=traceback.format_exc(), obj_id=bill_id)
+                    continue
+                logger.info("Deferred bill '%s': %s", bill_id, e)
+                deferred[bill_id] = e
+            except Exception as e:
+                traceback.print_exc()
+                self.scraper.send_failed_event(self.locality, e, trace=traceback.format_exc(), obj_id=bill_id)
+                continue
+        return deferred
 
     def scrape_bill(self, session, bill_id, **kwargs):
         raise NotImplementedError('Bill Scrapers must define a scrape_bill method')
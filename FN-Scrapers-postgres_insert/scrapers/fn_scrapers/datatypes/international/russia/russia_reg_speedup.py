@@ -69,9 +69,10 @@ class RussiaSpeedupScraper(object):
                 json=request_data)
             if len(api_response["items"]) == 0:
                 break
-            for item in api_response["items"]:
-                page_url = urljoin('https://rg.ru/api/search/', item["uri"])
-                doc = http.request_html5(page_url)
+            page_urls = [urljoin('https://rg.ru/api/search/', item["uri"])
+                         for item in api_response["items"]]
+            docs = http.gather_requests(page_urls, func=http.request_html5)
+            for page_url, doc in zip(page_urls, docs):
                 doc_links = doc.xpath('//a[@target="_blank" and contains(@href, ".pdf")]/@href')
                 if doc_links:
                     for doc_link in doc_links:
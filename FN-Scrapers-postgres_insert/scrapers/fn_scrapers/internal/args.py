@@ -38,6 +38,24 @@ def _configure_parser(parser):
     p.add_argument("scheduler_name", help="The name the scheduler should use - must be unique per server")
     p.add_argument("--serve-until", help=argparse.SUPPRESS)
     p.add_argument("--scraper-working-dir", help=argparse.SUPPRESS)
+    p.add_argument(
+        "--legacy-acquire",
+        action="store_true",
+        help="Acquire work by locking and examining every schedule, instead of using the precomputed "
+             "next start times")
+    p.add_argument(
+        "--slots",
+        type=int,
+        default=1,
+        help="The number of scrapers this scheduler may run at the same time")
+    p.add_argument(
+        "--max-rss",
+        type=int,
+        help="With --slots, don't start more scrapers while the running ones use this much memory (MB)")
+    p.add_argument(
+        "--max-cpu",
+        type=float,
+        help="With --slots, don't start more scrapers while the running ones use this many CPU cores")
 
     p = command_subparser.add_parser("upload", help="Upload schedules into the database from schedules.yaml")
     p.set_defaults(command=("fn_scrapers.internal.cmd_scheduler_upload", "upload_schedules"))
@@ -12,6 +12,7 @@ from fn_service.util.postgres import create_pg_engine
 
 from .config import get_config
 from .schedule import Schedule, PG_NOW
+from .schedule_notify import EVENT_KILL, notify
 
 
 def kill_scraper(args):
@@ -26,6 +27,9 @@ def kill_scraper(args):
             sys.exit(3)
         if not schedule.kill_immediately:
             schedule.kill_immediately = True
+            # Have the scheduler running the scraper kill it now, rather than
+            # on the scraper's next ping
+            notify(session, EVENT_KILL, schedule.scraper_name)
         else:
             print(u"{} already marked for death".format(args.scraper_name))
         session.commit()
@@ -12,6 +12,7 @@ from fn_service.util.postgres import create_pg_engine
 
 from .config import get_config
 from .schedule import Schedule, PG_NOW
+from .schedule_notify import EVENT_CHANGED, notify
 from .scheduler_util import is_schedule_running, schedule_name
 
 
@@ -34,4 +35,8 @@ def schedule_scrape(args):
                 sys.exit(3)
             if schedule.run_immediately is None:
                 schedule.run_immediately = PG_NOW
+        # Have the scheduler recompute when the scraper can start
+        schedule.next_can_start_at = None
+        schedule.next_should_start_at = None
+        notify(session, EVENT_CHANGED, schedule.scraper_name)
         session.commit()
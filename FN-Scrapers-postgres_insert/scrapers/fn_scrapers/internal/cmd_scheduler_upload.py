@@ -16,6 +16,7 @@ from fn_service.util.postgres import create_pg_engine, update_list, EntityManage
 from .duration_format import format_duration, parse_duration
 from .find_scrapers import ScraperNotFound, get_scraper_class_by_name
 from .schedule import Schedule
+from .schedule_notify import EVENT_CHANGED, notify
 from .config import get_config
 
 
@@ -94,6 +95,9 @@ def _sync_db(dry_run, no_output, schedule_names, schedule_file, on_modified_obj,
             if any(bool(attr.history.added) or bool(attr.history.deleted) for attr in inspect(obj).attrs):
                 changes[0] = True
                 on_modified_obj(context.is_new, obj)
+                # Have the scheduler recompute when the scraper can start
+                obj.next_can_start_at = None
+                obj.next_should_start_at = None
 
         def _delete_func(obj):
             changes[0] = True
@@ -111,6 +115,8 @@ def _sync_db(dry_run, no_output, schedule_names, schedule_file, on_modified_obj,
             delete_db_obj_func=_delete_func)
 
         if not dry_run:
+            if changes[0]:
+                notify(session, EVENT_CHANGED)
             session.commit()
 
     if not no_output and not changes[0]:
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+import contextlib
+import threading
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from .schedule import Schedule, ScheduleHeartbeat, PG_NOW
+
+
+# The running work was marked to be killed
+SIGNAL_KILL = "kill"
+
+# The running work was stolen by another scheduler, or its schedule was deleted
+SIGNAL_STOLEN = "stolen"
+
+
+class HeartbeatBatcher(object):
+    """
+    Coalesce the pings of all the workers that a scheduler runs into a single
+    UPDATE of the schedule_heartbeats table per interval, instead of locking
+    and updating each worker's schedule row every time it pings.
+
+    The same statement returns, for each work tag, whether the work was marked
+    to be killed or is no longer owned by us. Those signals are handed back to
+    the worker's next ping.
+    """
+    def __init__(self, session_maker, log, interval):
+        """
+        :param interval: The number of seconds between writes
+        """
+        self.session_maker = session_maker
+        self.log = log
+        self.interval = interval
+        self.is_closed = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # work tag -> the signal from the last write (None if nothing is wrong)
+        self._signals = {}
+        # work tags that pinged since the last write
+        self._pending = set()
+        self._thread = None
+        self._closing = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="heartbeat-batcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """
+        Stop the background thread, then write the pings that are still pending.
+        """
+        self.is_closed = True
+        self._closing.set()
+        if self._thread is not None:
+            self._thread.join(self.interval)
+        self.flush()
+
+    def add(self, tag):
+        with self._lock:
+            self._signals[tag] = None
+
+    def remove(self, tag):
+        with self._lock:
+            self._signals.pop(tag, None)
+            self._pending.discard(tag)
+
+    def ping(self, tag):
+        """
+        Record a ping, to be written with the next batch.
+
+        :return: None, SIGNAL_KILL or SIGNAL_STOLEN, as of the last write
+        """
+        with self._lock:
+            self._pending.add(tag)
+            return self._signals.get(tag)
+
+    def flush(self, all_tags=False):
+        """
+        Write the pending pings and update the signals.
+
+        :param all_tags: If True, write (and check) all running work, not just
+            the work that pinged since the last write.
+        """
+        with self._flush_lock:
+            with self._lock:
+                tags = set(self._signals) if all_tags else self._pending & set(self._signals)
+                self._pending = set()
+            if not tags:
+                return
+
+            heartbeats = ScheduleHeartbeat.__table__
+            schedules = Schedule.__table__
+            try:
+                with contextlib.closing(self.session_maker()) as session:
+                    # Joining the schedules makes work that was stolen (or
+                    # whose schedule was deleted) drop out of the result.
+                    rows = session.execute(
+                        heartbeats.update()
+                        .values(last_ping_at=PG_NOW)
+                        .where(heartbeats.c.owner_tag.in_(tags))
+                        .where(schedules.c.owner_tag == heartbeats.c.owner_tag)
+                        .returning(heartbeats.c.owner_tag, schedules.c.kill_immediately)).fetchall()
+                    session.commit()
+            except SQLAlchemyError:
+                self.log.critical(__name__, "work_update_failed", "Failed to ping work", exc_info=True)
+                # We don't retry here - the pings are written with the next batch
+                with self._lock:
+                    self._pending.update(tags)
+                return
+
+            kill = {tag: kill_immediately for tag, kill_immediately in rows}
+            with self._lock:
+                for tag in tags:
+                    if tag not in self._signals:
+                        # The work finished in the meantime
+                        continue
+                    if tag not in kill:
+                        self._signals[tag] = SIGNAL_STOLEN
+                    elif kill[tag]:
+                        self._signals[tag] = SIGNAL_KILL
+                    else:
+                        self._signals[tag] = None
+
+    def _run(self):
+        while not self.is_closed:
+            self._closing.wait(self.interval)
+            if self.is_closed:
+                # close() writes the last batch
+                return
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                self.log.critical(__name__, "work_update_failed", "Failed to ping work", exc_info=True)
@@ -0,0 +1,102 @@
+from __future__ import absolute_import, division
+
+import threading
+import time
+
+from .resource_process import read_proc_stats
+
+
+# The minimum number of seconds over which the CPU usage of a worker is measured
+MIN_CPU_SAMPLE_TIME = 1
+
+
+class NodeResources(object):
+    """
+    Track the CPU and memory used by the workers that a multi-slot scheduler
+    is running, so that it only starts more work while the node has room for it.
+
+    Workers are ResourceProcess objects. Usage includes the processes that the
+    workers start. CPU usage is measured as the number of cores used since the
+    previous check. A worker that was started with a footprint (the resources
+    its scraper usually needs) counts as using at least that much, so that a
+    worker that is still starting up doesn't make the node look idle.
+    """
+    def __init__(self, max_rss=None, max_cpu=None):
+        """
+        :param max_rss: The maximum resident memory of all workers, in KB. None for no limit.
+        :param max_cpu: The maximum number of cores used by all workers. None for no limit.
+        """
+        self.max_rss = max_rss
+        self.max_cpu = max_cpu
+        self._lock = threading.Lock()
+        self._workers = {}
+        self._footprints = {}
+        self._cpu_samples = {}
+
+    @property
+    def is_limited(self):
+        return self.max_rss is not None or self.max_cpu is not None
+
+    def add(self, slot, process, footprint=None):
+        """
+        :param footprint: Optional dict with the "rss" (KB) and "cpu" (cores)
+            that the worker is expected to use.
+        """
+        with self._lock:
+            self._workers[slot] = process
+            self._footprints[slot] = footprint
+            self._cpu_samples.pop(slot, None)
+
+    def remove(self, slot):
+        with self._lock:
+            self._workers.pop(slot, None)
+            self._footprints.pop(slot, None)
+            self._cpu_samples.pop(slot, None)
+
+    def usage(self):
+        """
+        :return: A dict with "workers", "rss" (KB) and "cpu" (cores) used by all running workers.
+        """
+        with self._lock:
+            if not self._workers:
+                return {"workers": 0, "rss": 0, "cpu": 0.0}
+            proc_stats = read_proc_stats()
+            now = time.time()
+            rss = 0
+            cpu = 0.0
+            for slot, process in self._workers.items():
+                current = process.current_usage(proc_stats)
+                if current is None:
+                    continue
+                footprint = self._footprints.get(slot) or {"rss": 0, "cpu": 0.0}
+                rss += max(current["rss"], footprint["rss"])
+                sampled_at, sampled_cpu, rate = self._cpu_samples.get(slot, (None, None, 0.0))
+                if sampled_at is None or now - sampled_at >= MIN_CPU_SAMPLE_TIME:
+                    # CPU time is counted in clock ticks, so the rate over short
+                    # intervals is too noisy - keep the previous one instead.
+                    if sampled_at is not None:
+                        rate = max(current["cpu"] - sampled_cpu, 0) / (now - sampled_at)
+                    self._cpu_samples[slot] = (now, current["cpu"], rate)
+                cpu += max(rate, footprint["cpu"])
+            return {"workers": len(self._workers), "rss": rss, "cpu": cpu}
+
+    def has_capacity(self, footprint=None):
+        """
+        :param footprint: Optional dict with the "rss" (KB) and "cpu" (cores)
+            that the worker to start is expected to use.
+        :return: True if another worker may be started. A worker may always be
+            started if none are running, so that a limit that is set too low
+            (or a scraper that needs more than it) can't stop the scheduler
+            from making any progress.
+        """
+        if not self.is_limited:
+            return True
+        usage = self.usage()
+        if not usage["workers"]:
+            return True
+        footprint = footprint or {"rss": 0, "cpu": 0.0}
+        for resource, limit in (("rss", self.max_rss), ("cpu", self.max_cpu)):
+            if limit is not None and (
+                    usage[resource] >= limit or usage[resource] + footprint[resource] > limit):
+                return False
+        return True
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import errno
 import os
+import resource
 import signal
 import time
 
@@ -10,6 +11,38 @@ import subprocess32 as subprocess
 from .unix_util import eintr_retry_call
 
 
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+_PAGE_SIZE_KB = resource.getpagesize() // 1024
+
+
+def read_proc_stats():
+    """
+    Read the parent pid, CPU time and resident memory of every process from /proc.
+
+    :return: A dict of pid to (ppid, CPU seconds, RSS in KB). Empty if /proc isn't available.
+    """
+    stats = {}
+    try:
+        pids = [int(p) for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return stats
+    for pid in pids:
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                stat = f.read()
+        except IOError:
+            # The process exited
+            continue
+        # The command name may contain spaces, so split after it. Fields
+        # are numbered as in proc(5), starting at 3 (state).
+        fields = stat[stat.rindex(")") + 2:].split()
+        stats[pid] = (
+            int(fields[1]),
+            (int(fields[11]) + int(fields[12])) / float(_CLOCK_TICKS),
+            int(fields[21]) * _PAGE_SIZE_KB)
+    return stats
+
+
 class ResourceProcess(object):
     """
     Wrap a subprocess.Process object to give it a new feature - we wait
@@ -77,6 +110,39 @@ class ResourceProcess(object):
                 else:
                     time.sleep(1)
 
+    def current_usage(self, proc_stats=None):
+        """
+        Get the resources currently used by the running child process and its
+        descendants (eg, process pools the scraper started). Unlike resource_usage,
+        which is only available once the child exits, this reads /proc.
+
+        :param proc_stats: Optional result of read_proc_stats() to use, so that
+            the usage of several processes can be computed from one read of /proc.
+        :return: A dict with "cpu" (user + system CPU seconds) and "rss" (resident
+            memory in KB), or None if the child has exited.
+        """
+        if self._child_exited:
+            return None
+        if proc_stats is None:
+            proc_stats = read_proc_stats()
+        if self.pid not in proc_stats:
+            return None
+
+        children = {}
+        for pid, (ppid, _, _) in proc_stats.items():
+            children.setdefault(ppid, []).append(pid)
+
+        cpu = 0.0
+        rss = 0
+        pending = [self.pid]
+        while pending:
+            pid = pending.pop()
+            _, pid_cpu, pid_rss = proc_stats[pid]
+            cpu += pid_cpu
+            rss += pid_rss
+            pending.extend(children.get(pid, []))
+        return {"cpu": cpu, "rss": rss}
+
     def poll(self):
         try:
             self.wait(timeout=0)
@@ -69,11 +69,31 @@ def _min_non_none(*values):
     return min(x for x in values if x is not None)
 
 
-def _monitor_worker(log, monitor_period, event_set, r, process, worker_name, ping_func):
+def _set_non_blocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+def _drain(fd):
+    # Read everything from a non-blocking pipe
+    while True:
+        try:
+            if not os.read(fd, 1024):
+                return
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+
+def _monitor_worker(log, monitor_period, event_set, r, process, worker_name, ping_func, wakeup_fd=None):
     # We need the read half of the pipe to be in non-blocking mode. Otherwise,
     # if we try to read from the pipe and there is no data there, we'll hang
     # forever which defeats the point of trying to check if the child is hung.
-    fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+    _set_non_blocking(r)
+    read_fds = [r]
+    if wakeup_fd is not None:
+        _set_non_blocking(wakeup_fd)
+        read_fds.append(wakeup_fd)
 
     ping_by = time.time() + monitor_period
     while True:
@@ -85,7 +105,7 @@ def _monitor_worker(log, monitor_period, event_set, r, process, worker_name, pin
         now = time.time()
         timeout = _min_non_none(ping_by - now, event_set.time_until_next(now))
         timeout = max(0, timeout)
-        select.select([r], [], [r], timeout)
+        readable, _, _ = select.select(read_fds, [], [r], timeout)
 
         now = time.time()
 
@@ -138,6 +158,14 @@ def _monitor_worker(log, monitor_period, event_set, r, process, worker_name, pin
             ping_by = now + monitor_period
 
             ping_func()
+        elif wakeup_fd in readable:
+            # We were asked to check on the work without waiting for the next
+            # ping - eg, because it was marked to be killed.
+            log.debug(__name__, fmt("Checking on {}", worker_name))
+            ping_func()
+
+        if wakeup_fd in readable:
+            _drain(wakeup_fd)
 
         if now > ping_by:
             # timeout occured - kill the worker
@@ -197,7 +225,9 @@ def run_worker(
         ping_time,
         worker_name,
         events,
-        ping_func):
+        ping_func,
+        on_start=None,
+        wakeup_fd=None):
     event_set = _EventSet(events)
 
     # Try to start the child processse the pipe!
@@ -230,6 +260,9 @@ def run_worker(
 
         log.info(__name__, fmt(u"{} running with pid {}".format(worker_name, process.pid)))
 
+        if on_start is not None:
+            on_start(process)
+
         try:
             # Close the write half of the pipe - we won't be writing to the pipe,
             # just reading.
@@ -241,7 +274,7 @@ def run_worker(
             closing_fds.remove_all(config_fds)
             CloseFds(config_fds).close()
 
-            _monitor_worker(log, monitor_period, event_set, r, process, worker_name, ping_func)
+            _monitor_worker(log, monitor_period, event_set, r, process, worker_name, ping_func, wakeup_fd)
         finally:
             if process.poll() is None:
                 process.kill()
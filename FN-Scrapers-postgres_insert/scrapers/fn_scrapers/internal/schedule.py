@@ -1,8 +1,9 @@
 from __future__ import absolute_import
 
-from sqlalchemy import func, Column, String, BigInteger, DateTime, Boolean
+from sqlalchemy import func, Column, Index, String, BigInteger, DateTime, Boolean, Float
 from sqlalchemy.dialects.postgresql import UUID, JSONB, INTERVAL
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql.expression import text
 
 
 PG_NOW = func.NOW()
@@ -13,6 +14,9 @@ BASE = declarative_base()
 class Schedule(BASE):
     __tablename__ = "schedules"
     __table_args__ = (
+        Index(
+            'schedules_next_start_idx', 'next_should_start_at', 'next_can_start_at', 'scraper_name',
+            postgresql_where=text('owner_tag IS NULL')),
         {'schema': 'fnscrapers'},
     )
 
@@ -103,12 +107,63 @@ class Schedule(BASE):
     owner_name = Column(String)
     owner_tag = Column(UUID(as_uuid=True))
     owner_start_at = Column(DateTime(True))
+    # only set when work is acquired - later pings go to ScheduleHeartbeat
     owner_last_ping_at = Column(DateTime(True))
 
     # If this is non-NULL, it means that someone is trying
-    # to steal the task. If this goes too long without getting
-    # set back to NULL, it means that its ok to steal it.
+    # to steal the task. If this goes too long without the owner
+    # pinging, it means that its ok to steal it.
     steal_start_at = Column(DateTime(True))
 
+    # The can_start_by/should_start_by values of get_schedule_start_times(),
+    # computed when a run ends. The scheduler uses these to find the next
+    # work to run without examining every schedule. NULL means that they need
+    # to be (re)computed - eg, the schedule is new or was modified.
+    next_can_start_at = Column(DateTime(True))
+    next_should_start_at = Column(DateTime(True))
+
     created_at = Column(DateTime(True), default=PG_NOW, nullable=False)
     updated_at = Column(DateTime(True), default=PG_NOW, onupdate=PG_NOW, nullable=False)
+
+
+class ScheduleHeartbeat(BASE):
+    """
+    The last time that the worker running a schedule pinged its scheduler.
+    Kept out of the schedules table so that pings, which schedulers write in
+    batches, don't lock or rewrite schedule rows.
+    """
+    __tablename__ = "schedule_heartbeats"
+    __table_args__ = {'schema': 'fnscrapers'}
+
+    owner_tag = Column(UUID(as_uuid=True), primary_key=True)
+    scraper_name = Column(String, nullable=False)
+    last_ping_at = Column(DateTime(True), nullable=False)
+
+
+class ScraperRun(BASE):
+    """
+    The resources used by one run of a scraper - recorded by the scheduler
+    when the worker process exits.
+    """
+    __tablename__ = "scraper_runs"
+    __table_args__ = (
+        Index('scraper_runs_scraper_name_end_at_idx', 'scraper_name', 'end_at'),
+        {'schema': 'fnscrapers'},
+    )
+
+    id = Column(BigInteger, primary_key=True)
+
+    scraper_name = Column(String, nullable=False)
+
+    owner_node = Column(String, nullable=False)
+    owner_name = Column(String, nullable=False)
+    owner_tag = Column(UUID(as_uuid=True), nullable=False)
+
+    start_at = Column(DateTime(True), nullable=False)
+    end_at = Column(DateTime(True), default=PG_NOW, nullable=False)
+    returncode = Column(BigInteger)
+
+    # From the worker's rusage. maxrss is in KB; utime and stime are CPU seconds.
+    maxrss = Column(BigInteger)
+    utime = Column(Float)
+    stime = Column(Float)
@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+
+import json
+import select
+import threading
+import time
+
+from sqlalchemy import func, select as sql_select
+
+from fn_service.server import fmt
+
+
+# Schedulers LISTEN on CHANNEL. Anything that changes what schedulers should be
+# doing - work completing or failing, schedules being uploaded or scheduled to
+# run immediately, scrapers being killed - NOTIFYs it so that schedulers
+# don't have to wait for their next poll to notice.
+CHANNEL = "fnscrapers_schedules"
+
+# A schedule may have become runnable
+EVENT_CHANGED = "changed"
+
+# A running scraper was marked to be killed
+EVENT_KILL = "kill"
+
+# How long to wait for notifications before checking that the connection
+# still works
+KEEPALIVE_TIME = 60
+
+# How long to wait before reconnecting after the connection failed
+RECONNECT_TIME = 10
+
+
+def notify(session, event, scraper_name=None):
+    """
+    Notify the schedulers when the session's transaction is committed.
+
+    :param event: EVENT_CHANGED or EVENT_KILL
+    :param scraper_name: The scraper the event is about, or None if it is about several
+    """
+    payload = json.dumps({"event": event, "scraper_name": scraper_name})
+    session.execute(sql_select([func.pg_notify(CHANNEL, payload)]))
+
+
+class ScheduleListener(object):
+    """
+    Listen for notifications on CHANNEL on a dedicated connection in a
+    background thread.
+
+    Waiters compare generations: the generation is incremented on every
+    notification (and after reconnecting, since notifications may have been
+    missed), so a notification that arrives while a waiter is busy checking
+    the DB isn't lost.
+    """
+    def __init__(self, engine, log):
+        self.engine = engine
+        self.log = log
+        self.generation = 0
+        self.is_closed = False
+        self._cond = threading.Condition()
+        self._callbacks = []
+        self._thread = None
+
+    def add_callback(self, callback):
+        """
+        :param callback: Called with (event, scraper_name) from the listener thread
+            for every notification.
+        """
+        self._callbacks.append(callback)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="schedule-listener")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self.is_closed = True
+
+    def wait(self, generation, timeout):
+        """
+        Wait until there was a notification since generation was read.
+
+        :return: True if notified, False if the timeout expired
+        """
+        with self._cond:
+            if self.generation == generation:
+                self._cond.wait(timeout)
+            return self.generation != generation
+
+    def _wake(self):
+        with self._cond:
+            self.generation += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while not self.is_closed:
+            try:
+                self._listen()
+            except Exception:  # pylint: disable=broad-except
+                self.log.warning(
+                    __name__, "listen_failed",
+                    fmt(u"Listening for schedule notifications failed. Reconnecting in {}s", RECONNECT_TIME),
+                    exc_info=True)
+                time.sleep(RECONNECT_TIME)
+
+    def _listen(self):
+        # The connection is detached from the pool since it is switched to
+        # autocommit mode, which LISTEN needs, and is never given back.
+        fairy = self.engine.raw_connection()
+        fairy.detach()
+        conn = fairy.connection
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute("LISTEN {}".format(CHANNEL))
+            # Notifications sent while we weren't listening are lost
+            self._wake()
+            while not self.is_closed:
+                if not select.select([conn], [], [], KEEPALIVE_TIME)[0]:
+                    cursor.execute("SELECT 1")
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    while conn.notifies:
+                        self._handle(conn.notifies.pop(0).payload)
+                    self._wake()
+        finally:
+            conn.close()
+
+    def _handle(self, payload):
+        try:
+            notification = json.loads(payload)
+            event, scraper_name = notification["event"], notification["scraper_name"]
+        except (ValueError, KeyError, TypeError):
+            self.log.warning(__name__, "bad_notification", fmt(u"Ignoring notification: {}", payload))
+            return
+        for callback in self._callbacks:
+            try:
+                callback(event, scraper_name)
+            except Exception:  # pylint: disable=broad-except
+                self.log.warning(__name__, "notification_failed", "Failed to handle notification", exc_info=True)
@@ -7,18 +7,25 @@ from datetime import datetime, timedelta
 import platform
 import uuid
 import json
+import os
+import sys
+import threading
 import time
 import pytz
 
 from fn_service.components.dispatcher import run_in_new_thread
 from fn_service.server import fmt, BlockingAppStatus, ServerShutdown, BlockingEventLogger, watchdog
 
+from sqlalchemy import and_, extract, func, literal_column, or_
 from sqlalchemy.exc import SQLAlchemyError
 
-from fn_scrapers.api.resources import ScraperDbSessionMaker, ScraperArguments
+from fn_scrapers.api.resources import ScraperDb, ScraperDbSessionMaker, ScraperArguments
 
-from .schedule import Schedule, PG_NOW
+from .schedule import Schedule, ScheduleHeartbeat, ScraperRun, PG_NOW
 from .scheduler_util import get_schedule_start_times, get_schedule_events, schedule_name
+from .heartbeat import HeartbeatBatcher, SIGNAL_KILL, SIGNAL_STOLEN
+from .node_resources import NodeResources
+from .schedule_notify import EVENT_CHANGED, EVENT_KILL, ScheduleListener, notify
 from .run_and_monitor_scraper import run_worker, WorkerFailed, WorkerTerminated
 
 
@@ -52,11 +59,32 @@ STEAL_TIME = PING_TIME * 2
 # steal. STEAL_DELAY configures this duration.
 STEAL_DELAY = PING_TIME * 10
 
+# HEARTBEAT_TIME is how often the pings of all of the workers of a scheduler
+# are written to the DB, in one batch. Kill and steal signals reach a worker
+# on its first ping after the batch that found them.
+HEARTBEAT_TIME = PING_TIME // 4
+
+# CAPACITY_CHECK_TIME is how long a slot of a multi-slot scheduler waits before
+# checking again whether the node has room to run another scraper.
+CAPACITY_CHECK_TIME = 10
+
+# A scraper's footprint - the memory and CPU it is expected to use - is the
+# FOOTPRINT_PERCENTILE of what its last FOOTPRINT_RUNS runs used. A multi-slot
+# scheduler with resource limits only starts a scraper if its footprint fits
+# in what is left on the node.
+FOOTPRINT_RUNS = 20
+FOOTPRINT_PERCENTILE = 0.95
+
 
 class WorkStolen(Exception):
     pass
 
 
+# Raised in the slots of a multi-slot scheduler once another slot failed.
+class SlotsStopping(Exception):
+    pass
+
+
 def _convert_events(events):
     from . import scheduler_util
     from . import run_and_monitor_scraper
@@ -77,6 +105,119 @@ def _convert_events(events):
     ]
 
 
+def _clear_next_start_times(schedule):
+    schedule.next_can_start_at = None
+    schedule.next_should_start_at = None
+
+
+def _not_excluded():
+    # exclude_nodes is a JSON array - or, for schedules uploaded as a JSON encoded
+    # string, a string that we search the same way as the Python code does.
+    return ~or_(
+        Schedule.exclude_nodes.has_key(NODE),
+        and_(func.jsonb_typeof(Schedule.exclude_nodes) == 'string',
+             func.strpos(Schedule.exclude_nodes.op('#>>')('{}'), NODE) > 0))
+
+
+def _unowned_schedules(session):
+    """
+    Query for schedules that this node may run and that aren't running.
+    """
+    return session.query(Schedule)\
+        .filter(Schedule.owner_tag.is_(None))\
+        .filter(or_(Schedule.enabled, Schedule.run_immediately.isnot(None)))\
+        .filter(_not_excluded())
+
+
+def _last_ping_at():
+    # Use with an outer join of ScheduleHeartbeat on the owner tag. Work that
+    # hasn't been pinged yet has no heartbeat and NULLs are ignored by GREATEST.
+    return func.greatest(Schedule.owner_last_ping_at, ScheduleHeartbeat.last_ping_at)
+
+
+def _join_heartbeats(query):
+    return query.outerjoin(ScheduleHeartbeat, ScheduleHeartbeat.owner_tag == Schedule.owner_tag)
+
+
+def _has_stealable_work(session, now):
+    """
+    Whether a schedule owned by another scheduler has stopped pinging the DB
+    and could be stolen by this node.
+    """
+    stealable_after = now - timedelta(seconds=STEAL_TIME)
+    steal_complete_after = now - timedelta(seconds=STEAL_DELAY)
+    return _join_heartbeats(session.query(Schedule.id))\
+        .filter(Schedule.owner_tag.isnot(None))\
+        .filter(_last_ping_at() <= stealable_after)\
+        .filter(or_(Schedule.steal_start_at.is_(None), Schedule.steal_start_at <= steal_complete_after))\
+        .filter(or_(Schedule.enabled, Schedule.run_immediately.isnot(None)))\
+        .filter(_not_excluded())\
+        .first() is not None
+
+
+def _next_work_query(session, now, skipped=None):
+    """
+    Query for the most deserving runnable schedule, locking it and skipping rows
+    locked by other schedulers.
+
+    :param skipped: Optional names of schedules to leave out
+    """
+    candidates = _unowned_schedules(session)\
+        .filter(or_(Schedule.next_can_start_at.is_(None), Schedule.next_can_start_at <= now))
+    if skipped:
+        candidates = candidates.filter(~Schedule.scraper_name.in_(skipped))
+    # with_for_update(skip_locked=True) needs SQLAlchemy 1.1; the suffix is
+    # rendered after FOR UPDATE.
+    return candidates\
+        .order_by(
+            Schedule.next_should_start_at.asc().nullsfirst(),
+            Schedule.next_can_start_at.asc().nullsfirst(),
+            Schedule.scraper_name)\
+        .with_for_update()\
+        .suffix_with("SKIP LOCKED")\
+        .limit(1)
+
+
+def _footprint_query(session, scraper_name):
+    """
+    Query for the FOOTPRINT_PERCENTILE of the memory (KB) and CPU (cores) used by
+    the last FOOTPRINT_RUNS recorded runs of a scraper.
+    """
+    duration = extract('epoch', ScraperRun.end_at - ScraperRun.start_at)
+    recent_runs = session.query(
+            ScraperRun.maxrss.label('rss'),
+            ((ScraperRun.utime + ScraperRun.stime) / func.nullif(duration, 0)).label('cpu'))\
+        .filter(ScraperRun.scraper_name == scraper_name)\
+        .filter(ScraperRun.maxrss.isnot(None))\
+        .order_by(ScraperRun.end_at.desc())\
+        .limit(FOOTPRINT_RUNS)\
+        .subquery('recent_runs')
+    # ordered-set aggregates (within_group) need SQLAlchemy 1.1
+    percentile = "percentile_cont({}) WITHIN GROUP (ORDER BY recent_runs.{})"
+    return session.query(
+            literal_column(percentile.format(FOOTPRINT_PERCENTILE, 'rss')),
+            literal_column(percentile.format(FOOTPRINT_PERCENTILE, 'cpu')))\
+        .select_from(recent_runs)
+
+
+def _get_footprint(session, scraper_name):
+    """
+    Get the memory and CPU that a scraper is expected to use, from its recent runs.
+
+    :return: A dict with "rss" (KB) and "cpu" (cores), or None if no runs were recorded
+    """
+    rss, cpu = _footprint_query(session, scraper_name).one()
+    if rss is None:
+        return None
+    return {"rss": int(rss), "cpu": cpu or 0.0}
+
+
+def _delete_heartbeat(session, tag):
+    session.query(ScheduleHeartbeat)\
+        .filter(ScheduleHeartbeat.owner_tag == tag)\
+        .delete(synchronize_session=False)
+
+
 @attr.s
 class ScheduleWithTimes(object):
     can_start_by = attr.ib()
@@ -95,20 +236,36 @@ class Scheduler(object):
     @injector.inject(
         bbs=BlockingAppStatus,
         log=BlockingEventLogger,
+        db=ScraperDb,
         session_maker=ScraperDbSessionMaker,
         args=ScraperArguments)
-    def __init__(self, bbs, log, session_maker, args):
+    def __init__(self, bbs, log, db, session_maker, args):
         self.bbs = bbs
         self.log = log
         self.session_maker = session_maker
         self.args = args
-
-    def _mark_work(self, now, schedule):
+        self.heartbeats = HeartbeatBatcher(session_maker, log, HEARTBEAT_TIME)
+        self.listener = ScheduleListener(db, log)
+        self.listener.add_callback(self._on_notification)
+        # scraper name -> write end of the pipe that wakes up the monitor of its worker
+        self._wakeup_fds = {}
+        self._wakeup_lock = threading.Lock()
+        # Set when a slot failed - the other slots kill their workers and exit
+        self._stopping = threading.Event()
+        self.node_resources = NodeResources(
+            max_rss=args.max_rss * 1024 if args.max_rss else None,
+            max_cpu=args.max_cpu)
+
+    def _mark_work(self, session, now, schedule, last_ping_at=None):
         # NOTE: we have to pass "now" into this function explicitly since if we
         # set attributes with PG_NOW, they will be left in an expired state
         # when we commit (regardless of if we set expire_on_commit or not).
-        if schedule.owner_tag is not None and schedule.steal_start_at is None:
+        if schedule.owner_tag is not None and (
+                schedule.steal_start_at is None or
+                (last_ping_at is not None and last_ping_at > schedule.steal_start_at)):
             # The work is owned, but stealable. So, mark the start of a steal period.
+            # Pings don't reset steal_start_at, so if the owner pinged since a
+            # previous steal period started, that one is abandoned and we start over.
             schedule.steal_start_at = now
             self.log.debug(__name__, "Starting to steal")
             return None
@@ -120,12 +277,14 @@ class Scheduler(object):
             schedule.failure_count = schedule.failure_count + 1 if schedule.failure_count else 1
             schedule.last_start_at = schedule.owner_start_at
             schedule.last_end_at = now
+            _delete_heartbeat(session, schedule.owner_tag)
             schedule.owner_node = None
             schedule.owner_name = None
             schedule.owner_tag = None
             schedule.owner_start_at = None
             schedule.owner_last_ping_at = None
             schedule.steal_start_at = None
+            _clear_next_start_times(schedule)
             return None
         else:
             # The work is elligable to run - so, run it!
@@ -137,37 +296,22 @@ class Scheduler(object):
             schedule.owner_last_ping_at = now
             schedule.steal_start_at = None
             schedule.run_immediately = None
+            session.add(ScheduleHeartbeat(owner_tag=tag, scraper_name=schedule.scraper_name, last_ping_at=now))
             self.log.debug(__name__, "Marked row as ready to start")
             return tag
 
     def _ping_work(self, tag, schedule):
-        try:
-            with contextlib.closing(self.session_maker()) as session:
-                s = session\
-                    .query(Schedule)\
-                    .filter(Schedule.scraper_name == schedule.scraper_name)\
-                    .with_for_update()\
-                    .one_or_none()
-                if s is None:
-                    # This is weird - stuff shouldn't generally get deleted
-                    # If this occurs, we exit since we can't ping the db anymore
-                    self.log.critical(__name__, "work_stolen", "Schedule Deleted. Killing scraper")
-                    raise WorkStolen()
-                elif s.owner_tag == tag:
-                    s.owner_last_ping_at = PG_NOW
-                    s.steal_start_at = None
-                    session.commit()
-                    if s.kill_immediately:
-                        self.log.warning(__name__, "killing_scraper", fmt("Killing {}", schedule.scraper_name))
-                        s.kill_immediately = False
-                        session.commit()
-                        raise WorkerFailed()
-                else:
-                    self.log.critical(__name__, "work_stolen", "Work stolen. Killing scraper")
-                    raise WorkStolen()
-        except SQLAlchemyError:
-            self.log.critical(__name__, "work_update_failed", "Failed to ping work", exc_info=True)
-            # We don't retry here - we'll retry the next time the worker pings us
+        # The ping itself is written by the HeartbeatBatcher - here we act on
+        # what it found the last time it wrote.
+        if self._stopping.is_set():
+            raise SlotsStopping()
+        signal = self.heartbeats.ping(tag)
+        if signal == SIGNAL_STOLEN:
+            self.log.critical(__name__, "work_stolen", "Work stolen or schedule deleted. Killing scraper")
+            raise WorkStolen()
+        elif signal == SIGNAL_KILL:
+            self.log.warning(__name__, "killing_scraper", fmt("Killing {}", schedule.scraper_name))
+            raise WorkerFailed()
 
     def _complete_work(self, tag, schedule):
         # Yay - worker finished. We retry in a loop until we can update the
@@ -187,6 +331,7 @@ class Scheduler(object):
                         self.log.debug(__name__, "Couldn't get schedule row")
                         break
                     elif s.owner_tag == tag:
+                        _delete_heartbeat(session, tag)
                         s.last_good_start_at = s.owner_start_at
                         s.last_good_end_at = now
                         s.last_start_at = s.owner_start_at
@@ -219,6 +364,8 @@ class Scheduler(object):
                         s.owner_start_at = None
                         s.owner_last_ping_at = None
                         s.steal_start_at = None
+                        self._set_next_start_times(now, s)
+                        notify(session, EVENT_CHANGED, s.scraper_name)
 
                         session.commit()
 
@@ -237,6 +384,8 @@ class Scheduler(object):
         while True:
             try:
                 with contextlib.closing(self.session_maker()) as session:
+                    now = session.query(PG_NOW).scalar()
+
                     s = session\
                         .query(Schedule)\
                         .filter(Schedule.scraper_name == schedule.scraper_name)\
@@ -247,10 +396,13 @@ class Scheduler(object):
                         self.log.debug(__name__, "Couldn't get schedule row")
                         break
                     elif s.owner_tag == tag:
+                        _delete_heartbeat(session, tag)
                         if increment_failures:
                             s.failure_count = s.failure_count + 1 if s.failure_count else 1
+                        # If the scraper was killed, it's done
+                        s.kill_immediately = False
                         s.last_start_at = s.owner_start_at
-                        s.last_end_at = PG_NOW
+                        s.last_end_at = now
 
                         s.owner_node = None
                         s.owner_name = None
@@ -258,6 +410,8 @@ class Scheduler(object):
                         s.owner_start_at = None
                         s.owner_last_ping_at = None
                         s.steal_start_at = None
+                        self._set_next_start_times(now, s)
+                        notify(session, EVENT_CHANGED, s.scraper_name)
 
                         session.commit()
                         
@@ -268,70 +422,232 @@ class Scheduler(object):
                         self.log.debug(__name__, "Schedule seems to have been stolen")
                         break
             except SQLAlchemyError:
+                if self._stopping.is_set():
+                    # Don't hold up the shutdown - the work gets stolen once
+                    # its heartbeats stop.
+                    self.log.critical(__name__, "work_update_failed", "Failed to release work.", exc_info=True)
+                    return
                 self.log.critical(__name__, "work_update_failed", "Failed to complete work. Will retry.", exc_info=True)
                 time.sleep(5)
 
+    def _set_next_start_times(self, now, schedule):
+        # Precompute the start times used by _acquire_next_work. If that fails,
+        # the columns are cleared and the acquiring scheduler computes them.
+        try:
+            schedule.next_can_start_at, schedule.next_should_start_at = \
+                get_schedule_start_times(now, schedule)
+        except Exception:  # pylint: disable=broad-except
+            self.log.warning(
+                __name__, "next_start_times_failed",
+                fmt(u"Failed to compute start times for {}", schedule.scraper_name), exc_info=True)
+            _clear_next_start_times(schedule)
+
+    def _on_notification(self, event, scraper_name):
+        # Called from the listener thread. Waiters in _sleep_until_notified are
+        # woken up by the listener itself - here we only need to wake up the
+        # monitor of a worker that should be killed.
+        if event != EVENT_KILL:
+            return
+        with self._wakeup_lock:
+            if scraper_name not in self._wakeup_fds:
+                return
+        # Get the kill signal now, rather than with the next batch
+        self.heartbeats.flush(all_tags=True)
+        with self._wakeup_lock:
+            wakeup_fd = self._wakeup_fds.get(scraper_name)
+            if wakeup_fd is not None:
+                os.write(wakeup_fd, b"k")
+
+    def _sleep_until_notified(self, generation, timeout):
+        """
+        Sleep until timeout expires, a notification was received since
+        generation was read from the listener, or the server shuts down.
+
+        :raises SlotsStopping: If another slot failed
+        """
+        deadline = time.time() + timeout
+        while True:
+            self.bbs.sleep_until_shutdown(0)
+            if self._stopping.is_set():
+                raise SlotsStopping()
+            remaining = deadline - time.time()
+            # Wake up at least once a second to check for shutdown
+            if remaining <= 0 or self.listener.wait(generation, min(remaining, 1)):
+                return
+
     def _do_acquire_work(self):
         sleep_time = 0
+        # Schedules that are due but that don't fit in the node's remaining
+        # resources. Skipped until the next time we sleep.
+        skipped = set()
+        generation = self.listener.generation
         while True:
-            # Sleep until the next time we should check for work to run
-            self.bbs.sleep_until_shutdown(sleep_time)
+            # Sleep until the next time we should check for work to run, or
+            # until something changes
+            self._sleep_until_notified(generation, sleep_time)
+            generation = self.listener.generation
 
-            # Go get all the schedules to examine
             with contextlib.closing(self.session_maker(expire_on_commit=False)) as session:
-                schedules = session.query(Schedule).with_for_update().all()
-
                 now = session.query(PG_NOW).scalar()
 
-                # Items that haven't been pinged since this time are elligable to be run.
-                stealable_after = now - timedelta(seconds=STEAL_TIME)
-                steal_complete_after = now - timedelta(seconds=STEAL_DELAY)
-
-                def is_eligible(s):
-                    return NODE not in s.exclude_nodes and\
-                        (s.enabled or s.run_immediately is not None) and\
-                        (s.owner_tag is None or s.owner_last_ping_at <= stealable_after) and\
-                        (s.steal_start_at is None or s.steal_start_at <= steal_complete_after)
-
-                # Filter out schedules we aren't eligable to run
-                eligible_schedules = [s for s in schedules if is_eligible(s)]
-
-                # Find the work most deserving of being run and try to mark it as running by us
-                if not eligible_schedules:
-                    self.log.debug(__name__, "No schedules eligible to run.")
-                    sleep_time = 60
+                # Stealing work from crashed schedulers is rare and needs the
+                # full algorithm, as does running with --legacy-acquire.
+                if self.args.legacy_acquire or _has_stealable_work(session, now):
+                    session.rollback()
+                    result, sleep_time = self._acquire_work_by_scan(session)
                 else:
-                    # Calculate the next start times for all eligible schedules.
-                    schedules_with_times = [ScheduleWithTimes.create(now, s) for s in eligible_schedules]
-
-                    # Sort eligible schedules by their can_start_by values
-                    by_availability = sorted(
-                        schedules_with_times,
-                        key=lambda x: (x.can_start_by, x.schedule.scraper_name))
-
-                    next_available = by_availability[0]
-
-                    if next_available.can_start_by > now:
-                        self.log.debug(
-                            __name__,
-                            fmt(u"{} is next to run, but in the future", next_available.schedule.scraper_name))
-                        sleep_time = min((next_available.can_start_by - now).total_seconds(), 60)
-                    else:
-                        # Sort runnable schedules by their should_start_by values
-                        by_need = sorted(
-                            (s for s in schedules_with_times if s.can_start_by <= now),
-                            key=lambda x: (x.should_start_by, x.can_start_by, x.schedule.scraper_name))
+                    result, sleep_time = self._acquire_next_work(session, now, skipped)
+                if result is not None:
+                    tag, schedule, footprint = result
+                    return now, tag, schedule, footprint
+                if sleep_time > 0:
+                    skipped.clear()
+
+    def _check_footprint(self, session, schedule):
+        """
+        :return: A two-tuple of (whether the schedule's scraper fits in the resources
+            left on this node, its footprint)
+        """
+        if not self.node_resources.is_limited:
+            return True, None
+        footprint = _get_footprint(session, schedule.scraper_name)
+        return self.node_resources.has_capacity(footprint), footprint
+
+    def _acquire_next_work(self, session, now, skipped):
+        """
+        Acquire the most deserving runnable schedule using the precomputed
+        next_can_start_at/next_should_start_at columns. Only the candidate row
+        is locked, and rows locked by other schedulers are skipped, so several
+        schedulers can acquire work at the same time.
+
+        :param skipped: Names of schedules not to run since they don't fit on this
+            node. Schedules that don't fit are added to it.
+        :return: A two-tuple of ((tag, schedule, footprint) or None, seconds to sleep)
+        """
+        schedule = _next_work_query(session, now, skipped).one_or_none()
+
+        if schedule is None and skipped:
+            session.rollback()
+            self.log.debug(__name__, "Not enough resources left to run any due schedules.")
+            return None, CAPACITY_CHECK_TIME
+
+        if schedule is None:
+            next_can_start_at = _unowned_schedules(session)\
+                .with_entities(func.min(Schedule.next_can_start_at))\
+                .scalar()
+            session.rollback()
+            if next_can_start_at is None:
+                self.log.debug(__name__, "No schedules eligible to run.")
+                return None, 60
+            return None, min(max((next_can_start_at - now).total_seconds(), 0), 60)
+
+        # The stored times don't account for a blackout period that started
+        # since they were computed (and are missing for new or modified
+        # schedules), so check them before running anything.
+        was_computed = schedule.next_can_start_at is not None
+        with_times = ScheduleWithTimes.create(now, schedule)
+        schedule.next_can_start_at = with_times.can_start_by
+        schedule.next_should_start_at = with_times.should_start_by
+
+        if not was_computed or with_times.can_start_by > now:
+            # Re-run the query - the schedule may not be next in line anymore
+            session.commit()
+            return None, 0
+
+        fits, footprint = self._check_footprint(session, schedule)
+        if not fits:
+            self.log.debug(__name__, fmt(u"Not enough resources left to run {}", schedule.scraper_name))
+            skipped.add(schedule.scraper_name)
+            session.commit()
+            return None, 0
+
+        self.log.debug(__name__, fmt(u"Attempting run {}", schedule.scraper_name))
+
+        tag = self._mark_work(session, now, schedule)
+        session.commit()
+        if tag is None:
+            return None, 0
+        return (tag, schedule, footprint), 0
+
+    def _acquire_work_by_scan(self, session):
+        """
+        Acquire work by locking and examining every schedule. Handles stealing
+        work from crashed schedulers.
+
+        :return: A two-tuple of ((tag, schedule, footprint) or None, seconds to sleep)
+        """
+        # Go get all the schedules to examine
+        rows = _join_heartbeats(session.query(Schedule, _last_ping_at()))\
+            .with_for_update(of=Schedule)\
+            .all()
+        schedules = [s for s, _ in rows]
+        last_ping_ats = {s.id: last_ping_at for s, last_ping_at in rows}
+
+        now = session.query(PG_NOW).scalar()
+
+        # Items that haven't been pinged since this time are elligable to be run.
+        stealable_after = now - timedelta(seconds=STEAL_TIME)
+        steal_complete_after = now - timedelta(seconds=STEAL_DELAY)
+
+        def is_eligible(s):
+            return NODE not in s.exclude_nodes and\
+                (s.enabled or s.run_immediately is not None) and\
+                (s.owner_tag is None or last_ping_ats[s.id] <= stealable_after) and\
+                (s.steal_start_at is None or s.steal_start_at <= steal_complete_after)
+
+        # Filter out schedules we aren't eligable to run
+        eligible_schedules = [s for s in schedules if is_eligible(s)]
+
+        # Find the work most deserving of being run and try to mark it as running by us
+        if not eligible_schedules:
+            self.log.debug(__name__, "No schedules eligible to run.")
+            session.rollback()
+            return None, 60
+
+        # Calculate the next start times for all eligible schedules.
+        schedules_with_times = [ScheduleWithTimes.create(now, s) for s in eligible_schedules]
+
+        # Sort eligible schedules by their can_start_by values
+        by_availability = sorted(
+            schedules_with_times,
+            key=lambda x: (x.can_start_by, x.schedule.scraper_name))
+
+        next_available = by_availability[0]
+
+        if next_available.can_start_by > now:
+            self.log.debug(
+                __name__,
+                fmt(u"{} is next to run, but in the future", next_available.schedule.scraper_name))
+            session.rollback()
+            return None, min((next_available.can_start_by - now).total_seconds(), 60)
+
+        # Sort runnable schedules by their should_start_by values
+        by_need = sorted(
+            (s for s in schedules_with_times if s.can_start_by <= now),
+            key=lambda x: (x.should_start_by, x.can_start_by, x.schedule.scraper_name))
+
+        # Take the most deserving schedule that fits on this node. Stealing
+        # doesn't run anything, so stealable schedules always fit.
+        for candidate in by_need:
+            schedule = candidate.schedule
+            if schedule.owner_tag is not None:
+                footprint = None
+                break
+            fits, footprint = self._check_footprint(session, schedule)
+            if fits:
+                break
+        else:
+            self.log.debug(__name__, "Not enough resources left to run any due schedules.")
+            session.rollback()
+            return None, CAPACITY_CHECK_TIME
 
-                        schedule = by_need[0].schedule
+        self.log.debug(__name__, fmt(u"Attempting run {}", schedule.scraper_name))
 
-                        self.log.debug(__name__, fmt(u"Attempting run {}", schedule.scraper_name))
-
-                        tag = self._mark_work(now, schedule)
-                        session.commit()
-                        if tag is not None:
-                            return now, tag, schedule
-                        else:
-                            sleep_time = 0
+        tag = self._mark_work(session, now, schedule, last_ping_ats[schedule.id])
+        session.commit()
+        if tag is None:
+            return None, 0
+        return (tag, schedule, footprint), 0
 
     def _acquire_work(self):
         while True:
@@ -340,30 +656,157 @@ class Scheduler(object):
             except SQLAlchemyError:
                 self.log.critical(__name__, "mark_work", "Failed to mark work", exc_info=True)
 
-    def _invoke_scraper(self, now, tag, schedule):
+    def _wait_for_capacity(self, slot):
+        waiting = False
+        generation = self.listener.generation
+        while not self.node_resources.has_capacity():
+            if not waiting:
+                self.log.info(
+                    __name__,
+                    fmt(u"Slot {} waiting for capacity: {}", slot, self.node_resources.usage()))
+                waiting = True
+            self._sleep_until_notified(generation, CAPACITY_CHECK_TIME)
+            generation = self.listener.generation
+
+    def _record_run(self, start_at, tag, schedule, process):
+        # Record the resources the worker used, for _get_footprint. Not
+        # retried - a missing run only makes the footprint a bit less accurate.
+        if process.resource_usage is None:
+            return
+        try:
+            with contextlib.closing(self.session_maker()) as session:
+                session.add(ScraperRun(
+                    scraper_name=schedule.scraper_name,
+                    owner_node=NODE,
+                    owner_name=self.args.scheduler_name,
+                    owner_tag=tag,
+                    start_at=start_at,
+                    returncode=process.returncode,
+                    maxrss=process.resource_usage.ru_maxrss,
+                    utime=process.resource_usage.ru_utime,
+                    stime=process.resource_usage.ru_stime))
+                session.commit()
+        except SQLAlchemyError:
+            self.log.critical(__name__, "record_run_failed", "Failed to record scraper run", exc_info=True)
+
+    def _invoke_scraper(self, now, tag, schedule, footprint=None, slot=None):
         events = _convert_events(get_schedule_events(now, schedule))
 
-        run_worker(
-            self.log,
-            self.args.scraper_working_dir,
-            schedule.scraper_name,
-            json.loads(schedule.scraper_args) if schedule.scraper_args else [],
-            KILL_TIME,
-            PING_TIME,
-            schedule_name(schedule),
-            events,
-            ping_func=lambda: self._ping_work(tag, schedule))
+        scraper_working_dir = self.args.scraper_working_dir
+        worker_name = schedule_name(schedule)
+        if slot is not None:
+            # run_worker clears out the working directory, so each slot needs its own
+            if scraper_working_dir:
+                scraper_working_dir = os.path.join(scraper_working_dir, "slot-{}".format(slot))
+            worker_name = u"{} (slot {})".format(worker_name, slot)
 
-    def schedule(self):
+        started = []
+
+        def _on_start(process):
+            started.append(process)
+            self.node_resources.add(slot, process, footprint)
+
+        wakeup_r, wakeup_w = os.pipe()
+        with self._wakeup_lock:
+            self._wakeup_fds[schedule.scraper_name] = wakeup_w
+        self.heartbeats.add(tag)
+
+        try:
+            run_worker(
+                self.log,
+                scraper_working_dir,
+                schedule.scraper_name,
+                json.loads(schedule.scraper_args) if schedule.scraper_args else [],
+                KILL_TIME,
+                PING_TIME,
+                worker_name,
+                events,
+                ping_func=lambda: self._ping_work(tag, schedule),
+                on_start=_on_start,
+                wakeup_fd=wakeup_r)
+        finally:
+            self.heartbeats.remove(tag)
+            with self._wakeup_lock:
+                del self._wakeup_fds[schedule.scraper_name]
+                os.close(wakeup_w)
+            os.close(wakeup_r)
+            self.node_resources.remove(slot)
+            if started:
+                self._record_run(now, tag, schedule, started[0])
+
+    def _run_slot(self, slot=None):
         while True:
             try:
-                now, tag, schedule = self._acquire_work()
+                if slot is not None:
+                    self._wait_for_capacity(slot)
+                now, tag, schedule, footprint = self._acquire_work()
                 try:
-                    self._invoke_scraper(now, tag, schedule)
+                    self._invoke_scraper(now, tag, schedule, footprint, slot)
                     self._complete_work(tag, schedule)
                 except (WorkerFailed, WorkStolen):
                     self._fail_work(tag, schedule, increment_failures=True)
                 except WorkerTerminated:
                     self._fail_work(tag, schedule, increment_failures=False)
-            except ServerShutdown:
+                except SlotsStopping:
+                    # The worker was killed - release the schedule right away
+                    self._fail_work(tag, schedule, increment_failures=False)
+                    return
+            except (ServerShutdown, SlotsStopping):
+                return
+
+    def schedule(self):
+        # Polling still happens if the listener can't connect or misses a
+        # notification - it just isn't the only way to find new work.
+        self.listener.start()
+        self.heartbeats.start()
+        try:
+            self._schedule_slots()
+        finally:
+            self.heartbeats.close()
+            self.listener.close()
+
+    def _schedule_slots(self):
+        if self.args.slots <= 1:
+            self._run_slot()
+            return
+
+        # Each slot runs one scraper at a time in its own thread. The slots share
+        # the DB session maker (and so its connection pool) and the node's
+        # resource limits. Pings, completions and failures are handled by the
+        # thread of the slot running the scraper.
+        failures = []
+
+        def _run(slot):
+            try:
+                self._run_slot(slot)
+            except Exception:  # pylint: disable=broad-except
+                self.log.critical(__name__, "slot_failed", fmt(u"Slot {} failed", slot), exc_info=True)
+                failures.append(sys.exc_info())
+
+        threads = []
+        for slot in range(self.args.slots):
+            thread = threading.Thread(target=_run, args=(slot,), name="scheduler-slot-{}".format(slot))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        while True:
+            if failures:
+                # Give up like a single slot scheduler would, but only once the
+                # other slots killed their workers and released their schedules.
+                self._stop_slots()
+                for thread in threads:
+                    thread.join()
+                exc_type, exc_value, exc_tb = failures[0]
+                raise exc_type, exc_value, exc_tb
+            alive = [thread for thread in threads if thread.is_alive()]
+            if not alive:
                 return
+            alive[0].join(1)
+
+    def _stop_slots(self):
+        self._stopping.set()
+        # Wake up the monitors of running workers, whose next ping kills them
+        with self._wakeup_lock:
+            for wakeup_fd in self._wakeup_fds.values():
+                os.write(wakeup_fd, b"s")
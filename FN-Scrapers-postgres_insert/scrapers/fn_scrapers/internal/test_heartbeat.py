@@ -0,0 +1,76 @@
+import mock
+from sqlalchemy.exc import OperationalError
+
+from fn_scrapers.internal.heartbeat import HeartbeatBatcher, SIGNAL_KILL, SIGNAL_STOLEN
+
+
+def _batcher(rows, on_execute=None):
+    def _execute(statement):
+        if on_execute is not None:
+            on_execute()
+        result = mock.Mock()
+        result.fetchall.return_value = rows
+        return result
+    session = mock.Mock()
+    session.execute.side_effect = _execute
+    return HeartbeatBatcher(lambda: session, mock.Mock(), 15), session
+
+def test_flush_signals():
+    batcher, session = _batcher([("running", False), ("killed", True)])
+    for tag in ("running", "killed", "stolen", "idle"):
+        batcher.add(tag)
+        if tag != "idle":
+            assert batcher.ping(tag) is None
+    batcher.flush()
+    assert session.commit.called
+    assert batcher.ping("running") is None
+    assert batcher.ping("killed") == SIGNAL_KILL
+    # Missing from the result - stolen, or the schedule was deleted
+    assert batcher.ping("stolen") == SIGNAL_STOLEN
+    # Didn't ping, so it wasn't written
+    assert batcher.ping("idle") is None
+
+    # Only work that pinged since the last write is written
+    session.execute.reset_mock()
+    batcher.flush()
+    assert session.execute.call_count == 1
+    batcher.flush()
+    assert session.execute.call_count == 1
+
+def test_flush_all_tags():
+    batcher, _ = _batcher([])
+    batcher.add("idle")
+    batcher.flush(all_tags=True)
+    assert batcher.ping("idle") == SIGNAL_STOLEN
+
+def test_flush_removed_tag():
+    batcher, _ = _batcher([], on_execute=lambda: batcher.remove("done"))
+    batcher.add("done")
+    batcher.ping("done")
+    batcher.flush()
+    # The work finished during the write - it gets no signal
+    assert "done" not in batcher._signals
+    assert not batcher._pending
+
+def test_flush_failure():
+    def _fail():
+        raise OperationalError("UPDATE", {}, Exception("down"))
+    batcher, _ = _batcher([], on_execute=_fail)
+    batcher.add("running")
+    batcher.ping("running")
+    batcher.flush()
+    assert batcher.log.critical.called
+    # Written with the next batch instead
+    assert batcher._pending == {"running"}
+    assert batcher.ping("running") is None
+
+def test_close():
+    batcher, session = _batcher([("running", False)])
+    batcher.interval = 60
+    batcher.start()
+    batcher.add("running")
+    batcher.ping("running")
+    batcher.close()
+    # The last pings are written, and the thread doesn't outlive the batcher
+    assert session.execute.call_count == 1
+    assert not batcher._thread.is_alive()
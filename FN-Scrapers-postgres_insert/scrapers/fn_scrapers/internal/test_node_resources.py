@@ -0,0 +1,71 @@
+import os
+
+import mock
+
+from fn_scrapers.internal.node_resources import NodeResources
+from fn_scrapers.internal.resource_process import ResourceProcess, read_proc_stats
+
+
+class FakeWorker(object):
+    def __init__(self, rss=0, cpu=0.0):
+        self.rss = rss
+        self.cpu = cpu
+
+    def current_usage(self, proc_stats=None):
+        return {"rss": self.rss, "cpu": self.cpu}
+
+def test_read_proc_stats():
+    stats = read_proc_stats()
+    ppid, cpu, rss = stats[os.getpid()]
+    assert ppid == os.getppid()
+    assert cpu >= 0 and rss > 0
+
+def test_current_usage():
+    process = ResourceProcess(mock.Mock(pid=10))
+    proc_stats = {
+        1: (0, 5.0, 100),
+        10: (1, 1.0, 1000),
+        11: (10, 2.0, 200),
+        12: (11, 0.5, 30),
+        13: (1, 9.0, 9000),
+    }
+    assert process.current_usage(proc_stats) == {"cpu": 3.5, "rss": 1230}
+    assert ResourceProcess(mock.Mock(pid=20)).current_usage(proc_stats) is None
+
+def test_node_resources():
+    clock = [100.0]
+    resources = NodeResources(max_rss=1000, max_cpu=2)
+    with mock.patch("fn_scrapers.internal.node_resources.read_proc_stats", return_value={}), \
+            mock.patch("fn_scrapers.internal.node_resources.time.time", lambda: clock[0]):
+        # A worker may always be started on an idle node
+        assert resources.has_capacity({"rss": 5000, "cpu": 8.0})
+
+        first = FakeWorker(rss=100, cpu=10.0)
+        resources.add(0, first, {"rss": 300, "cpu": 0.5})
+        # Counts as using at least its footprint, no CPU rate measured yet
+        assert resources.usage() == {"workers": 1, "rss": 300, "cpu": 0.5}
+
+        clock[0] += 0.5
+        first.cpu = 11.0
+        # Sampled too recently to measure the rate
+        assert resources.usage()["cpu"] == 0.5
+
+        clock[0] += 0.5
+        first.rss = 400
+        assert resources.usage() == {"workers": 1, "rss": 400, "cpu": 1.0}
+
+        second = FakeWorker(rss=500)
+        resources.add(1, second)
+        assert resources.usage() == {"workers": 2, "rss": 900, "cpu": 1.0}
+        assert resources.has_capacity({"rss": 100, "cpu": 1.0})
+        assert not resources.has_capacity({"rss": 101, "cpu": 0.0})
+        assert not resources.has_capacity({"rss": 0, "cpu": 1.5})
+
+        second.rss = 600
+        assert not resources.has_capacity()
+
+        resources.remove(1)
+        assert resources.has_capacity()
+        assert resources.usage()["workers"] == 1
+
+    assert NodeResources().has_capacity({"rss": 5000, "cpu": 8.0})
@@ -0,0 +1,30 @@
+import os
+import time
+
+import mock
+
+from fn_scrapers.internal.run_and_monitor_scraper import _EventSet, _monitor_worker
+
+
+class Pinged(Exception):
+    pass
+
+def test_monitor_worker_wakeup():
+    r, w = os.pipe()
+    wakeup_r, wakeup_w = os.pipe()
+    ping_func = mock.Mock(side_effect=Pinged)
+    try:
+        os.write(wakeup_w, b"k")
+        start = time.time()
+        try:
+            _monitor_worker(mock.Mock(), 60, _EventSet([]), r, mock.Mock(),
+                            "foo", ping_func, wakeup_fd=wakeup_r)
+            assert False
+        except Pinged:
+            pass
+        # Checked on the worker right away rather than at the next ping
+        assert time.time() - start < 5
+        assert ping_func.call_count == 1
+    finally:
+        for fd in (r, w, wakeup_r, wakeup_w):
+            os.close(fd)
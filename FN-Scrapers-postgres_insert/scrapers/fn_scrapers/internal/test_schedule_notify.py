@@ -0,0 +1,36 @@
+import json
+import threading
+import time
+
+import mock
+
+from fn_scrapers.internal.schedule_notify import EVENT_KILL, ScheduleListener
+
+
+def test_wait_after_wake():
+    listener = ScheduleListener(mock.Mock(), mock.Mock())
+    generation = listener.generation
+    # A notification between reading the generation and waiting isn't lost
+    listener._wake()
+    start = time.time()
+    assert listener.wait(generation, 10)
+    assert time.time() - start < 1
+    assert not listener.wait(listener.generation, 0.01)
+
+def test_wait_woken():
+    listener = ScheduleListener(mock.Mock(), mock.Mock())
+    threading.Timer(0.05, listener._wake).start()
+    start = time.time()
+    assert listener.wait(listener.generation, 10)
+    assert time.time() - start < 5
+
+def test_handle():
+    listener = ScheduleListener(mock.Mock(), mock.Mock())
+    callback = mock.Mock()
+    listener.add_callback(callback)
+    listener._handle(json.dumps({"event": EVENT_KILL, "scraper_name": "foo"}))
+    callback.assert_called_once_with(EVENT_KILL, "foo")
+    listener._handle("not json")
+    listener._handle(json.dumps({"event": EVENT_KILL}))
+    assert callback.call_count == 1
+    assert listener.log.warning.call_count == 2
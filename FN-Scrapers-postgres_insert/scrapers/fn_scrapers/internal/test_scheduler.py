@@ -0,0 +1,61 @@
+from datetime import datetime
+import threading
+import time
+
+import mock
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from fn_scrapers.internal.scheduler import Scheduler, _footprint_query, _next_work_query
+
+
+def _compile(query):
+    return str(query.statement.compile(dialect=postgresql.dialect()))
+
+def test_next_work_query():
+    sql = _compile(_next_work_query(Session(), datetime(2020, 1, 1), {'foo'}))
+    assert sql.rstrip().endswith('LIMIT %(param_1)s FOR UPDATE SKIP LOCKED')
+    assert 'NOT IN (%(scraper_name_1)s)' in sql
+
+def test_footprint_query():
+    sql = _compile(_footprint_query(Session(), 'foo'))
+    assert sql.startswith(
+        'SELECT percentile_cont(0.95) WITHIN GROUP (ORDER BY recent_runs.rss), '
+        'percentile_cont(0.95) WITHIN GROUP (ORDER BY recent_runs.cpu) \nFROM (')
+    assert sql.endswith('LIMIT %(param_1)s) AS recent_runs')
+
+def test_failed_slot_stops_other_slots():
+    scheduler = Scheduler.__new__(Scheduler)
+    scheduler.args = mock.Mock(slots=2)
+    scheduler.log = mock.Mock()
+    scheduler.heartbeats = mock.Mock()
+    scheduler.heartbeats.ping.return_value = None
+    scheduler._wakeup_fds = {}
+    scheduler._wakeup_lock = threading.Lock()
+    scheduler._stopping = threading.Event()
+    schedule = mock.Mock(scraper_name='foo')
+    running = threading.Event()
+
+    def _wait_for_capacity(slot):
+        if slot == 0:
+            running.wait(5)
+            raise ValueError('bad')
+    def _invoke_scraper(now, tag, schedule, footprint, slot):
+        # pings until the scraper is killed, like _monitor_worker
+        running.set()
+        while True:
+            scheduler._ping_work(tag, schedule)
+            time.sleep(0.01)
+
+    scheduler._wait_for_capacity = _wait_for_capacity
+    scheduler._acquire_work = lambda: (datetime(2020, 1, 1), 'tag', schedule, None)
+    scheduler._invoke_scraper = _invoke_scraper
+    scheduler._fail_work = mock.Mock()
+    try:
+        scheduler._schedule_slots()
+        assert False
+    except ValueError:
+        pass
+    scheduler._fail_work.assert_called_once_with('tag', schedule, increment_failures=False)
+    assert not [thread for thread in threading.enumerate()
+                if thread.name.startswith('scheduler-slot-')]